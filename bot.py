@@ -15,17 +15,30 @@ import json
 import re
 import shutil
 import gzip
+import random
 import csv
 import time
 import traceback
 import functools
+import hashlib
+import hmac
+import secrets
+import heapq
+import itertools
+import contextvars
+import threading
 import warnings
 import signal
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple, Any, Union
-from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple, Any, Union
+from collections import defaultdict, OrderedDict, deque
+from enum import IntEnum
 from pathlib import Path
 from io import StringIO, BytesIO
+from http import HTTPStatus
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
 import pytz
 import sqlite3
 from dataclasses import dataclass, asdict
@@ -80,20 +93,24 @@ try:
     from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
     from telegram.ext import (
         Application, ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-        ConversationHandler, MessageHandler, filters, ContextTypes
+        ConversationHandler, MessageHandler, filters, ContextTypes, BaseRateLimiter,
+        BasePersistence, PersistenceInput
     )
     from telegram.constants import ParseMode
-    from telegram.error import RetryAfter, TimedOut, BadRequest, Conflict
+    from telegram.error import RetryAfter, TimedOut, BadRequest, Conflict, Forbidden, NetworkError, TelegramError
+    import httpx
 except ImportError:
     print("Устанавливаем python-telegram-bot...")
     os.system(f"{sys.executable} -m pip install python-telegram-bot==20.3")
     from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
     from telegram.ext import (
         Application, ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-        ConversationHandler, MessageHandler, filters, ContextTypes
+        ConversationHandler, MessageHandler, filters, ContextTypes, BaseRateLimiter,
+        BasePersistence, PersistenceInput
     )
     from telegram.constants import ParseMode
-    from telegram.error import RetryAfter, TimedOut, BadRequest, Conflict
+    from telegram.error import RetryAfter, TimedOut, BadRequest, Conflict, Forbidden, NetworkError, TelegramError
+    import httpx
 
 try:
     from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -116,10 +133,11 @@ except ImportError:
 
 try:
     from sqlalchemy import (
-        create_engine, Column, Integer, String, DateTime, Text, 
+        create_engine, Column, Integer, String, DateTime, Date, Text, 
         Boolean, BigInteger, Index, func, select, and_, or_, desc,
-        inspect
+        inspect, event, text, bindparam
     )
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.orm import sessionmaker, scoped_session
     from sqlalchemy.pool import QueuePool
@@ -127,24 +145,26 @@ except ImportError:
     print("Устанавливаем SQLAlchemy...")
     os.system(f"{sys.executable} -m pip install sqlalchemy==2.0.23")
     from sqlalchemy import (
-        create_engine, Column, Integer, String, DateTime, Text, 
+        create_engine, Column, Integer, String, DateTime, Date, Text, 
         Boolean, BigInteger, Index, func, select, and_, or_, desc,
-        inspect
+        inspect, event, text, bindparam
     )
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.orm import sessionmaker, scoped_session
     from sqlalchemy.pool import QueuePool
 
 # ============== КОНФИГУРАЦИЯ ==============
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8515765315:AAEufR-gJQUZCux_kC0yDfmHRZf2QLgacUk")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
 ADMIN_IDS = [int(id) for id in os.environ.get("ADMIN_IDS", "308780639").split(",") if id]
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID", "308780639")
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 
 # Директории для данных
-DATA_DIR = Path("/app/data")
-BACKUP_DIR = Path("/app/backups")
-LOG_DIR = Path("/app/logs")
+DATA_DIR = Path(os.environ.get("DATA_DIR", "/app/data"))
+BACKUP_DIR = Path(os.environ.get("BACKUP_DIR", "/app/backups"))
+LOG_DIR = Path(os.environ.get("LOG_DIR", "/app/logs"))
 
 for directory in [DATA_DIR, BACKUP_DIR, LOG_DIR]:
     os.makedirs(directory, exist_ok=True)
@@ -362,19 +382,129 @@ def log_execution_time(func):
             raise
     return wrapper
 
+# ============== HTTP-КЛИЕНТ BOT API ==============
+
+BOT_API_TIMEOUT = float(os.environ.get("BOT_API_TIMEOUT", "10"))
+BOT_API_CONNECTIONS = int(os.environ.get("BOT_API_CONNECTIONS", "4"))
+
+class BotApiClient:
+    """Общий keep-alive клиент для запросов к Bot API в обход python-telegram-bot.
+    
+    Уведомления админу, deleteWebhook и прочие служебные вызовы идут через один
+    пул соединений httpx вместо синхронного requests с новым TCP+TLS на каждый
+    запрос. Адрес берется из TELEGRAM_API_URL, так что в тестах его можно
+    направить на локальную заглушку.
+    """
+    
+    def __init__(self, token: str, base_url: str = TELEGRAM_API_URL,
+                 timeout: float = BOT_API_TIMEOUT, max_connections: int = BOT_API_CONNECTIONS):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=f"{self.base_url}/bot{self.token}/",
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                )
+            )
+        return self._client
+    
+    async def call(self, method: str, **params) -> Any:
+        """Вызывает метод Bot API и возвращает result; ошибки - как в python-telegram-bot."""
+        try:
+            r = await self.client.post(method, json=params)
+            data = r.json()
+        except httpx.TimeoutException as e:
+            raise TimedOut(str(e) or "Timed out") from e
+        except (httpx.HTTPError, ValueError) as e:
+            raise NetworkError(f"{method}: {e}") from e
+        
+        if data.get('ok'):
+            return data.get('result')
+        
+        parameters = data.get('parameters') or {}
+        description = data.get('description', f"HTTP {r.status_code}")
+        if 'retry_after' in parameters:
+            raise RetryAfter(parameters['retry_after'])
+        if r.status_code == 403:
+            raise Forbidden(description)
+        if r.status_code == 400:
+            raise BadRequest(description)
+        raise TelegramError(description)
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+bot_api = BotApiClient(BOT_TOKEN)
+
 # ============== СИСТЕМА УВЕДОМЛЕНИЙ ОБ ОШИБКАХ ==============
 
+ERROR_DIGEST_WINDOW = int(os.environ.get("ERROR_DIGEST_WINDOW", "300"))
+ERROR_QUEUE_SIZE = int(os.environ.get("ERROR_QUEUE_SIZE", "1000"))
+ERROR_MAX_FINGERPRINTS = int(os.environ.get("ERROR_MAX_FINGERPRINTS", "100"))
+ERROR_ALERTS_PER_WINDOW = int(os.environ.get("ERROR_ALERTS_PER_WINDOW", "5"))
+
+def error_fingerprint(error_type: str, message: str, tb: Optional[str]) -> str:
+    """Отпечаток ошибки: тип + стек вызовов (без текста сообщения, в нем бывают id)."""
+    if tb:
+        frames = [line.strip() for line in tb.splitlines() if line.lstrip().startswith('File ')]
+        key = error_type + "\n" + "\n".join(frames)
+    else:
+        key = error_type + "\n" + re.sub(r'\d+', '#', message)
+    return hashlib.sha1(key.encode('utf-8', 'replace')).hexdigest()[:16]
+
+@dataclass
+class ErrorDigest:
+    error_type: str
+    message: str
+    traceback: Optional[str]
+    user_id: Optional[int]
+    first_seen: datetime
+    last_seen: datetime
+    count: int = 1
+    alerted: bool = False
+
 class ErrorNotifier:
-    def __init__(self, bot_token: str, admin_chat_id: str):
-        self.bot_token = bot_token
+    """Уведомления админу об ошибках со сводками по окнам.
+    
+    notify() только кладет ошибку в буфер фиксированного размера (при переполнении
+    вытесняются самые старые). Обработчик группирует ошибки по отпечатку: первая
+    ошибка с новым отпечатком в окне уходит сразу (не больше ERROR_ALERTS_PER_WINDOW
+    за окно), остальные копятся, и в конце окна ERROR_DIGEST_WINDOW приходит одна
+    сводка "N раз за 5 минут, первая/последняя". Число сообщений и память не зависят
+    от того, сколько ошибок случилось.
+    """
+    
+    def __init__(self, api: BotApiClient, admin_chat_id: str,
+                 window: int = ERROR_DIGEST_WINDOW, queue_size: int = ERROR_QUEUE_SIZE):
+        self.api = api
         self.admin_chat_id = int(admin_chat_id) if admin_chat_id else None
-        self.error_counts = defaultdict(int)
-        self.last_reset = datetime.now()
-        self.queue = asyncio.Queue()
+        self.window = window
+        self.buffer = deque(maxlen=queue_size)
+        self.digests: Dict[str, ErrorDigest] = {}
+        self.window_started = datetime.now()
+        self.alerts_in_window = 0
+        self.overflow = 0
+        self.received = 0
+        self.dropped = 0
+        self.sent = 0
         self.task = None
+        self._wakeup: Optional[asyncio.Event] = None
     
     async def start(self):
         if self.admin_chat_id:
+            self._wakeup = asyncio.Event()
+            self.window_started = datetime.now()
             self.task = asyncio.create_task(self._processor())
             log.info("✅ Система уведомлений об ошибках запущена")
     
@@ -385,110 +515,234 @@ class ErrorNotifier:
                 await self.task
             except asyncio.CancelledError:
                 pass
+            self.task = None
+            self._collect()
+            try:
+                await asyncio.wait_for(self._flush(), timeout=5)
+            except Exception as e:
+                print(f"Failed to send error digest: {e}")
     
     async def _processor(self):
         while True:
             try:
-                if datetime.now() - self.last_reset > timedelta(hours=1):
-                    self.error_counts.clear()
-                    self.last_reset = datetime.now()
+                remaining = self.window - (datetime.now() - self.window_started).total_seconds()
+                if remaining > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
                 
-                error = await self.queue.get()
-                key = error['type']
-                self.error_counts[key] += 1
+                for digest in self._collect():
+                    await self._send_alert(digest)
                 
-                if self.error_counts[key] <= 5:
-                    await self._send(error)
-                
-                await asyncio.sleep(2)
+                if (datetime.now() - self.window_started).total_seconds() >= self.window:
+                    await self._flush()
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 print(f"Error in notification processor: {e}")
     
-    async def _send(self, error: dict):
+    def _collect(self) -> List[ErrorDigest]:
+        """Разбирает буфер в сводки окна; возвращает ошибки для немедленного уведомления."""
+        immediate = []
+        while self.buffer:
+            error = self.buffer.popleft()
+            fingerprint = error_fingerprint(error['type'], error['message'], error['traceback'])
+            digest = self.digests.get(fingerprint)
+            if digest:
+                digest.count += 1
+                digest.last_seen = error['timestamp']
+                continue
+            if len(self.digests) >= ERROR_MAX_FINGERPRINTS:
+                self.overflow += 1
+                continue
+            digest = ErrorDigest(
+                error_type=error['type'], message=error['message'], traceback=error['traceback'],
+                user_id=error['user_id'], first_seen=error['timestamp'], last_seen=error['timestamp']
+            )
+            self.digests[fingerprint] = digest
+            if self.alerts_in_window < ERROR_ALERTS_PER_WINDOW:
+                self.alerts_in_window += 1
+                immediate.append(digest)
+        return immediate
+    
+    async def _flush(self):
+        """Отправляет сводку за окно и начинает новое."""
+        pending = [
+            d for d in self.digests.values()
+            if d.count > 1 or not d.alerted
+        ]
+        overflow, dropped = self.overflow, self.dropped
+        minutes = max(1, round(self.window / 60))
+        
+        self.digests = {}
+        self.overflow = 0
+        self.dropped = 0
+        self.alerts_in_window = 0
+        self.window_started = datetime.now()
+        
+        if not pending and not overflow and not dropped:
+            return
+        
+        pending.sort(key=lambda d: d.count, reverse=True)
+        text = f"📊 Сводка ошибок за {minutes} мин\n"
+        for digest in pending[:20]:
+            text += (
+                f"\n• {digest.count} × {digest.error_type}: {digest.message[:150]}\n"
+                f"  первая {digest.first_seen:%H:%M:%S}, последняя {digest.last_seen:%H:%M:%S}\n"
+            )
+        if len(pending) > 20:
+            text += f"\n… и еще {len(pending) - 20} видов ошибок\n"
+        if overflow:
+            text += f"\n⚠️ Без группировки (лимит видов): {overflow}\n"
+        if dropped:
+            text += f"\n⚠️ Вытеснено из буфера: {dropped}\n"
+        await self._post(text[:4000], parse_mode=None)
+    
+    async def _send_alert(self, digest: ErrorDigest):
+        digest.alerted = True
         text = f"🚨 *Критическая ошибка!*\n\n"
-        text += f"**Тип:** {error['type']}\n"
-        text += f"**Время:** {error['timestamp']}\n"
-        if 'user_id' in error:
-            text += f"**Пользователь:** `{error['user_id']}`\n"
-        text += f"\n**Сообщение:**\n```\n{error['message'][:500]}\n```\n"
-        if 'traceback' in error:
-            text += f"\n**Traceback:**\n```\n{error['traceback'][:1000]}\n```"
-        
-        import requests
+        text += f"**Тип:** {digest.error_type}\n"
+        text += f"**Время:** {digest.first_seen:%Y-%m-%d %H:%M:%S}\n"
+        if digest.user_id:
+            text += f"**Пользователь:** `{digest.user_id}`\n"
+        text += f"\n**Сообщение:**\n```\n{digest.message[:500]}\n```\n"
+        if digest.traceback:
+            text += f"\n**Traceback:**\n```\n{digest.traceback[-1000:]}\n```"
+        text += f"\nПовторы придут сводкой через {max(1, round(self.window / 60))} мин."
+        await self._post(text, parse_mode="Markdown")
+    
+    async def _post(self, text: str, parse_mode: Optional[str]):
+        params = {"chat_id": self.admin_chat_id, "text": text}
+        if parse_mode:
+            params["parse_mode"] = parse_mode
         try:
-            requests.post(
-                f"https://api.telegram.org/bot{self.bot_token}/sendMessage",
-                json={"chat_id": self.admin_chat_id, "text": text, "parse_mode": "Markdown"},
-                timeout=5
+            await outbound_queue.submit(
+                SendPriority.ADMIN, self.admin_chat_id,
+                functools.partial(self.api.call, "sendMessage", **params)
             )
+            self.sent += 1
         except Exception as e:
             print(f"Failed to send notification: {e}")
     
     def notify(self, error_type: str, message: str, user_id: int = None, traceback: str = None):
         if not self.admin_chat_id:
             return
-        try:
-            self.queue.put_nowait({
-                "type": error_type,
-                "message": message,
-                "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                "user_id": user_id,
-                "traceback": traceback
-            })
-        except asyncio.QueueFull:
-            print("Notification queue full")
+        self.received += 1
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append({
+            "type": error_type,
+            "message": message[:500],
+            "timestamp": datetime.now(),
+            "user_id": user_id,
+            "traceback": traceback[-2000:] if traceback else None
+        })
+        if self._wakeup:
+            self._wakeup.set()
 
 error_notifier = None
 
 # ============== СИСТЕМА РЕЗЕРВНОГО КОПИРОВАНИЯ ==============
 
+# Копия снимается sqlite3 backup API шагами по BACKUP_STEP_PAGES страниц с паузой
+# BACKUP_STEP_PAUSE между ними, чтобы не забирать диск у запросов бота
+BACKUP_STEP_PAGES = int(os.environ.get("BACKUP_STEP_PAGES", "1024"))
+BACKUP_STEP_PAUSE = float(os.environ.get("BACKUP_STEP_PAUSE", "0.005"))
+BACKUP_COMPRESS_LEVEL = int(os.environ.get("BACKUP_COMPRESS_LEVEL", "6"))
+
 class BackupManager:
+    FILES = (("lor_reminder.db", "БД"), ("apscheduler_jobs.db", "Jobs"))
+    
     def __init__(self, db_path: Path, jobs_path: Path, backup_dir: Path, max_backups: int = 30):
         self.db_path = db_path
         self.jobs_path = jobs_path
         self.backup_dir = backup_dir
         self.max_backups = max_backups
         self.backup_dir.mkdir(exist_ok=True)
-    
-    def create_backup(self, backup_type: str = "auto") -> Optional[Path]:
-        try:
+        # Обе БД копируются и сжимаются параллельно, вне event loop и вне db_executor
+        self._executor = ThreadPoolExecutor(max_workers=len(self.FILES), thread_name_prefix="backup")
+        self._lock = asyncio.Lock()
+        self.created = 0
+        self.failed = 0
+        self.last_duration = 0.0
+    
+    async def create_backup(self, backup_type: str = "auto") -> Optional[Path]:
+        """Снимает онлайн-копию обеих БД, не блокируя event loop; бэкапы не накладываются друг на друга."""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            started = time.monotonic()
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             backup_path = self.backup_dir / f"{backup_type}_{timestamp}"
-            backup_path.mkdir(exist_ok=True)
-            
-            stats = []
-            
-            if self.db_path.exists():
-                dst = backup_path / "lor_reminder.db"
-                shutil.copy2(self.db_path, dst)
-                self._compress(dst)
-                stats.append(f"БД: {self.db_path.stat().st_size / 1024:.1f}KB")
-            
-            if self.jobs_path.exists():
-                dst = backup_path / "apscheduler_jobs.db"
-                shutil.copy2(self.jobs_path, dst)
-                self._compress(dst)
-                stats.append(f"Jobs: {self.jobs_path.stat().st_size / 1024:.1f}KB")
-            
-            self._save_metadata(backup_path, backup_type, stats)
-            self._cleanup_old()
-            
-            log.info(f"✅ {backup_type.upper()} бэкап создан: {timestamp} ({', '.join(stats)})")
-            return backup_path
-            
-        except Exception as e:
-            log.error(f"❌ Ошибка создания бэкапа: {e}")
-            return None
+            try:
+                backup_path.mkdir(exist_ok=True)
+                
+                sources = [(src, name, label) for src, (name, label) in zip((self.db_path, self.jobs_path), self.FILES)
+                           if src.exists()]
+                sizes = await asyncio.gather(*(
+                    loop.run_in_executor(self._executor, self._backup_database, src, backup_path / name)
+                    for src, name, _ in sources
+                ))
+                stats = [f"{label}: {size / 1024:.1f}KB" for (_, _, label), size in zip(sources, sizes)]
+                
+                await loop.run_in_executor(self._executor, self._finish, backup_path, backup_type, stats)
+                
+                self.created += 1
+                self.last_duration = time.monotonic() - started
+                log.info(f"✅ {backup_type.upper()} бэкап создан: {timestamp} ({', '.join(stats)}) "
+                         f"за {self.last_duration:.1f}s")
+                return backup_path
+                
+            except Exception as e:
+                self.failed += 1
+                log.error(f"❌ Ошибка создания бэкапа: {e}")
+                # Неполный бэкап не должен попасть в список и в восстановление
+                await loop.run_in_executor(self._executor, functools.partial(shutil.rmtree, backup_path, ignore_errors=True))
+                return None
+    
+    async def close(self):
+        """Дожидается текущего бэкапа и останавливает потоки."""
+        async with self._lock:
+            self._executor.shutdown(wait=True)
+    
+    def _backup_database(self, src: Path, dst: Path) -> int:
+        """Копирует БД через backup API в dst и сжимает; возвращает размер копии.
+        
+        Все шаги идут внутри одной читающей транзакции: в WAL-режиме она не
+        мешает писателям и держит согласованный снимок. Без нее каждая запись
+        бота между шагами перезапускала бы копирование с начала.
+        """
+        source = sqlite3.connect(str(src), timeout=SQLITE_PROFILE.busy_timeout_ms / 1000, isolation_level=None)
+        target = sqlite3.connect(str(dst))
+        try:
+            source.execute("BEGIN")
+            source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            source.backup(target, pages=BACKUP_STEP_PAGES, progress=self._step_pause)
+            source.execute("COMMIT")
+        finally:
+            target.close()
+            source.close()
+        size = dst.stat().st_size
+        self._compress(dst)
+        return size
+    
+    @staticmethod
+    def _step_pause(status: int, remaining: int, total: int):
+        if remaining and BACKUP_STEP_PAUSE > 0:
+            time.sleep(BACKUP_STEP_PAUSE)
     
     def _compress(self, file_path: Path):
         compressed = file_path.with_suffix('.db.gz')
         with open(file_path, 'rb') as f_in:
-            with gzip.open(compressed, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            with gzip.open(compressed, 'wb', compresslevel=BACKUP_COMPRESS_LEVEL) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
         file_path.unlink()
     
+    def _finish(self, backup_path: Path, backup_type: str, stats: list):
+        self._save_metadata(backup_path, backup_type, stats)
+        self._cleanup_old()
+    
     def _save_metadata(self, backup_path: Path, backup_type: str, stats: list):
         metadata = {
             "timestamp": backup_path.name.split('_')[1],
@@ -542,6 +796,8 @@ class BackupManager:
         try:
             for gz_file in backup_path.glob("*.gz"):
                 original = DATA_DIR / gz_file.stem
+                for suffix in ("-wal", "-shm"):
+                    Path(f"{original}{suffix}").unlink(missing_ok=True)
                 with gzip.open(gz_file, 'rb') as f_in:
                     with open(original, 'wb') as f_out:
                         shutil.copyfileobj(f_in, f_out)
@@ -611,7 +867,10 @@ class Medicine(Base):
     paused_until = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=lambda: datetime.now(pytz.UTC))
     
-    __table_args__ = (Index('ix_medicines_user_status', 'user_id', 'status'),)
+    __table_args__ = (
+        Index('ix_medicines_user_status', 'user_id', 'status'),
+        Index('ix_medicines_paused', 'paused_until', sqlite_where=text('paused_until IS NOT NULL')),
+    )
 
 class Analysis(Base):
     __tablename__ = 'analyses'
@@ -633,6 +892,7 @@ class Analysis(Base):
     __table_args__ = (
         Index('ix_analyses_user_status', 'user_id', 'status'),
         Index('ix_analyses_scheduled_date', 'scheduled_date'),
+        Index('ix_analyses_paused', 'paused_until', sqlite_where=text('paused_until IS NOT NULL')),
     )
 
 class Reminder(Base):
@@ -648,9 +908,13 @@ class Reminder(Base):
     last_error = Column(Text, nullable=True)
     postponed_until = Column(DateTime(timezone=True), nullable=True)
     postponed_days = Column(Integer, nullable=True)
+    next_retry_at = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime, default=lambda: datetime.now(pytz.UTC))
     
-    __table_args__ = (Index('ix_reminders_status_time', 'status', 'scheduled_time'),)
+    __table_args__ = (
+        Index('ix_reminders_status_time', 'status', 'scheduled_time'),
+        Index('ix_reminders_retry', 'status', 'next_retry_at'),
+    )
 
 class MedicineLog(Base):
     __tablename__ = 'medicine_logs'
@@ -722,188 +986,841 @@ class BroadcastLog(Base):
     total = Column(Integer, nullable=False)
     success = Column(Integer, nullable=False)
     failed = Column(Integer, nullable=False)
+    status = Column(String(20), default='running')
+    last_user_id = Column(BigInteger, default=0)
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+class ConversationState(Base):
+    """Состояние persistent ConversationHandler: строка на каждый незавершенный диалог."""
+    __tablename__ = 'conversation_states'
+    name = Column(String(50), primary_key=True)
+    conversation_key = Column(String(100), primary_key=True)
+    user_id = Column(BigInteger, nullable=False, index=True)
+    state = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
 
-# ============== ФУНКЦИЯ МИГРАЦИИ БАЗЫ ДАННЫХ ==============
+class UserData(Base):
+    """context.user_data пользователя в JSON; пустой user_data строки не имеет."""
+    __tablename__ = 'user_data'
+    user_id = Column(BigInteger, primary_key=True)
+    data = Column(Text, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
 
-def migrate_database():
-    db = SessionLocal()
+class DailyUserStats(Base):
+    """Сводка журналов пользователя за локальный день: из нее строятся экраны статистики."""
+    __tablename__ = 'daily_user_stats'
+    user_id = Column(BigInteger, primary_key=True)
+    day = Column(Date, primary_key=True)
+    mood_count = Column(Integer, nullable=False, default=0)
+    mood_sum = Column(Integer, nullable=False, default=0)
+    mood_min = Column(Integer, nullable=True)
+    mood_max = Column(Integer, nullable=True)
+    symptom_count = Column(Integer, nullable=False, default=0)
+    symptom_sum = Column(Integer, nullable=False, default=0)
+    symptom_min = Column(Integer, nullable=True)
+    symptom_max = Column(Integer, nullable=True)
+    medicine_taken = Column(Integer, nullable=False, default=0)
+    medicine_skipped = Column(Integer, nullable=False, default=0)
+
+class AppState(Base):
+    """Служебные значения фоновых задач (водяные знаки и т.п.) в виде ключ-значение."""
+    __tablename__ = 'app_state'
+    key = Column(String(100), primary_key=True)
+    value = Column(Text, nullable=True)
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
+
+# ============== МИГРАЦИИ СХЕМЫ БАЗЫ ДАННЫХ ==============
+
+MIGRATIONS: List[Tuple[int, str, Any]] = []
+
+def migration(version: int, description: str):
+    """Регистрирует функцию миграции fn(conn). Версии применяются по возрастанию.
+    
+    Миграция, добавляющая таблицу, создает ее сама (Model.__table__.create с
+    checkfirst=True): на версионированной БД create_all больше не вызывается.
+    """
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+def add_column(conn, table: str, column_ddl: str):
+    """ALTER TABLE ADD COLUMN, не падающий, если колонка уже есть."""
     try:
-        inspector = inspect(engine)
-        
-        if 'medicines' in inspector.get_table_names():
-            columns = [c['name'] for c in inspector.get_columns('medicines')]
-            
-            if 'times_per_day' not in columns:
-                db.execute(text('ALTER TABLE medicines ADD COLUMN times_per_day INTEGER DEFAULT 1'))
-                log.info("✅ Добавлена колонка times_per_day в medicines")
-            
-            if 'reminder_minutes' not in columns:
-                db.execute(text('ALTER TABLE medicines ADD COLUMN reminder_minutes INTEGER DEFAULT 0'))
-                log.info("✅ Добавлена колонка reminder_minutes в medicines")
-            
-            if 'course_type' not in columns:
-                db.execute(text('ALTER TABLE medicines ADD COLUMN course_type VARCHAR(20) DEFAULT "unlimited"'))
-                log.info("✅ Добавлена колонка course_type в medicines")
-            
-            if 'course_days' not in columns:
-                db.execute(text('ALTER TABLE medicines ADD COLUMN course_days INTEGER'))
-                log.info("✅ Добавлена колонка course_days в medicines")
-            
-            if 'repeat_type' not in columns:
-                db.execute(text('ALTER TABLE medicines ADD COLUMN repeat_type VARCHAR(20) DEFAULT "none"'))
-                log.info("✅ Добавлена колонка repeat_type в medicines")
-            
-            if 'repeat_days' not in columns:
-                db.execute(text('ALTER TABLE medicines ADD COLUMN repeat_days INTEGER'))
-                log.info("✅ Добавлена колонка repeat_days в medicines")
-            
-            if 'paused_until' not in columns:
-                db.execute(text('ALTER TABLE medicines ADD COLUMN paused_until DATETIME'))
-                log.info("✅ Добавлена колонка paused_until в medicines")
-            
-            if 'end_date' not in columns:
-                db.execute(text('ALTER TABLE medicines ADD COLUMN end_date DATETIME'))
-                log.info("✅ Добавлена колонка end_date в medicines")
-        
-        if 'analyses' in inspector.get_table_names():
-            columns = [c['name'] for c in inspector.get_columns('analyses')]
-            
-            if 'reminder_unit' not in columns:
-                db.execute(text('ALTER TABLE analyses ADD COLUMN reminder_unit VARCHAR(10) DEFAULT "minutes"'))
-                log.info("✅ Добавлена колонка reminder_unit в analyses")
-            
-            if 'repeat_interval' not in columns:
-                db.execute(text('ALTER TABLE analyses ADD COLUMN repeat_interval INTEGER'))
-                log.info("✅ Добавлена колонка repeat_interval в analyses")
-            
-            if 'reminder_before' not in columns:
-                db.execute(text('ALTER TABLE analyses ADD COLUMN reminder_before INTEGER DEFAULT 120'))
-                log.info("✅ Добавлена колонка reminder_before в analyses")
-            
-            if 'scheduled_time' not in columns:
-                db.execute(text('ALTER TABLE analyses ADD COLUMN scheduled_time VARCHAR(10) DEFAULT "12:00"'))
-                log.info("✅ Добавлена колонка scheduled_time в analyses")
-            
-            if 'paused_until' not in columns:
-                db.execute(text('ALTER TABLE analyses ADD COLUMN paused_until DATETIME'))
-                log.info("✅ Добавлена колонка paused_until в analyses")
-            
-            if 'notes' not in columns:
-                db.execute(text('ALTER TABLE analyses ADD COLUMN notes TEXT'))
-                log.info("✅ Добавлена колонка notes в analyses")
-        
-        if 'reminders' in inspector.get_table_names():
-            columns = [c['name'] for c in inspector.get_columns('reminders')]
-            
-            if 'postponed_days' not in columns:
-                db.execute(text('ALTER TABLE reminders ADD COLUMN postponed_days INTEGER'))
-                log.info("✅ Добавлена колонка postponed_days в reminders")
-            
-            if 'postponed_until' not in columns:
-                db.execute(text('ALTER TABLE reminders ADD COLUMN postponed_until DATETIME'))
-                log.info("✅ Добавлена колонка postponed_until в reminders")
-            
-            if 'retry_count' not in columns:
-                db.execute(text('ALTER TABLE reminders ADD COLUMN retry_count INTEGER DEFAULT 0'))
-                log.info("✅ Добавлена колонка retry_count в reminders")
-            
-            if 'last_error' not in columns:
-                db.execute(text('ALTER TABLE reminders ADD COLUMN last_error TEXT'))
-                log.info("✅ Добавлена колонка last_error в reminders")
-        
-        if 'medicine_logs' in inspector.get_table_names():
-            columns = [c['name'] for c in inspector.get_columns('medicine_logs')]
-            
-            if 'is_planned' not in columns:
-                db.execute(text('ALTER TABLE medicine_logs ADD COLUMN is_planned BOOLEAN DEFAULT 1'))
-                log.info("✅ Добавлена колонка is_planned в medicine_logs")
-            
-            if 'dosage' not in columns:
-                db.execute(text('ALTER TABLE medicine_logs ADD COLUMN dosage VARCHAR(50)'))
-                log.info("✅ Добавлена колонка dosage в medicine_logs")
-            
-            if 'comment' not in columns:
-                db.execute(text('ALTER TABLE medicine_logs ADD COLUMN comment TEXT'))
-                log.info("✅ Добавлена колонка comment в medicine_logs")
-            
-            if 'course_info' not in columns:
-                db.execute(text('ALTER TABLE medicine_logs ADD COLUMN course_info TEXT'))
-                log.info("✅ Добавлена колонка course_info в medicine_logs")
-        
-        if 'users' in inspector.get_table_names():
-            columns = [c['name'] for c in inspector.get_columns('users')]
-            
-            if 'is_admin' not in columns:
-                db.execute(text('ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT 0'))
-                log.info("✅ Добавлена колонка is_admin в users")
-            
-            if 'language' not in columns:
-                db.execute(text('ALTER TABLE users ADD COLUMN language VARCHAR(10) DEFAULT "ru"'))
-                log.info("✅ Добавлена колонка language в users")
-            
-            if 'total_interactions' not in columns:
-                db.execute(text('ALTER TABLE users ADD COLUMN total_interactions INTEGER DEFAULT 0'))
-                log.info("✅ Добавлена колонка total_interactions в users")
-        
-        db.commit()
-        log.info("✅ Миграция базы данных завершена успешно")
-        
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column_ddl}"))
+        log.info(f"✅ Добавлена колонка {column_ddl.split()[0]} в {table}")
     except Exception as e:
-        log.error(f"❌ Ошибка при миграции БД: {e}")
-        db.rollback()
-    finally:
-        db.close()
+        if "duplicate column" not in str(e).lower():
+            raise
+
+LEGACY_COLUMNS = {
+    'medicines': [
+        "times_per_day INTEGER DEFAULT 1",
+        "reminder_minutes INTEGER DEFAULT 0",
+        "course_type VARCHAR(20) DEFAULT 'unlimited'",
+        "course_days INTEGER",
+        "repeat_type VARCHAR(20) DEFAULT 'none'",
+        "repeat_days INTEGER",
+        "paused_until DATETIME",
+        "end_date DATETIME",
+    ],
+    'analyses': [
+        "reminder_unit VARCHAR(10) DEFAULT 'minutes'",
+        "repeat_interval INTEGER",
+        "reminder_before INTEGER DEFAULT 120",
+        "scheduled_time VARCHAR(10) DEFAULT '12:00'",
+        "paused_until DATETIME",
+        "notes TEXT",
+    ],
+    'reminders': [
+        "postponed_days INTEGER",
+        "postponed_until DATETIME",
+        "retry_count INTEGER DEFAULT 0",
+        "last_error TEXT",
+    ],
+    'medicine_logs': [
+        "is_planned BOOLEAN DEFAULT 1",
+        "dosage VARCHAR(50)",
+        "comment TEXT",
+        "course_info TEXT",
+    ],
+    'users': [
+        "is_admin BOOLEAN DEFAULT 0",
+        "language VARCHAR(10) DEFAULT 'ru'",
+        "total_interactions INTEGER DEFAULT 0",
+    ],
+}
+
+@migration(1, "Колонки, добавленные до появления версий схемы")
+def _migration_legacy_columns(conn):
+    inspector = inspect(conn)
+    for table, columns in LEGACY_COLUMNS.items():
+        if not inspector.has_table(table):
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table)}
+        for column_ddl in columns:
+            if column_ddl.split()[0] not in existing:
+                add_column(conn, table, column_ddl)
+
+@migration(2, "Повторная отправка напоминаний: next_retry_at")
+def _migration_reminder_retries(conn):
+    add_column(conn, 'reminders', "next_retry_at DATETIME")
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_reminders_retry ON reminders (status, next_retry_at)"))
+
+@migration(3, "Рассылки: статус и контрольная точка")
+def _migration_broadcast_progress(conn):
+    add_column(conn, 'broadcast_logs', "status VARCHAR(20) DEFAULT 'done'")
+    add_column(conn, 'broadcast_logs', "last_user_id BIGINT DEFAULT 0")
+    add_column(conn, 'broadcast_logs', "finished_at DATETIME")
+
+@migration(4, "Хранение состояния диалогов и user_data")
+def _migration_conversation_persistence(conn):
+    ConversationState.__table__.create(conn, checkfirst=True)
+    UserData.__table__.create(conn, checkfirst=True)
+
+# Существующие журналы переносятся в сводки после старта (backfill_daily_stats):
+# миграции выполняются при импорте, раньше, чем объявлены часовые пояса
+daily_stats_backfill_pending = False
+
+@migration(5, "Дневные сводки статистики пользователей")
+def _migration_daily_user_stats(conn):
+    global daily_stats_backfill_pending
+    DailyUserStats.__table__.create(conn, checkfirst=True)
+    daily_stats_backfill_pending = True
+
+@migration(6, "Служебное состояние и частичные индексы паузы")
+def _migration_app_state(conn):
+    AppState.__table__.create(conn, checkfirst=True)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_medicines_paused ON medicines (paused_until) WHERE paused_until IS NOT NULL"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_analyses_paused ON analyses (paused_until) WHERE paused_until IS NOT NULL"))
+
+def latest_schema_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def migrate_database():
+    """Применяет только те миграции, версия которых выше записанной в schema_version.
+    
+    На актуальной БД это один SELECT без интроспекции схемы. Новая БД создается
+    по моделям и сразу помечается последней версией.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at DATETIME NOT NULL)"
+        ))
+        current = conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    
+    latest = latest_schema_version()
+    if current is not None and current >= latest:
+        log.info(f"✅ Схема БД актуальна (версия {current})")
+        return
+    
+    if current is None:
+        fresh = not inspect(engine).has_table('users')
+        Base.metadata.create_all(bind=engine)
+        log.info("✅ Таблицы созданы/проверены")
+        if fresh:
+            with engine.begin() as conn:
+                for version, description, _ in MIGRATIONS:
+                    _record_migration(conn, version, description)
+            log.info(f"✅ Новая БД создана сразу в версии {latest}")
+            return
+        current = 0
+    
+    for version, description, fn in MIGRATIONS:
+        if version <= current:
+            continue
+        with engine.begin() as conn:
+            fn(conn)
+            _record_migration(conn, version, description)
+        log.info(f"✅ Миграция {version} применена: {description}")
+
+def _record_migration(conn, version: int, description: str):
+    conn.execute(
+        text("INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :a)"),
+        {"v": version, "d": description, "a": datetime.now(pytz.UTC)}
+    )
 
 # ============== СОЕДИНЕНИЕ С БД ==============
 
-engine = create_engine(
+@dataclass
+class SQLiteProfile:
+    """Набор PRAGMA, применяемых к каждому новому соединению SQLite."""
+    journal_mode: str = "WAL"
+    busy_timeout_ms: int = 5000
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024
+    cache_size: int = -20000
+    
+    @classmethod
+    def from_env(cls) -> "SQLiteProfile":
+        return cls(
+            journal_mode=os.environ.get("SQLITE_JOURNAL_MODE", cls.journal_mode).upper(),
+            busy_timeout_ms=int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", cls.busy_timeout_ms)),
+            synchronous=os.environ.get("SQLITE_SYNCHRONOUS", cls.synchronous).upper(),
+            mmap_size=int(os.environ.get("SQLITE_MMAP_SIZE", cls.mmap_size)),
+            cache_size=int(os.environ.get("SQLITE_CACHE_SIZE", cls.cache_size)),
+        )
+    
+    def pragmas(self) -> List[str]:
+        return [
+            f"PRAGMA journal_mode={self.journal_mode}",
+            f"PRAGMA busy_timeout={self.busy_timeout_ms}",
+            f"PRAGMA synchronous={self.synchronous}",
+            f"PRAGMA mmap_size={self.mmap_size}",
+            f"PRAGMA cache_size={self.cache_size}",
+        ]
+
+SQLITE_PROFILE = SQLiteProfile.from_env()
+
+def apply_sqlite_profile(target_engine, profile: SQLiteProfile = SQLITE_PROFILE):
+    if target_engine.dialect.name != "sqlite":
+        return
+    
+    @event.listens_for(target_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in profile.pragmas():
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+def create_sqlite_engine(url: str, **kwargs):
+    if url.startswith("sqlite"):
+        kwargs.setdefault("connect_args", {"check_same_thread": False})
+    target_engine = create_engine(url, **kwargs)
+    apply_sqlite_profile(target_engine)
+    return target_engine
+
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+
+engine = create_sqlite_engine(
     DATABASE_URL,
     poolclass=QueuePool,
-    pool_size=10,
-    max_overflow=20,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
     pool_pre_ping=True
 )
-SessionLocal = sessionmaker(bind=engine)
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+
+jobs_engine = create_sqlite_engine(JOB_STORE_URL)
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
-    log.info("✅ Таблицы созданы/проверены")
     migrate_database()
 
 init_db()
 
-def get_db():
+# ============== UNIT OF WORK ==============
+
+_current_uow: contextvars.ContextVar = contextvars.ContextVar("unit_of_work", default=None)
+
+class UnitOfWork:
+    """Одна сессия на update Telegram или задачу планировщика.
+    
+    Соединение из пула и слот _uow_slots сессия держит только на время фаз
+    работы с БД (run_db). После фазы транзакция без несохраненных изменений
+    закрывается и соединение возвращается в пул, поэтому отправка сообщений
+    в Telegram между фазами не держит ни соединение, ни слот. Объекты сессии
+    и кэш BatchLoader при этом живут до конца unit of work.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.session = SessionLocal()
+        self.checkouts = 0
+        self.commits = 0
+        self.queries = 0
+        self.loaders: Dict[Any, "BatchLoader"] = {}
+        self.holding = False
+        self._releasing = False
+        self._phase_lock = asyncio.Lock()
+    
+    async def run(self, func, *args, **kwargs):
+        """Фаза работы с БД: func выполняется в пуле потоков БД, пока unit of work держит слот."""
+        async with self._phase_lock:
+            if not self.holding:
+                await _uow_slots.acquire()
+                self.holding = True
+            try:
+                return await run_blocking(self._phase, func, *args, **kwargs)
+            finally:
+                if not self.holding:
+                    _uow_slots.release()
+    
+    def release_slot(self):
+        if self.holding:
+            self.holding = False
+            _uow_slots.release()
+    
+    def _phase(self, func, *args, **kwargs):
+        result = func(*args, **kwargs)
+        self._end_phase()
+        return result
+    
+    def _end_phase(self):
+        """Возвращает соединение в пул, если транзакция не несет незакоммиченных изменений."""
+        session = self.session
+        if session.new or session.dirty or session.deleted or session.info.get("flushed"):
+            return
+        if session.in_transaction():
+            # Транзакция только читала: commit ничего не пишет, объекты не истекают (expire_on_commit=False)
+            self._releasing = True
+            try:
+                session.commit()
+            finally:
+                self._releasing = False
+        self.holding = False
+    
+    def finish(self, commit: bool = True):
+        try:
+            if commit and (self.session.new or self.session.dirty or self.session.deleted or self.session.info.get("flushed")):
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.close()
+
+@event.listens_for(SessionLocal, "after_flush")
+def _mark_flushed(session, flush_context):
+    session.info["flushed"] = True
+
+@event.listens_for(SessionLocal, "after_commit")
+@event.listens_for(SessionLocal, "after_rollback")
+def _clear_flushed(session):
+    session.info.pop("flushed", None)
+
+class UnitOfWorkStats:
+    def __init__(self):
+        self.units = 0
+        self.checkouts = 0
+        self.commits = 0
+        self.queries = 0
+        self.max_checkouts = 0
+        self.max_queries = 0
+    
+    def record(self, uow: UnitOfWork):
+        self.units += 1
+        self.checkouts += uow.checkouts
+        self.commits += uow.commits
+        self.queries += uow.queries
+        self.max_checkouts = max(self.max_checkouts, uow.checkouts)
+        self.max_queries = max(self.max_queries, uow.queries)
+    
+    @property
+    def avg_checkouts(self) -> float:
+        return self.checkouts / self.units if self.units else 0.0
+    
+    @property
+    def avg_queries(self) -> float:
+        return self.queries / self.units if self.units else 0.0
+
+uow_stats = UnitOfWorkStats()
+
+@event.listens_for(engine, "checkout")
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    uow = _current_uow.get()
+    if uow:
+        uow.checkouts += 1
+
+@event.listens_for(engine, "commit")
+def _count_commit(connection):
+    uow = _current_uow.get()
+    if uow and not uow._releasing:
+        uow.commits += 1
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    uow = _current_uow.get()
+    if uow:
+        uow.queries += 1
+
+@asynccontextmanager
+async def unit_of_work(name: str):
+    """Открывает unit of work, если он еще не открыт выше по стеку вызовов."""
+    if _current_uow.get() is not None:
+        yield _current_uow.get()
+        return
+    
+    uow = UnitOfWork(name)
+    token = _current_uow.set(uow)
+    succeeded = False
+    try:
+        yield uow
+        succeeded = True
+    finally:
+        try:
+            await uow.run(uow.finish, succeeded)
+        finally:
+            uow.release_slot()
+            _current_uow.reset(token)
+            uow_stats.record(uow)
+            log.debug(f"UOW {name}: checkouts={uow.checkouts}, commits={uow.commits}, queries={uow.queries}")
+
+def with_unit_of_work(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with unit_of_work(func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+
+class BatchLoader:
+    """Загрузка объектов модели по id в стиле DataLoader.
+    
+    id, нужные обработчику, сначала собираются (want/load_many), и все еще не
+    загруженные выбираются одним IN-запросом. Результат, включая отсутствующие
+    id, кэшируется до конца unit of work: повторный load того же id в БД не ходит.
+    """
+    
+    def __init__(self, model):
+        self.model = model
+        self._cache: Dict[int, Any] = {}
+        self._wanted: set = set()
+        self.fetches = 0
+    
+    def want(self, ids):
+        self._wanted.update(i for i in ids if i is not None and i not in self._cache)
+    
+    def load_many(self, db, ids) -> Dict[int, Any]:
+        ids = list(ids)
+        self.want(ids)
+        if self._wanted:
+            wanted, self._wanted = list(self._wanted), set()
+            for chunk in _chunks(wanted):
+                found = {obj.id: obj for obj in db.query(self.model).filter(self.model.id.in_(chunk))}
+                for item_id in chunk:
+                    self._cache[item_id] = found.get(item_id)
+                self.fetches += 1
+        return {item_id: self._cache.get(item_id) for item_id in ids}
+    
+    def load(self, db, item_id: int):
+        return self.load_many(db, [item_id])[item_id]
+
+def loader(model) -> BatchLoader:
+    """BatchLoader модели в текущем unit of work; вне его - одноразовый, без общего кэша."""
+    uow = _current_uow.get()
+    if uow is None:
+        return BatchLoader(model)
+    if model not in uow.loaders:
+        uow.loaders[model] = BatchLoader(model)
+    return uow.loaders[model]
+
+@contextmanager
+def db_session(db=None):
+    """Отдает переданную сессию, сессию текущего unit of work или новую."""
+    if db is not None:
+        yield db
+        return
+    
+    uow = _current_uow.get()
+    if uow is not None:
+        yield uow.session
+        return
+    
     db = SessionLocal()
     try:
-        return db
+        yield db
     finally:
         db.close()
 
+# ============== АСИНХРОННЫЙ ДОСТУП К БД ==============
+
+DB_WORKERS = int(os.environ.get("DB_WORKERS", "4"))
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+# Unit of work, держащих соединение между фазами (незакоммиченные изменения), не больше
+# размера пула за вычетом соединений для потоков БД вне unit of work. Иначе потоки
+# блокируются в ожидании соединения, а владельцы соединений — потока. Слот берется
+# только на фазу работы с БД, ожидание отправки в Telegram его не занимает.
+_uow_slots = asyncio.Semaphore(max(1, DB_POOL_SIZE + DB_MAX_OVERFLOW - DB_WORKERS))
+
+async def run_blocking(func, *args, **kwargs):
+    """Выполняет блокирующую функцию в пуле потоков БД, не останавливая event loop."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет func(db, *args) в пуле потоков БД.
+    
+    Внутри unit of work используется его сессия, иначе — отдельная сессия,
+    которая закрывается после вызова.
+    """
+    def _call():
+        with db_session() as db:
+            return func(db, *args, **kwargs)
+    
+    uow = _current_uow.get()
+    if uow is not None:
+        return await uow.run(_call)
+    return await run_blocking(_call)
+
 # ============== RATE LIMITER ==============
 
+# Лимиты Telegram Bot API: всего сообщений в секунду, в один чат в секунду, в группу в минуту
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.environ.get("TELEGRAM_GROUP_RATE", "20"))
+# Сколько сообщений подряд можно отправить в чат без паузы (1 - строго по лимиту)
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", "1"))
+
+class RateLimit:
+    """Token bucket в форме GCRA: count сообщений за period секунд, до burst подряд.
+    
+    Вместо счетчика токенов хранится теоретическое время следующей отправки (tat),
+    поэтому пополнять ведро по таймеру не нужно.
+    """
+    __slots__ = ('interval', 'tolerance', 'tat')
+    
+    def __init__(self, count: float, period: float = 1.0, burst: int = 1):
+        self.interval = period / count
+        self.tolerance = self.interval * (max(1, burst) - 1)
+        self.tat = 0.0
+    
+    def earliest(self, now: float) -> float:
+        return max(now, self.tat - self.tolerance)
+    
+    def consume(self, at: float):
+        self.tat = max(self.tat, at) + self.interval
+    
+    def hold(self, until: float):
+        self.tat = max(self.tat, until + self.tolerance)
+
+class ChatLimits:
+    __slots__ = ('lock', 'chat', 'group')
+    
+    def __init__(self, chat_id: Union[int, str]):
+        self.lock = asyncio.Lock()
+        self.chat = RateLimit(TELEGRAM_CHAT_RATE, 1.0, TELEGRAM_CHAT_BURST)
+        # У групп и каналов отрицательные chat_id, каналы можно указать и строкой @username
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        self.group = RateLimit(TELEGRAM_GROUP_RATE, 60.0, TELEGRAM_CHAT_BURST) if is_group else None
+    
+    def limits(self):
+        return (self.chat, self.group) if self.group else (self.chat,)
+
 class RateLimiter:
-    def __init__(self, global_rate: int = 30, per_user_rate: int = 1):
-        self.global_semaphore = asyncio.Semaphore(global_rate)
-        self.per_user_rate = per_user_rate
-        self.user_last_message = defaultdict(float)
-    
-    async def acquire(self, user_id: Optional[int] = None):
-        await self.global_semaphore.acquire()
-        if user_id:
-            now = time.time()
-            last = self.user_last_message[user_id]
-            if now - last < self.per_user_rate:
-                await asyncio.sleep(self.per_user_rate - (now - last))
-            self.user_last_message[user_id] = now
+    """Общий лимитер исходящих сообщений: глобальный лимит и лимиты каждого чата.
+    
+    Ожидание своего чата идет под замком этого чата и не задерживает другие чаты;
+    в общую FIFO-очередь глобального лимита сообщение встает, только когда его чат
+    уже готов к отправке.
+    """
+    
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, max_chats: int = 10000):
+        self.global_limit = RateLimit(global_rate)
+        self._global_lock = asyncio.Lock()
+        self.max_chats = max_chats
+        self.chats: Dict[Union[int, str], ChatLimits] = {}
+        self.acquired = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self.retry_afters = 0
+    
+    def _chat(self, chat_id: Union[int, str]) -> ChatLimits:
+        limits = self.chats.get(chat_id)
+        if limits is None:
+            if len(self.chats) >= self.max_chats:
+                self._prune()
+            limits = self.chats[chat_id] = ChatLimits(chat_id)
+        return limits
+    
+    def _prune(self):
+        now = time.monotonic()
+        for chat_id, limits in list(self.chats.items()):
+            if not limits.lock.locked() and all(limit.tat <= now for limit in limits.limits()):
+                del self.chats[chat_id]
+    
+    async def _reserve_global(self) -> float:
+        # Слот отсчитывается от фактического времени пробуждения, а не от запланированного,
+        # чтобы опоздавший sleep не сжал интервал до следующей отправки
+        async with self._global_lock:
+            while (now := time.monotonic()) < (at := self.global_limit.earliest(now)):
+                await asyncio.sleep(at - now)
+            self.global_limit.consume(now)
+            return now
+    
+    async def acquire(self, chat_id: Union[int, str, None] = None):
+        started = time.monotonic()
+        if chat_id:
+            limits = self._chat(chat_id)
+            async with limits.lock:
+                while (now := time.monotonic()) < (ready := max(limit.earliest(now) for limit in limits.limits())):
+                    await asyncio.sleep(ready - now)
+                sent_at = await self._reserve_global()
+                for limit in limits.limits():
+                    limit.consume(sent_at)
+        else:
+            await self._reserve_global()
+        
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.waited += waited
+        self.max_wait = max(self.max_wait, waited)
+    
+    def chat_delay(self, chat_id: Union[int, str, None]) -> float:
+        """Сколько секунд чату еще ждать по своим лимитам (без учета глобального)."""
+        limits = self.chats.get(chat_id) if chat_id else None
+        if limits is None:
+            return 0.0
+        now = time.monotonic()
+        return max(limit.earliest(now) for limit in limits.limits()) - now
+    
+    def retry_after(self, chat_id: Union[int, str, None], seconds: float):
+        """Telegram ответил RetryAfter: приостанавливаем отправку.
+        
+        Лимиты чатов мы соблюдаем сами, поэтому считаем, что превышен глобальный
+        лимит, и держим паузу для всех чатов.
+        """
+        until = time.monotonic() + float(seconds)
+        self.retry_afters += 1
+        self.global_limit.hold(until)
+        if chat_id:
+            for limit in self._chat(chat_id).limits():
+                limit.hold(until)
+        log.warning(f"⏳ RetryAfter {seconds}s (чат {chat_id}), отправка приостановлена")
 
 rate_limiter = RateLimiter()
 
+# ============== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ==============
+
+class SendPriority(IntEnum):
+    """Приоритет исходящего сообщения; передается в методы бота через rate_limit_args.
+    
+    Значения начинаются с 1: ExtBot отбрасывает "ложные" rate_limit_args, и 0 превратился бы в None.
+    """
+    REMINDER = 1
+    INTERACTIVE = 2
+    ADMIN = 3
+    BROADCAST = 4
+
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", "16"))
+
+@dataclass
+class OutboundMessage:
+    chat_id: Union[int, str, None]
+    priority: SendPriority
+    func: Any
+    args: tuple
+    kwargs: dict
+    future: asyncio.Future
+    enqueued: float
+    seq: int = 0
+    ready: bool = False
+
+class OutboundStats:
+    def __init__(self):
+        self.depth = defaultdict(int)
+        self.sent = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.wait_total = defaultdict(float)
+        self.wait_max = defaultdict(float)
+        self.latency_total = defaultdict(float)
+        self.latency_max = defaultdict(float)
+    
+    def record(self, priority: SendPriority, waited: float, latency: float, ok: bool):
+        (self.sent if ok else self.failed)[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+        self.latency_total[priority] += latency
+        self.latency_max[priority] = max(self.latency_max[priority], latency)
+    
+    def summary(self) -> str:
+        lines = []
+        for priority in SendPriority:
+            done = self.sent[priority] + self.failed[priority]
+            if not done and not self.depth[priority]:
+                continue
+            lines.append(
+                f"{priority.name.lower()}: в очереди {self.depth[priority]}, отправлено {self.sent[priority]}, "
+                f"ошибок {self.failed[priority]}, ожидание {self.wait_total[priority] / max(done, 1) * 1000:.0f}мс "
+                f"(макс. {self.wait_max[priority]:.1f}s), отправка {self.latency_total[priority] / max(done, 1) * 1000:.0f}мс "
+                f"(макс. {self.latency_max[priority]:.1f}s)"
+            )
+        return "\n".join(lines)
+
+class OutboundQueue:
+    """Центральная очередь запросов к Bot API с приоритетами и пулом воркеров.
+    
+    Из очереди первым берется сообщение с наивысшим приоритетом, внутри приоритета - FIFO.
+    У каждого чата в работе не больше одного сообщения: остальные ждут в parked (куча по
+    тому же ключу, что и очередь), поэтому сообщения одного приоритета приходят в чат по
+    порядку. Возвращаясь в очередь, сообщение сохраняет свой (priority, seq). Чат, которому по лимиту
+    еще рано, откладывается по таймеру и не занимает воркер. Срочное сообщение может
+    пропустить вперед не больше workers уже взятых в работу.
+    """
+    
+    def __init__(self, limiter: RateLimiter, workers: int = OUTBOUND_WORKERS):
+        self.limiter = limiter
+        self.workers = workers
+        self.stats = OutboundStats()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._seq = itertools.count()
+        self._busy: set = set()
+        self._parked: Dict[Any, list] = defaultdict(list)
+        self._tasks: List[asyncio.Task] = []
+    
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        log.info(f"📤 Очередь исходящих сообщений запущена ({self.workers} воркеров)")
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def submit(self, priority: SendPriority, chat_id, func, *args, **kwargs):
+        """Ставит вызов func(*args, **kwargs) в очередь и ждет его результата."""
+        if not self._tasks:
+            # Очередь еще не запущена (старт/остановка бота) - отправляем напрямую
+            await self.limiter.acquire(chat_id)
+            return await func(*args, **kwargs)
+        
+        message = OutboundMessage(
+            chat_id=chat_id, priority=SendPriority(priority), func=func, args=args, kwargs=kwargs,
+            future=asyncio.get_running_loop().create_future(), enqueued=time.monotonic(),
+            seq=next(self._seq)
+        )
+        self.stats.depth[message.priority] += 1
+        self._put(message)
+        return await message.future
+    
+    def _put(self, message: OutboundMessage):
+        self._queue.put_nowait((message.priority, message.seq, message))
+    
+    def _release(self, chat_id):
+        self._busy.discard(chat_id)
+        parked = self._parked.get(chat_id)
+        if parked:
+            self._put(heapq.heappop(parked)[2])
+            if not parked:
+                del self._parked[chat_id]
+    
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, message = await self._queue.get()
+            chat_id = message.chat_id
+            
+            if not message.ready:
+                if chat_id is not None and chat_id in self._busy:
+                    heapq.heappush(self._parked[chat_id], (message.priority, message.seq, message))
+                    continue
+                self._busy.add(chat_id)
+                delay = self.limiter.chat_delay(chat_id)
+                if delay > 0:
+                    message.ready = True
+                    loop.call_later(delay, self._put, message)
+                    continue
+            
+            self.stats.depth[message.priority] -= 1
+            if message.future.done():  # отправитель уже не ждет (отмена)
+                self._release(chat_id)
+                continue
+            
+            ok = False
+            try:
+                await self.limiter.acquire(chat_id)
+                started = time.monotonic()
+                try:
+                    message.future.set_result(await message.func(*message.args, **message.kwargs))
+                    ok = True
+                except RetryAfter as e:
+                    self.limiter.retry_after(chat_id, e.retry_after)
+                    message.future.set_exception(e)
+                except Exception as e:
+                    message.future.set_exception(e)
+                self.stats.record(message.priority, started - message.enqueued, time.monotonic() - started, ok)
+            except asyncio.CancelledError:
+                if not message.future.done():
+                    message.future.cancel()
+                raise
+            finally:
+                self._release(chat_id)
+
+outbound_queue = OutboundQueue(rate_limiter)
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Пропускает запросы application.bot через outbound_queue: ответы обработчиков, напоминания.
+    
+    Приоритет берется из rate_limit_args (SendPriority), по умолчанию - INTERACTIVE.
+    Запросы без chat_id (getUpdates, answerCallbackQuery) идут напрямую.
+    """
+    
+    def __init__(self, queue: OutboundQueue):
+        self.queue = queue
+    
+    async def initialize(self):
+        self.queue.start()
+    
+    async def shutdown(self):
+        await self.queue.stop()
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        
+        priority = SendPriority.INTERACTIVE if rate_limit_args is None else rate_limit_args
+        async with update_lanes.waiting():
+            return await self.queue.submit(priority, chat_id, callback, *args, **kwargs)
+
 # ============== ПЛАНИРОВЩИК ==============
 
 class PersistentScheduler:
     def __init__(self):
-        jobstores = {'default': SQLAlchemyJobStore(url=JOB_STORE_URL)}
+        self.jobstore = SQLAlchemyJobStore(engine=jobs_engine)
+        jobstores = {'default': self.jobstore}
         executors = {'default': AsyncIOExecutor()}
         job_defaults = {
             'coalesce': True,
@@ -927,67 +1844,207 @@ class PersistentScheduler:
         log.info("SCHEDULER - Планировщик остановлен")
     
     async def restore_reminders(self):
-        db = get_db()
-        try:
+        """Сверяет задачи напоминаний в jobstore с pending-напоминаниями в БД.
+        
+        Добавляются только недостающие задачи и удаляются лишние, поэтому
+        перезапуск с уже заполненным jobstore почти ничего не пишет. Просроченные
+        не больше чем на REMINDER_MISFIRE_GRACE тоже получают задачу: APScheduler
+        отправит их сразу, как колесо при старте.
+        """
+        if REMINDER_DISPATCHER == 'wheel':
+            return await self.drop_reminder_jobs()
+        
+        def _restore(db):
             now = datetime.now(pytz.UTC)
-            pending = db.query(Reminder).filter(
-                Reminder.status == 'pending',
-                Reminder.scheduled_time > now
-            ).all()
-            
-            for reminder in pending:
-                job_id = f"{reminder.reminder_type}_{reminder.id}"
-                try:
-                    self.scheduler.remove_job(job_id)
-                except JobLookupError:
-                    pass
-                
+            existing = {job_id for job_id in self.existing_job_ids() if LEGACY_REMINDER_JOB.match(job_id)}
+            pending = set()
+            added = 0
+            rows = db.execute(
+                select(Reminder.id, Reminder.reminder_type, Reminder.scheduled_time)
+                .where(Reminder.status == 'pending')
+                .execution_options(yield_per=REMINDER_WHEEL_CHUNK)
+            )
+            for reminder_id, reminder_type, scheduled_time in rows:
+                job_id = f"{reminder_type}_{reminder_id}"
+                pending.add(job_id)
+                scheduled_time = _as_utc(scheduled_time)
+                if job_id in existing or scheduled_time <= now - REMINDER_MISFIRE_GRACE:
+                    continue
                 self.scheduler.add_job(
                     send_reminder_job,
-                    trigger=DateTrigger(run_date=reminder.scheduled_time),
+                    trigger=DateTrigger(run_date=scheduled_time),
                     id=job_id,
-                    args=[reminder.id],
+                    args=[reminder_id],
                     replace_existing=True
                 )
+                added += 1
             
-            log.info(f"RESTORE - Восстановлено {len(pending)} напоминаний")
-            return len(pending)
-        finally:
-            db.close()
+            removed = self.delete_jobs(existing - pending)
+            return added, removed
+        
+        added, removed = await run_db(_restore)
+        log.info(f"RESTORE - Напоминаний: добавлено {added} задач, удалено {removed}")
+        return added
+    
+    def existing_job_ids(self) -> set:
+        """ID задач в jobstore без распаковки самих задач."""
+        # До scheduler.start() таблицы jobstore может еще не быть
+        self.jobstore.jobs_t.create(jobs_engine, checkfirst=True)
+        with jobs_engine.connect() as conn:
+            return set(conn.execute(select(self.jobstore.jobs_t.c.id)).scalars())
+    
+    def delete_jobs(self, job_ids) -> int:
+        """Удаляет задачи одним DELETE на пачку вместо remove_job на каждую."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return 0
+        self.jobstore.jobs_t.create(jobs_engine, checkfirst=True)
+        with jobs_engine.begin() as conn:
+            for chunk in _chunks(job_ids):
+                conn.execute(self.jobstore.jobs_t.delete().where(self.jobstore.jobs_t.c.id.in_(chunk)))
+        return len(job_ids)
+    
+    async def drop_reminder_jobs(self) -> int:
+        """При переходе на колесо убирает из jobstore задачи отдельных напоминаний, чтобы они не сработали дважды."""
+        def _drop():
+            return self.delete_jobs(job_id for job_id in self.existing_job_ids() if LEGACY_REMINDER_JOB.match(job_id))
+        
+        dropped = await run_blocking(_drop)
+        if dropped:
+            log.info(f"RESTORE - Удалено {dropped} задач напоминаний, их отправляет колесо")
+        return dropped
+    
+    async def restore_medicine_schedules(self):
+        """Добавляет недостающие задачи приемов для активных лекарств (например, после обновления).
+        
+        Если у лекарства появляются задачи приема, его будущие pending-напоминания
+        остались от старой схемы (одно напоминание и одна задача на каждый прием):
+        новые medicine_dose_job создают напоминание в момент приема. Такие
+        напоминания отменяются, а их задачи удаляются, иначе прием придет дважды.
+        """
+        def _restore(db):
+            existing = self.existing_job_ids()
+            # Старые задачи предупреждений вызывали medicine_dose_job и создавали второй прием
+            self.delete_jobs(job_id for job_id in existing if LEGACY_PRE_JOB.match(job_id))
+            added = 0
+            converted = set()
+            medicines = db.query(Medicine).outerjoin(User, User.user_id == Medicine.user_id).filter(
+                Medicine.status == 'active', User.is_active.isnot(False)
+            )
+            for medicine in medicines:
+                for job_id, trigger, func, args in medicine_dose_jobs(medicine):
+                    if job_id in existing or trigger is None:
+                        continue
+                    self.scheduler.add_job(
+                        func, trigger=trigger, id=job_id, args=args, replace_existing=True
+                    )
+                    added += 1
+                    if func is medicine_dose_job:
+                        converted.add(medicine.id)
+            
+            legacy = []
+            now = datetime.now(pytz.UTC)
+            for chunk in _chunks(list(converted)):
+                legacy.extend(db.execute(
+                    select(Reminder.id).where(
+                        Reminder.reminder_type == 'medicine',
+                        Reminder.item_id.in_(chunk),
+                        Reminder.status == 'pending',
+                        Reminder.scheduled_time > now
+                    )
+                ).scalars())
+            set_reminders_status(db, legacy, 'cancelled')
+            db.commit()
+            self.delete_jobs(f"medicine_{reminder_id}" for reminder_id in legacy)
+            return added, len(legacy)
+        
+        added, cancelled = await run_db(_restore)
+        log.info(f"RESTORE - Добавлено {added} задач приема лекарств, отменено {cancelled} старых напоминаний")
+        return added
 
 scheduler = PersistentScheduler()
 
 # ============== ФУНКЦИИ ДЛЯ РАБОТЫ С ЧАСОВЫМИ ПОЯСАМИ ==============
 
-def get_user_timezone(user_id: int) -> str:
-    db = get_db()
-    try:
+DEFAULT_TIMEZONE = 'Europe/Moscow'
+TZ_CACHE_SIZE = int(os.environ.get("TZ_CACHE_SIZE", "10000"))
+
+class TimezoneCache:
+    """LRU-кэш часовых поясов пользователей. Обновляется через set_user_timezone."""
+    
+    def __init__(self, max_size: int = TZ_CACHE_SIZE):
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            timezone = self._data.get(user_id)
+            if timezone is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return timezone
+    
+    def set(self, user_id: int, timezone: str):
+        with self._lock:
+            self._data[user_id] = timezone
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._data)
+
+timezone_cache = TimezoneCache()
+
+@functools.lru_cache(maxsize=None)
+def get_tz(name: str):
+    """Кэширующая обертка над pytz.timezone."""
+    return pytz.timezone(name)
+
+def get_user_timezone(user_id: int, db=None) -> str:
+    timezone = timezone_cache.get(user_id)
+    if timezone is not None:
+        return timezone
+    
+    with db_session(db) as db:
         user_tz = db.query(UserTimezone).filter_by(user_id=user_id).first()
-        return user_tz.timezone if user_tz else 'Europe/Moscow'
-    finally:
-        db.close()
+        timezone = user_tz.timezone if user_tz else DEFAULT_TIMEZONE
+    timezone_cache.set(user_id, timezone)
+    return timezone
 
-def set_user_timezone(user_id: int, timezone: str):
-    db = get_db()
-    try:
+def set_user_timezone(user_id: int, timezone: str, db=None):
+    """Меняет часовой пояс пользователя.
+    
+    Сводки daily_user_stats разложены по локальным дням, поэтому при смене пояса
+    они пересчитываются из журналов, иначе старые дни остаются в прежних границах.
+    """
+    with db_session(db) as db:
         user_tz = db.query(UserTimezone).filter_by(user_id=user_id).first()
+        previous = user_tz.timezone if user_tz else DEFAULT_TIMEZONE
         if user_tz:
             user_tz.timezone = timezone
         else:
             user_tz = UserTimezone(user_id=user_id, timezone=timezone)
             db.add(user_tz)
+        if previous != timezone:
+            db.flush()
+            rebuild_daily_stats(db, [user_id])
         db.commit()
-    finally:
-        db.close()
+    timezone_cache.set(user_id, timezone)
 
 def local_to_utc(local_time_str: str, tz: str, base: datetime = None) -> datetime:
     if base is None:
-        base = datetime.now(pytz.timezone(tz))
+        base = datetime.now(get_tz(tz))
     
     h, m = map(int, local_time_str.split(':'))
     local = base.replace(hour=h, minute=m, second=0, microsecond=0)
     if not local.tzinfo:
-        local = pytz.timezone(tz).localize(local)
+        local = get_tz(tz).localize(local)
     
     return local.astimezone(pytz.UTC)
 
@@ -1001,7 +2058,7 @@ def local_to_utc_safe(local_time_str: str, tz: str, base: datetime = None) -> da
 def utc_to_local(utc: datetime, tz: str) -> datetime:
     if utc.tzinfo is None:
         utc = pytz.UTC.localize(utc)
-    return utc.astimezone(pytz.timezone(tz))
+    return utc.astimezone(get_tz(tz))
 
 def parse_date(date_str: str, tz: str) -> Optional[datetime]:
     try:
@@ -1009,16 +2066,15 @@ def parse_date(date_str: str, tz: str) -> Optional[datetime]:
         for fmt in fmts:
             try:
                 dt = datetime.strptime(date_str, fmt).replace(hour=12)
-                return pytz.timezone(tz).localize(dt)
+                return get_tz(tz).localize(dt)
             except:
                 continue
     except:
         pass
     return None
 
-def check_existing_analysis(user_id: int, date: datetime, time: str) -> bool:
-    db = get_db()
-    try:
+def check_existing_analysis(user_id: int, date: datetime, time: str, db=None) -> bool:
+    with db_session(db) as db:
         if date.tzinfo is None:
             date = pytz.UTC.localize(date)
         exists = db.query(Analysis).filter(
@@ -1028,8 +2084,246 @@ def check_existing_analysis(user_id: int, date: datetime, time: str) -> bool:
             Analysis.scheduled_time == time
         ).first()
         return exists is not None
-    finally:
-        db.close()
+
+# ============== РАСПИСАНИЕ ПРИЕМОВ ЛЕКАРСТВ ==============
+
+def _as_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    if dt is not None and dt.tzinfo is None:
+        return pytz.UTC.localize(dt)
+    return dt
+
+def medicine_course_end(medicine) -> Optional[datetime]:
+    end = _as_utc(medicine.end_date)
+    if end is None and medicine.course_days and medicine.start_date:
+        end = _as_utc(medicine.start_date) + timedelta(days=medicine.course_days)
+    return end
+
+def medicine_dose_jobs(medicine) -> List[Tuple[str, Optional[CronTrigger], Callable, list]]:
+    """Одна повторяющаяся задача на каждое время приема и, если задано, на предупреждение перед ним.
+    
+    Прием создает Reminder (medicine_dose_job), предупреждение только присылает
+    уведомление (medicine_pre_job). Возвращает (job_id, trigger, func, args);
+    trigger равен None, если курс уже закончился.
+    """
+    tz = get_tz(medicine.user_timezone or DEFAULT_TIMEZONE)
+    start = _as_utc(medicine.start_date)
+    end = medicine_course_end(medicine)
+    finished = end is not None and end <= datetime.now(pytz.UTC)
+    
+    jobs = []
+    for dose_time in medicine.schedule.split(','):
+        h, m = map(int, dose_time.split(':'))
+        offsets = [('dose', 0, medicine_dose_job)]
+        if medicine.reminder_minutes:
+            offsets.append(('before', medicine.reminder_minutes, medicine_pre_job))
+        for kind, minutes_before, func in offsets:
+            fire = (h * 60 + m - minutes_before) % (24 * 60)
+            trigger = None if finished else CronTrigger(
+                hour=fire // 60, minute=fire % 60, timezone=tz, start_date=start, end_date=end
+            )
+            jobs.append((f"medicine_{medicine.id}_{kind}_{h:02d}{m:02d}", trigger, func, [medicine.id, dose_time]))
+    return jobs
+
+def schedule_medicine(medicine):
+    for job_id, trigger, func, args in medicine_dose_jobs(medicine):
+        if trigger is None:
+            continue
+        scheduler.scheduler.add_job(
+            func, trigger=trigger, id=job_id, args=args, replace_existing=True
+        )
+
+def unschedule_medicine(medicine):
+    for job_id, _, _, _ in medicine_dose_jobs(medicine):
+        try:
+            scheduler.scheduler.remove_job(job_id)
+        except JobLookupError:
+            pass
+
+# ============== ДИСПЕТЧЕР НАПОМИНАНИЙ ==============
+
+# apscheduler - отдельная задача в jobstore на каждое напоминание (как было)
+# wheel       - таблица reminders как единственный источник, в памяти только ближайшие часы
+REMINDER_DISPATCHER = os.environ.get("REMINDER_DISPATCHER", "apscheduler").lower()
+REMINDER_WHEEL_HORIZON_HOURS = float(os.environ.get("REMINDER_WHEEL_HORIZON_HOURS", "6"))
+REMINDER_WHEEL_RESOLUTION = int(os.environ.get("REMINDER_WHEEL_RESOLUTION", "1"))
+REMINDER_WHEEL_REFILL_SECONDS = int(os.environ.get("REMINDER_WHEEL_REFILL_SECONDS", "300"))
+REMINDER_WHEEL_CHUNK = 5000
+REMINDER_MISFIRE_GRACE = timedelta(hours=1)
+
+LEGACY_REMINDER_JOB = re.compile(r'^(medicine|analysis)_\d+$')
+LEGACY_PRE_JOB = re.compile(r'^medicine_\d+_pre_\d{4}$')
+
+class ReminderWheel:
+    """Таймер-колесо напоминаний.
+    
+    В памяти лежат только pending-напоминания ближайших horizon часов, разложенные
+    по корзинам шириной resolution секунд. Окно дочитывается из reminders по индексу
+    ix_reminders_status_time от водяной отметки loaded_until, поэтому число pending
+    в таблице не влияет ни на время запуска, ни на память. Отмена ленивая:
+    send_reminder_job пропускает напоминания не в статусе pending.
+    """
+    
+    def __init__(self, horizon_hours: float = REMINDER_WHEEL_HORIZON_HOURS,
+                 resolution: int = REMINDER_WHEEL_RESOLUTION,
+                 refill_seconds: int = REMINDER_WHEEL_REFILL_SECONDS):
+        self.horizon = timedelta(hours=horizon_hours)
+        self.resolution = max(1, resolution)
+        self.refill_seconds = refill_seconds
+        self.loaded_until: Optional[datetime] = None
+        self.dispatched = 0
+        self._buckets: Dict[int, set] = {}
+        self._heap: List[int] = []
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+    
+    def _bucket(self, when: datetime) -> int:
+        return int(_as_utc(when).timestamp()) // self.resolution
+    
+    def _put(self, reminder_id: int, key: int):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = set()
+            heapq.heappush(self._heap, key)
+        bucket.add(reminder_id)
+    
+    def add(self, reminder_id: int, when: datetime):
+        """Потокобезопасно: вызывается из обработчиков внутри run_db.
+        
+        Граница - now + horizon, а не loaded_until: add вызывается до коммита, и
+        идущая сейчас дозагрузка окна может этой записи уже не увидеть, а следующая
+        начнет после нового loaded_until. Повторная загрузка того же id безвредна:
+        корзина - множество.
+        """
+        if self.loaded_until is None or _as_utc(when) > datetime.now(pytz.UTC) + self.horizon:
+            return  # попадет в колесо при следующей дозагрузке окна
+        key = self._bucket(when)
+        with self._lock:
+            self._put(reminder_id, key)
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+    
+    def discard(self, reminder_id: int, when: datetime):
+        key = self._bucket(when)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket:
+                bucket.discard(reminder_id)
+    
+    def __len__(self):
+        with self._lock:
+            return sum(len(b) for b in self._buckets.values())
+    
+    def _load_window(self, db, after: datetime, until: datetime) -> int:
+        rows = db.execute(
+            select(Reminder.id, Reminder.scheduled_time).where(
+                Reminder.status == 'pending',
+                Reminder.scheduled_time > after,
+                Reminder.scheduled_time <= until
+            ).execution_options(yield_per=REMINDER_WHEEL_CHUNK)
+        )
+        
+        loaded = 0
+        for chunk in rows.partitions():
+            with self._lock:
+                for reminder_id, scheduled_time in chunk:
+                    self._put(reminder_id, self._bucket(scheduled_time))
+            loaded += len(chunk)
+        return loaded
+    
+    async def refill(self) -> int:
+        until = datetime.now(pytz.UTC) + self.horizon
+        loaded = await run_db(self._load_window, self.loaded_until, until)
+        self.loaded_until = until
+        if self._wakeup:
+            self._wakeup.set()
+        return loaded
+    
+    def _pop_due(self, now_key: int) -> List[int]:
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0] <= now_key:
+                due.extend(self._buckets.pop(heapq.heappop(self._heap), ()))
+        return due
+    
+    async def dispatch(self, reminder_ids: List[int]):
+        self.dispatched += len(reminder_ids)
+        if REMINDER_SEND_MODE == 'batch':
+            reminder_batcher.submit(reminder_ids)
+            return
+        for reminder_id in reminder_ids:
+            task = asyncio.create_task(send_reminder(reminder_id))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+    
+    async def _run(self):
+        next_refill = self._loop.time() + self.refill_seconds
+        while True:
+            try:
+                due = self._pop_due(self._bucket(datetime.now(pytz.UTC)))
+                if due:
+                    await self.dispatch(due)
+                if self._loop.time() >= next_refill:
+                    loaded = await self.refill()
+                    next_refill = self._loop.time() + self.refill_seconds
+                    log.debug(f"WHEEL - Дозагружено {loaded} напоминаний")
+            except Exception as e:
+                log.error(f"❌ WHEEL - Ошибка диспетчера: {e}")
+            
+            with self._lock:
+                next_key = self._heap[0] if self._heap else None
+            delay = next_refill - self._loop.time()
+            if next_key is not None:
+                delay = min(delay, next_key * self.resolution - time.time())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, min(delay, 1.0)))
+            except asyncio.TimeoutError:
+                pass
+    
+    async def start(self) -> int:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.loaded_until = datetime.now(pytz.UTC) - REMINDER_MISFIRE_GRACE
+        loaded = await self.refill()
+        self._task = asyncio.create_task(self._run())
+        log.info(f"WHEEL - Диспетчер запущен, в окне {loaded} напоминаний")
+        return loaded
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+reminder_wheel = ReminderWheel()
+
+def schedule_reminder(reminder):
+    """Ставит напоминание в выбранный диспетчер. Запись reminder должна быть уже в сессии (flush)."""
+    if REMINDER_DISPATCHER == 'wheel':
+        reminder_wheel.add(reminder.id, reminder.scheduled_time)
+        return
+    scheduler.scheduler.add_job(
+        send_reminder_job,
+        trigger=DateTrigger(run_date=reminder.scheduled_time),
+        id=f"{reminder.reminder_type}_{reminder.id}",
+        args=[reminder.id],
+        replace_existing=True
+    )
+
+def unschedule_reminder(reminder):
+    if REMINDER_DISPATCHER == 'wheel':
+        reminder_wheel.discard(reminder.id, reminder.scheduled_time)
+        return
+    try:
+        scheduler.scheduler.remove_job(f"{reminder.reminder_type}_{reminder.id}")
+    except JobLookupError:
+        pass
 
 # ============== КЛАВИАТУРЫ ==============
 
@@ -1336,13 +2630,159 @@ def get_admin_backups_keyboard():
     ADMIN_BROADCAST_CONFIRM
 ) = range(19)
 
-# ============== ОБРАБОТЧИКИ КОМАНД ==============
+# ============== МАРШРУТИЗАЦИЯ КНОПОК ==============
 
-async def register_user(update: Update) -> bool:
-    user = update.effective_user
-    db = get_db()
-    try:
-        existing = db.query(User).filter_by(user_id=user.id).first()
+class CallbackRouter:
+    """Таблица маршрутов callback_data вместо цепочки if/elif в button_callback.
+    
+    Точные ключи ищутся в dict. Префиксы - по таблице длин: для каждой длины
+    (от длинной к короткой) один поиск в dict, поэтому побеждает самый длинный
+    совпавший префикс и порядок регистрации не важен (analysis_take_ не уйдет в
+    take_). Типизированный хвост после префикса разбирается один раз и
+    передается обработчику в context.args, как аргументы команд.
+    """
+    
+    def __init__(self):
+        self._exact: Dict[str, Callable] = {}
+        self._prefixes: Dict[str, Tuple[Callable, Optional[Callable[[str], Any]]]] = {}
+        self._lengths: List[int] = []
+    
+    def exact(self, *keys: str):
+        def decorator(handler):
+            for key in keys:
+                if key in self._exact:
+                    raise ValueError(f"Маршрут {key!r} уже зарегистрирован")
+                self._exact[key] = handler
+            return handler
+        return decorator
+    
+    def prefix(self, prefix: str, arg: Optional[Callable[[str], Any]] = None):
+        def decorator(handler):
+            if prefix in self._prefixes:
+                raise ValueError(f"Префикс {prefix!r} уже зарегистрирован")
+            self._prefixes[prefix] = (handler, arg)
+            self._lengths = sorted({len(p) for p in self._prefixes}, reverse=True)
+            return handler
+        return decorator
+    
+    def resolve(self, data: str) -> Optional[Tuple[Callable, Optional[list]]]:
+        """(обработчик, аргументы) для callback_data или None, если маршрута нет."""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, None
+        for length in self._lengths:
+            route = self._prefixes.get(data[:length])
+            if route is None:
+                continue
+            handler, arg = route
+            if arg is None:
+                return handler, None
+            try:
+                return handler, [arg(data[length:])]
+            except ValueError:
+                return None
+        return None
+    
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        route = self.resolve(update.callback_query.data or "")
+        if route is None:
+            return False
+        handler, args = route
+        if args is not None:
+            context.args = args
+        await handler(update, context)
+        return True
+
+callback_router = CallbackRouter()
+
+# ============== АКТИВНОСТЬ ПОЛЬЗОВАТЕЛЕЙ ==============
+
+ACTIVITY_FLUSH_INTERVAL = int(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "30"))
+
+class ActivityTracker:
+    """Копит last_activity/total_interactions/username в памяти и пишет их пачкой.
+    
+    Пользователь, которого уже видели активным, повторно в БД не проверяется:
+    его обращения сливаются в одну строку на пользователя и уходят одним
+    executemany UPDATE раз в ACTIVITY_FLUSH_INTERVAL секунд и при остановке.
+    deactivate_users вычеркивает пользователя из известных, чтобы следующее
+    обращение снова прошло через БД и вернуло ему напоминания.
+    """
+    
+    def __init__(self):
+        self.known: set = set()
+        self._pending: Dict[int, dict] = {}
+        self._flush_lock = asyncio.Lock()
+        self.touches = 0
+        self.flushes = 0
+        self.rows_written = 0
+    
+    def remember(self, user_id: int):
+        self.known.add(user_id)
+    
+    def forget(self, user_ids):
+        self.known.difference_update(user_ids)
+    
+    def touch(self, user) -> bool:
+        """Учитывает обращение известного пользователя; False - пользователя надо проверить в БД."""
+        if user.id not in self.known:
+            return False
+        entry = self._pending.get(user.id)
+        if entry is None:
+            entry = self._pending[user.id] = {"uid": user.id, "interactions": 0, "username": None}
+        entry["last_activity"] = datetime.now(pytz.UTC)
+        entry["interactions"] += 1
+        if user.username:
+            entry["username"] = user.username
+        self.touches += 1
+        return True
+    
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            
+            users = User.__table__
+            stmt = users.update().where(users.c.user_id == bindparam("uid")).values(
+                last_activity=bindparam("last_activity"),
+                total_interactions=func.coalesce(users.c.total_interactions, 0) + bindparam("interactions"),
+                username=func.coalesce(bindparam("username"), users.c.username)
+            )
+            
+            def _write(db):
+                db.execute(stmt, list(pending.values()))
+                db.commit()
+            
+            try:
+                await run_db(_write)
+            except Exception as e:
+                for user_id, entry in pending.items():
+                    merged = self._pending.setdefault(user_id, entry)
+                    if merged is not entry:
+                        merged["interactions"] += entry["interactions"]
+                        merged["username"] = merged["username"] or entry["username"]
+                log.error(f"❌ Ошибка записи активности пользователей: {e}")
+                return 0
+            
+            self.flushes += 1
+            self.rows_written += len(pending)
+            return len(pending)
+
+activity_tracker = ActivityTracker()
+
+async def flush_activity(context: ContextTypes.DEFAULT_TYPE):
+    await activity_tracker.flush()
+
+# ============== ОБРАБОТЧИКИ КОМАНД ==============
+
+async def register_user(update: Update) -> bool:
+    user = update.effective_user
+    if activity_tracker.touch(user):
+        return False
+    
+    def _register(db):
+        existing = db.query(User).filter_by(user_id=user.id).first()
         if not existing:
             new_user = User(
                 user_id=user.id,
@@ -1352,17 +2792,23 @@ async def register_user(update: Update) -> bool:
             )
             db.add(new_user)
             db.commit()
-            log.info(f"🎉 Новый пользователь: {user.first_name} (@{user.username})", update=update)
             return True
         else:
             existing.last_activity = datetime.now(pytz.UTC)
             existing.total_interactions += 1
             if user.username:
                 existing.username = user.username
+            if existing.is_active is False:
+                existing.is_active = True
+                reactivate_user(db, user.id)
             db.commit()
             return False
-    finally:
-        db.close()
+    
+    is_new = await run_db(_register)
+    activity_tracker.remember(user.id)
+    if is_new:
+        log.info(f"🎉 Новый пользователь: {user.first_name} (@{user.username})", update=update)
+    return is_new
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await register_user(update)
@@ -1384,6 +2830,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, reply_markup=get_start_keyboard(), parse_mode=None)
     log.info("✅ /start обработан", update=update)
 
+@callback_router.exact("help")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = """❓ *Как очистить историю переписки*
 
@@ -1406,6 +2853,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(text, reply_markup=get_about_keyboard(), parse_mode=None)
     log.info("✅ /help обработан", update=update)
 
+@callback_router.exact("about")
 async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = DOCTOR_INFO + f"""
 
@@ -1425,6 +2873,7 @@ async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ============== АДМИН-КОМАНДЫ ==============
 
+@callback_router.exact("admin_panel")
 @admin_only
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -1434,35 +2883,74 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     log.info(f"🔐 Админ-панель открыта", update=update)
 
+@admin_only
+async def admin_backfill_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("⏳ Пересчитываю дневные сводки статистики из журналов...")
+    users, rows = await run_daily_stats_backfill()
+    await update.message.reply_text(f"✅ Сводки пересчитаны: {users} пользователей, {rows} дней")
+    log.info("📊 Сводки статистики пересчитаны вручную", update=update)
+
+@callback_router.exact("admin_stats")
 @admin_only
 async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    db = get_db()
-    try:
+    def _counts(db):
         total_users = db.query(User).count()
         active_today = db.query(User).filter(
             User.last_activity >= datetime.now(pytz.UTC) - timedelta(days=1)
         ).count()
         total_medicines = db.query(Medicine).filter(Medicine.status == 'active').count()
         total_analyses = db.query(Analysis).filter(Analysis.status == 'pending').count()
-        
-        text = f"""📊 *Статистика бота*
+        retrying = db.query(Reminder).filter(Reminder.status == 'retry').count()
+        return total_users, active_today, total_medicines, total_analyses, retrying
+    
+    total_users, active_today, total_medicines, total_analyses, retrying = await run_db(_counts)
+    
+    text = f"""📊 *Статистика бота*
 
 👥 *Пользователи:* {total_users}
 📊 *Активных сегодня:* {active_today}
 💊 *Активных лекарств:* {total_medicines}
-🩺 *Запланированных анализов:* {total_analyses}"""
-        
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]]),
-            parse_mode=None
-        )
-    finally:
-        db.close()
+🩺 *Запланированных анализов:* {total_analyses}
+🔁 *Напоминаний ждут повтора:* {retrying}
+
+🔌 *Соединений с БД на запрос:* {uow_stats.avg_checkouts:.2f} (макс. {uow_stats.max_checkouts})
+🔎 *SQL-запросов на запрос:* {uow_stats.avg_queries:.1f} (макс. {uow_stats.max_queries})
+🌍 *Кэш часовых поясов:* {timezone_cache.hits} попаданий / {timezone_cache.misses} промахов ({len(timezone_cache)} польз.)
+🕐 *Кэш pytz:* {get_tz.cache_info().hits} попаданий / {get_tz.cache_info().misses} промахов"""
+    if outbound_queue.stats.summary():
+        text += f"\n📤 *Очередь отправки:*\n{outbound_queue.stats.summary()}"
+    if rate_limiter.acquired:
+        text += (f"\n🚦 *Лимитер Telegram:* {rate_limiter.acquired} сообщений, ожидание "
+                 f"{rate_limiter.waited / rate_limiter.acquired * 1000:.0f}мс в среднем, "
+                 f"макс. {rate_limiter.max_wait:.1f}s, RetryAfter: {rate_limiter.retry_afters}")
+    if REMINDER_SEND_MODE == 'batch':
+        text += f"\n📦 *Пачек напоминаний:* {reminder_batcher.batches} (крупнейшая {reminder_batcher.largest})"
+    if update_lanes.processed:
+        text += f"\n🧵 *Обработка updates:* {update_lanes.summary()}"
+    if integrity_stats.runs:
+        text += f"\n🧹 *Проверка целостности:* {integrity_stats.summary()}"
+    if backup_manager.created or backup_manager.failed:
+        text += (f"\n💾 *Бэкапы:* {backup_manager.created} создано, {backup_manager.failed} ошибок, "
+                 f"последний за {backup_manager.last_duration:.1f}s")
+    if activity_tracker.touches:
+        text += (f"\n👣 *Активность:* {activity_tracker.touches} обращений -> {activity_tracker.rows_written} строк "
+                 f"за {activity_tracker.flushes} записей, известно {len(activity_tracker.known)} польз.")
+    if persistence.loads:
+        text += (f"\n💾 *Состояние диалогов:* загружено {persistence.loads} польз., "
+                 f"записано {persistence.rows_written} строк за {persistence.flushes} сбросов")
+    if REMINDER_DISPATCHER == 'wheel':
+        text += f"\n⏱ *Колесо напоминаний:* {len(reminder_wheel)} в окне, отправлено {reminder_wheel.dispatched}"
+    
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]]),
+        parse_mode=None
+    )
 
+@callback_router.exact("admin_users")
 @admin_only
 async def admin_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1473,29 +2961,29 @@ async def admin_users_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         parse_mode=None
     )
 
+@callback_router.exact("admin_users_list")
 @admin_only
 async def admin_users_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    db = get_db()
-    try:
-        users = db.query(User).order_by(User.registered_at.desc()).limit(10).all()
-        
-        text = "📋 *Последние 10 пользователей:*\n\n"
-        for u in users:
-            date = u.registered_at.strftime('%d.%m.%Y')
-            name = u.first_name or u.username or str(u.user_id)
-            text += f"• {name} (ID: {u.user_id}) - {date}\n"
-        
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_users")]]),
-            parse_mode=None
-        )
-    finally:
-        db.close()
+    users = await run_db(
+        lambda db: db.query(User).order_by(User.registered_at.desc()).limit(10).all()
+    )
+    
+    text = "📋 *Последние 10 пользователей:*\n\n"
+    for u in users:
+        date = u.registered_at.strftime('%d.%m.%Y')
+        name = u.first_name or u.username or str(u.user_id)
+        text += f"• {name} (ID: {u.user_id}) - {date}\n"
+    
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_users")]]),
+        parse_mode=None
+    )
 
+@callback_router.exact("admin_logs")
 @admin_only
 async def admin_logs_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1506,6 +2994,7 @@ async def admin_logs_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         parse_mode=None
     )
 
+@callback_router.exact("admin_logs_errors")
 @admin_only
 async def admin_logs_errors_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1535,6 +3024,7 @@ async def admin_logs_errors_callback(update: Update, context: ContextTypes.DEFAU
         parse_mode=None
     )
 
+@callback_router.exact("admin_backups")
 @admin_only
 async def admin_backups_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1545,13 +3035,14 @@ async def admin_backups_callback(update: Update, context: ContextTypes.DEFAULT_T
         parse_mode=None
     )
 
+@callback_router.exact("admin_backup_create")
 @admin_only
 async def admin_backup_create_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     await query.edit_message_text("🔄 Создаю резервную копию...")
-    backup_path = backup_manager.create_backup("manual")
+    backup_path = await backup_manager.create_backup("manual")
     
     if backup_path:
         await query.edit_message_text(
@@ -1562,6 +3053,7 @@ async def admin_backup_create_callback(update: Update, context: ContextTypes.DEF
     else:
         await query.edit_message_text("❌ Ошибка при создании бэкапа")
 
+@callback_router.exact("admin_backup_list")
 @admin_only
 async def admin_backup_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1592,8 +3084,211 @@ async def admin_backup_list_callback(update: Update, context: ContextTypes.DEFAU
         parse_mode=None
     )
 
+# ============== РАССЫЛКИ ==============
+
+BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", "200"))
+
+BROADCAST_SEGMENTS = {
+    'all': "👥 Всем активным",
+    'medicines': "💊 С активными лекарствами",
+    'analyses': "🩺 С запланированными анализами",
+}
+
+def broadcast_recipients(segment: str):
+    """Запрос user_id получателей сегмента; страницы берутся по ключу user_id."""
+    query = select(User.user_id).where(User.is_active == True, User.is_banned == False)
+    if segment == 'medicines':
+        query = query.where(
+            select(Medicine.id).where(Medicine.user_id == User.user_id, Medicine.status == 'active').exists()
+        )
+    elif segment == 'analyses':
+        query = query.where(
+            select(Analysis.id).where(Analysis.user_id == User.user_id, Analysis.status == 'pending').exists()
+        )
+    return query
+
+class BroadcastEngine:
+    """Рассылка с контрольными точками в BroadcastLog.
+    
+    Получатели читаются страницами по BROADCAST_PAGE_SIZE (user_id > last_user_id),
+    сообщения идут через outbound_queue с приоритетом BROADCAST, то есть с максимальной
+    скоростью, которую оставляют лимиты Telegram и более срочные сообщения. После каждой
+    страницы в BroadcastLog пишутся last_user_id и счетчики, поэтому после перезапуска
+    рассылка продолжается с места остановки; повторно может уйти не больше одной страницы.
+    """
+    
+    def __init__(self, page_size: int = BROADCAST_PAGE_SIZE):
+        self.page_size = page_size
+        self._tasks: Dict[int, asyncio.Task] = {}
+    
+    async def create(self, admin_id: int, message: str, segment: str) -> Tuple[int, int]:
+        def _create(db):
+            total = db.execute(select(func.count()).select_from(broadcast_recipients(segment).subquery())).scalar()
+            entry = BroadcastLog(
+                admin_id=admin_id, message=message, target=segment,
+                total=total, success=0, failed=0, status='running', last_user_id=0
+            )
+            db.add(entry)
+            db.commit()
+            return entry.id, total
+        
+        broadcast_id, total = await run_db(_create)
+        self.start(broadcast_id)
+        log.info(f"📨 Рассылка {broadcast_id} запущена: сегмент {segment}, получателей {total}")
+        return broadcast_id, total
+    
+    def start(self, broadcast_id: int):
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id), context=contextvars.Context())
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+    
+    async def resume(self) -> int:
+        """Продолжает рассылки, прерванные остановкой бота."""
+        running = await run_db(lambda db: [
+            b.id for b in db.query(BroadcastLog.id).filter(BroadcastLog.status == 'running')
+        ])
+        for broadcast_id in running:
+            self.start(broadcast_id)
+        if running:
+            log.info(f"📨 Возобновлено рассылок: {len(running)}")
+        return len(running)
+    
+    async def _send(self, chat_id: int, text: str, dead: list) -> bool:
+        for attempt in range(2):
+            try:
+                await application.bot.send_message(
+                    chat_id=chat_id, text=text, rate_limit_args=SendPriority.BROADCAST
+                )
+                return True
+            except RetryAfter:
+                continue  # лимитер уже выдержит паузу перед повтором
+            except Exception as e:
+                if is_dead_chat_error(e):
+                    dead.append(chat_id)
+                log.debug(f"Рассылка: не доставлено {chat_id}: {e}")
+                return False
+        return False
+    
+    async def _run(self, broadcast_id: int):
+        def _page(db, segment, after):
+            return list(db.execute(
+                broadcast_recipients(segment).where(User.user_id > after)
+                .order_by(User.user_id).limit(self.page_size)
+            ).scalars())
+        
+        def _checkpoint(db, last_user_id, ok, failed, dead):
+            if dead:
+                deactivate_users(db, dead)
+            db.query(BroadcastLog).filter_by(id=broadcast_id).update({
+                BroadcastLog.last_user_id: last_user_id,
+                BroadcastLog.success: BroadcastLog.success + ok,
+                BroadcastLog.failed: BroadcastLog.failed + failed,
+            })
+            db.commit()
+        
+        def _finish(db):
+            entry = db.query(BroadcastLog).filter_by(id=broadcast_id).first()
+            entry.status = 'done'
+            entry.finished_at = datetime.now(pytz.UTC)
+            db.commit()
+            return entry.admin_id, entry.total, entry.success, entry.failed
+        
+        entry = await run_db(lambda db: db.query(BroadcastLog).filter_by(id=broadcast_id).first())
+        if not entry or entry.status != 'running':
+            return
+        cursor = entry.last_user_id or 0
+        
+        try:
+            while True:
+                page = await run_db(_page, entry.target, cursor)
+                if not page:
+                    break
+                dead = []
+                results = await asyncio.gather(*(self._send(chat_id, entry.message, dead) for chat_id in page))
+                ok = sum(results)
+                cursor = page[-1]
+                await run_db(_checkpoint, cursor, ok, len(page) - ok, dead)
+            
+            admin_id, total, success, failed = await run_db(_finish)
+            log.info(f"📨 Рассылка {broadcast_id} завершена: {success} доставлено, {failed} ошибок")
+            await application.bot.send_message(
+                chat_id=admin_id,
+                text=f"📨 Рассылка #{broadcast_id} завершена\n\n"
+                     f"👥 Получателей: {total}\n✅ Доставлено: {success}\n❌ Ошибок: {failed}",
+                rate_limit_args=SendPriority.ADMIN
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"❌ Рассылка {broadcast_id} прервана на user_id {cursor}: {e}")
+
+broadcast_engine = BroadcastEngine()
+
+@admin_only
+async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    context.user_data['broadcast'] = {}
+    await query.edit_message_text(
+        "📨 Рассылка\n\nОтправьте текст сообщения.\nДля отмены - /cancel",
+        parse_mode=None
+    )
+    return ADMIN_BROADCAST_MESSAGE
+
+async def admin_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    context.user_data['broadcast'] = {'text': text}
+    
+    def _counts(db):
+        return {
+            segment: db.execute(select(func.count()).select_from(broadcast_recipients(segment).subquery())).scalar()
+            for segment in BROADCAST_SEGMENTS
+        }
+    
+    counts = await run_db(_counts)
+    keyboard = [
+        [InlineKeyboardButton(f"{title} ({counts[segment]})", callback_data=f"broadcast_send_{segment}")]
+        for segment, title in BROADCAST_SEGMENTS.items()
+    ]
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="broadcast_cancel")])
+    
+    await update.message.reply_text(
+        f"📨 Текст рассылки:\n\n{text}\n\nКому отправить?",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode=None
+    )
+    return ADMIN_BROADCAST_CONFIRM
+
+async def admin_broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    if query.data == "broadcast_cancel":
+        context.user_data.pop('broadcast', None)
+        await safe_send_message(query, "❌ Рассылка отменена", reply_markup=InlineKeyboardMarkup([get_main_menu_button()]))
+        return ConversationHandler.END
+    
+    segment = query.data.replace("broadcast_send_", "")
+    text = context.user_data.pop('broadcast', {}).get('text')
+    if segment not in BROADCAST_SEGMENTS or not text:
+        await safe_send_message(query, "❌ Рассылка не найдена, начните заново")
+        return ConversationHandler.END
+    
+    broadcast_id, total = await broadcast_engine.create(update.effective_user.id, text, segment)
+    await safe_send_message(
+        query,
+        f"✅ Рассылка #{broadcast_id} запущена\n👥 Получателей: {total}\n\nПо окончании придет отчет.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]])
+    )
+    log.info(f"📨 Рассылка #{broadcast_id} ({segment}) создана", update=update)
+    return ConversationHandler.END
+
 # ============== ОБРАБОТЧИКИ ДОБАВЛЕНИЯ ЛЕКАРСТВ ==============
 
+@callback_router.exact("add_medicine")
 async def add_medicine_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1616,6 +3311,7 @@ async def add_medicine_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return MEDICINE_TIMES_PER_DAY
 
+@callback_router.prefix("times_")
 async def add_medicine_times_per_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query:
         query = update.callback_query
@@ -1654,6 +3350,7 @@ async def add_medicine_times_per_day(update: Update, context: ContextTypes.DEFAU
             await update.message.reply_text("❌ Введите число от 1 до 10")
             return MEDICINE_TIMES_PER_DAY
 
+@callback_router.prefix("med_hour_")
 async def add_medicine_hour(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1671,6 +3368,7 @@ async def add_medicine_hour(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return MEDICINE_TIME_MINUTE
 
+@callback_router.prefix("med_minute_")
 async def add_medicine_minute(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1704,6 +3402,7 @@ async def add_medicine_minute(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return MEDICINE_REMINDER_UNIT
 
+@callback_router.exact("reminder_minutes", "reminder_hours")
 async def add_medicine_reminder_unit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1723,6 +3422,7 @@ async def add_medicine_reminder_unit(update: Update, context: ContextTypes.DEFAU
         )
         return MEDICINE_REMINDER_VALUE
 
+@callback_router.prefix("med_remind_")
 async def add_medicine_reminder_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query:
         query = update.callback_query
@@ -1796,6 +3496,7 @@ async def add_medicine_reminder_value(update: Update, context: ContextTypes.DEFA
         )
     return MEDICINE_CONFIRM
 
+@callback_router.exact("confirm_medicine")
 async def add_medicine_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1811,8 +3512,7 @@ async def add_medicine_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return ConversationHandler.END
     
-    db = get_db()
-    try:
+    def _save(db):
         medicine = Medicine(
             user_id=user_id,
             name=med['name'],
@@ -1820,64 +3520,17 @@ async def add_medicine_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
             times_per_day=med['times_per_day'],
             reminder_minutes=med.get('reminder_minutes', 0),
             start_date=datetime.now(pytz.UTC),
-            user_timezone=get_user_timezone(user_id),
+            user_timezone=get_user_timezone(user_id, db),
             course_type='unlimited'
         )
         db.add(medicine)
-        db.flush()
-        
-        times = med['schedule'].split(',')
-        for time_str in times:
-            tz = pytz.timezone(get_user_timezone(user_id))
-            now = datetime.now(tz)
-            h, m = map(int, time_str.split(':'))
-            scheduled = now.replace(hour=h, minute=m, second=0, microsecond=0)
-            
-            if scheduled < now:
-                scheduled += timedelta(days=1)
-            
-            reminder_minutes = med.get('reminder_minutes', 0)
-            if reminder_minutes > 0:
-                reminder_time = scheduled - timedelta(minutes=reminder_minutes)
-                if reminder_time > datetime.now(tz).astimezone(pytz.UTC):
-                    reminder = Reminder(
-                        user_id=user_id,
-                        reminder_type='medicine',
-                        item_id=medicine.id,
-                        scheduled_time=reminder_time.astimezone(pytz.UTC),
-                        user_timezone=get_user_timezone(user_id)
-                    )
-                    db.add(reminder)
-                    db.flush()
-                    
-                    scheduler.scheduler.add_job(
-                        send_reminder_job,
-                        trigger=DateTrigger(run_date=reminder_time.astimezone(pytz.UTC)),
-                        id=f"medicine_{reminder.id}",
-                        args=[reminder.id],
-                        replace_existing=True
-                    )
-            
-            main_reminder = Reminder(
-                user_id=user_id,
-                reminder_type='medicine',
-                item_id=medicine.id,
-                scheduled_time=scheduled.astimezone(pytz.UTC),
-                user_timezone=get_user_timezone(user_id)
-            )
-            db.add(main_reminder)
-            db.flush()
-            
-            scheduler.scheduler.add_job(
-                send_reminder_job,
-                trigger=DateTrigger(run_date=scheduled.astimezone(pytz.UTC)),
-                id=f"medicine_{main_reminder.id}",
-                args=[main_reminder.id],
-                replace_existing=True
-            )
-        
         db.commit()
         
+        schedule_medicine(medicine)
+    
+    try:
+        await run_db(_save)
+        
         await safe_send_message(
             query,
             f"✅ Лекарство '{med['name']}' добавлено!\nНапоминания настроены.",
@@ -1886,7 +3539,6 @@ async def add_medicine_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
         log.info(f"✅ Лекарство добавлено: {med['name']}", update=update)
         
     except Exception as e:
-        db.rollback()
         log.error(f"❌ Ошибка добавления лекарства: {e}", update=update, exc_info=True)
         await safe_send_message(
             query,
@@ -1894,13 +3546,13 @@ async def add_medicine_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
         )
     finally:
-        db.close()
         context.user_data.clear()
     
     return ConversationHandler.END
 
 # ============== ОБРАБОТЧИКИ ДОБАВЛЕНИЯ АНАЛИЗОВ ==============
 
+@callback_router.exact("add_analysis")
 async def add_analysis_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1923,9 +3575,10 @@ async def add_analysis_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ANALYSIS_DATE
 
+@callback_router.prefix("analysis_date_")
 async def add_analysis_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    tz = get_user_timezone(user_id)
+    tz = await run_db(lambda db: get_user_timezone(user_id, db))
     
     if update.callback_query:
         query = update.callback_query
@@ -1941,7 +3594,7 @@ async def add_analysis_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
         date_str = query.data.replace("analysis_date_", "")
         try:
             date = datetime.strptime(date_str, '%d.%m.%Y')
-            date = pytz.timezone(tz).localize(date.replace(hour=12))
+            date = get_tz(tz).localize(date.replace(hour=12))
             context.user_data['analysis']['date'] = date
         except:
             await safe_send_message(query, "❌ Неверный формат даты")
@@ -1961,6 +3614,7 @@ async def add_analysis_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ANALYSIS_TIME_HOUR
 
+@callback_router.prefix("ana_hour_")
 async def add_analysis_hour(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1975,6 +3629,7 @@ async def add_analysis_hour(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ANALYSIS_TIME_MINUTE
 
+@callback_router.prefix("ana_minute_")
 async def add_analysis_minute(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -2010,6 +3665,7 @@ async def add_analysis_reminder_unit(update: Update, context: ContextTypes.DEFAU
         )
         return ANALYSIS_REMINDER_VALUE
 
+@callback_router.prefix("ana_remind_")
 async def add_analysis_reminder_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query:
         query = update.callback_query
@@ -2085,6 +3741,7 @@ async def add_analysis_reminder_value(update: Update, context: ContextTypes.DEFA
         )
     return ANALYSIS_CONFIRM
 
+@callback_router.exact("confirm_analysis")
 async def add_analysis_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -2100,8 +3757,8 @@ async def add_analysis_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return ConversationHandler.END
     
-    db = get_db()
-    try:
+    def _save(db):
+        tz_name = get_user_timezone(user_id, db)
         h, m = map(int, ana['time'].split(':'))
         dt = ana['date'].replace(hour=h, minute=m)
         
@@ -2112,7 +3769,7 @@ async def add_analysis_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
             scheduled_time=ana['time'],
             reminder_before=ana['reminder_minutes'],
             reminder_unit=ana.get('reminder_unit', 'minutes'),
-            user_timezone=get_user_timezone(user_id)
+            user_timezone=tz_name
         )
         db.add(analysis)
         db.flush()
@@ -2124,20 +3781,16 @@ async def add_analysis_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
                 reminder_type='analysis',
                 item_id=analysis.id,
                 scheduled_time=remind_time,
-                user_timezone=get_user_timezone(user_id)
+                user_timezone=tz_name
             )
             db.add(reminder)
             db.flush()
-            
-            scheduler.scheduler.add_job(
-                send_reminder_job,
-                trigger=DateTrigger(run_date=remind_time),
-                id=f"analysis_{reminder.id}",
-                args=[reminder.id],
-                replace_existing=True
-            )
+            schedule_reminder(reminder)
         
         db.commit()
+    
+    try:
+        await run_db(_save)
         
         await safe_send_message(
             query,
@@ -2147,7 +3800,6 @@ async def add_analysis_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
         log.info(f"✅ Анализ добавлен: {ana['name']}", update=update)
         
     except Exception as e:
-        db.rollback()
         log.error(f"❌ Ошибка добавления анализа: {e}", update=update, exc_info=True)
         await safe_send_message(
             query,
@@ -2155,7 +3807,6 @@ async def add_analysis_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
         )
     finally:
-        db.close()
         context.user_data.clear()
     
     return ConversationHandler.END
@@ -2174,6 +3825,7 @@ async def safe_send_message(target, text, reply_markup=None, parse_mode=None):
 
 # ============== ОБРАБОТЧИКИ СПИСКОВ ==============
 
+@callback_router.exact("list_medicines")
 async def list_medicines(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -2181,35 +3833,34 @@ async def list_medicines(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query:
         await query.answer()
     
-    db = get_db()
-    try:
-        medicines = db.query(Medicine).filter(
+    medicines = await run_db(
+        lambda db: db.query(Medicine).filter(
             Medicine.user_id == user_id,
             Medicine.status == 'active'
         ).order_by(Medicine.created_at.desc()).all()
-        
-        if not medicines:
-            text = "📋 У вас нет активных лекарств"
-            keyboard = [
-                [InlineKeyboardButton("💊 Добавить лекарство", callback_data="add_medicine")],
-                get_main_menu_button()
-            ]
-        else:
-            text = "📋 Ваши лекарства:\n\n"
-            keyboard = []
-            for i, m in enumerate(medicines, 1):
-                text += f"{i}. {m.name}\n   ⏰ {m.schedule}\n"
-                keyboard.append([InlineKeyboardButton(f"🗑️ Удалить {m.name}", callback_data=f"delete_medicine_{m.id}")])
-            keyboard.append([InlineKeyboardButton("💊 Добавить лекарство", callback_data="add_medicine")])
-            keyboard.append(get_main_menu_button())
-        
-        if query:
-            await safe_send_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            await safe_send_message(update.message, text, reply_markup=InlineKeyboardMarkup(keyboard))
-    finally:
-        db.close()
+    )
+    
+    if not medicines:
+        text = "📋 У вас нет активных лекарств"
+        keyboard = [
+            [InlineKeyboardButton("💊 Добавить лекарство", callback_data="add_medicine")],
+            get_main_menu_button()
+        ]
+    else:
+        text = "📋 Ваши лекарства:\n\n"
+        keyboard = []
+        for i, m in enumerate(medicines, 1):
+            text += f"{i}. {m.name}\n   ⏰ {m.schedule}\n"
+            keyboard.append([InlineKeyboardButton(f"🗑️ Удалить {m.name}", callback_data=f"delete_medicine_{m.id}")])
+        keyboard.append([InlineKeyboardButton("💊 Добавить лекарство", callback_data="add_medicine")])
+        keyboard.append(get_main_menu_button())
+    
+    if query:
+        await safe_send_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await safe_send_message(update.message, text, reply_markup=InlineKeyboardMarkup(keyboard))
 
+@callback_router.exact("list_analyses")
 async def list_analyses(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -2217,91 +3868,91 @@ async def list_analyses(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query:
         await query.answer()
     
-    db = get_db()
-    try:
-        analyses = db.query(Analysis).filter(
+    analyses = await run_db(
+        lambda db: db.query(Analysis).filter(
             Analysis.user_id == user_id,
             Analysis.status == 'pending'
         ).order_by(Analysis.scheduled_date.asc()).all()
-        
-        if not analyses:
-            text = "📋 У вас нет запланированных анализов"
-            keyboard = [
-                [InlineKeyboardButton("🩺 Добавить анализ", callback_data="add_analysis")],
-                get_main_menu_button()
-            ]
-        else:
-            text = "📋 Запланированные анализы:\n\n"
-            keyboard = []
-            now = datetime.now(pytz.UTC)
-            for i, a in enumerate(analyses, 1):
-                local = utc_to_local(a.scheduled_date, a.user_timezone)
-                text += f"{i}. {a.name}\n   📅 {local.strftime('%d.%m.%Y %H:%M')}\n"
-                keyboard.append([InlineKeyboardButton(f"🗑️ Удалить {a.name}", callback_data=f"delete_analysis_{a.id}")])
-            keyboard.append([InlineKeyboardButton("🩺 Добавить анализ", callback_data="add_analysis")])
-            keyboard.append(get_main_menu_button())
-        
-        if query:
-            await safe_send_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            await safe_send_message(update.message, text, reply_markup=InlineKeyboardMarkup(keyboard))
-    finally:
-        db.close()
+    )
+    
+    if not analyses:
+        text = "📋 У вас нет запланированных анализов"
+        keyboard = [
+            [InlineKeyboardButton("🩺 Добавить анализ", callback_data="add_analysis")],
+            get_main_menu_button()
+        ]
+    else:
+        text = "📋 Запланированные анализы:\n\n"
+        keyboard = []
+        now = datetime.now(pytz.UTC)
+        for i, a in enumerate(analyses, 1):
+            local = utc_to_local(a.scheduled_date, a.user_timezone)
+            text += f"{i}. {a.name}\n   📅 {local.strftime('%d.%m.%Y %H:%M')}\n"
+            keyboard.append([InlineKeyboardButton(f"🗑️ Удалить {a.name}", callback_data=f"delete_analysis_{a.id}")])
+        keyboard.append([InlineKeyboardButton("🩺 Добавить анализ", callback_data="add_analysis")])
+        keyboard.append(get_main_menu_button())
+    
+    if query:
+        await safe_send_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await safe_send_message(update.message, text, reply_markup=InlineKeyboardMarkup(keyboard))
 
+@callback_router.prefix("delete_medicine_", int)
 async def delete_medicine(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    med_id = int(query.data.replace("delete_medicine_", ""))
+    med_id = context.args[0]
     
-    db = get_db()
-    try:
+    def _delete(db):
         med = db.query(Medicine).filter_by(id=med_id).first()
-        if med:
-            med.status = 'deleted'
-            for r in db.query(Reminder).filter(
-                Reminder.item_id == med_id,
-                Reminder.reminder_type == 'medicine',
-                Reminder.status.in_(['pending', 'sent'])
-            ):
-                r.status = 'cancelled'
-                try:
-                    scheduler.scheduler.remove_job(f"medicine_{r.id}")
-                except:
-                    pass
-            db.commit()
-            await safe_send_message(query, f"✅ Лекарство {med.name} удалено", reply_markup=InlineKeyboardMarkup([get_main_menu_button()]))
-    finally:
-        db.close()
+        if not med:
+            return None
+        med.status = 'deleted'
+        for r in db.query(Reminder).filter(
+            Reminder.item_id == med_id,
+            Reminder.reminder_type == 'medicine',
+            Reminder.status.in_(['pending', 'sent'])
+        ):
+            r.status = 'cancelled'
+            unschedule_reminder(r)
+        db.commit()
+        unschedule_medicine(med)
+        return med.name
+    
+    name = await run_db(_delete)
+    if name:
+        await safe_send_message(query, f"✅ Лекарство {name} удалено", reply_markup=InlineKeyboardMarkup([get_main_menu_button()]))
 
+@callback_router.prefix("delete_analysis_", int)
 async def delete_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    ana_id = int(query.data.replace("delete_analysis_", ""))
+    ana_id = context.args[0]
     
-    db = get_db()
-    try:
+    def _delete(db):
         ana = db.query(Analysis).filter_by(id=ana_id).first()
-        if ana:
-            ana.status = 'cancelled'
-            for r in db.query(Reminder).filter(
-                Reminder.item_id == ana_id,
-                Reminder.reminder_type == 'analysis',
-                Reminder.status.in_(['pending', 'sent'])
-            ):
-                r.status = 'cancelled'
-                try:
-                    scheduler.scheduler.remove_job(f"analysis_{r.id}")
-                except:
-                    pass
-            db.commit()
-            await safe_send_message(query, f"✅ Анализ {ana.name} удален", reply_markup=InlineKeyboardMarkup([get_main_menu_button()]))
-    finally:
-        db.close()
+        if not ana:
+            return None
+        ana.status = 'cancelled'
+        for r in db.query(Reminder).filter(
+            Reminder.item_id == ana_id,
+            Reminder.reminder_type == 'analysis',
+            Reminder.status.in_(['pending', 'sent'])
+        ):
+            r.status = 'cancelled'
+            unschedule_reminder(r)
+        db.commit()
+        return ana.name
+    
+    name = await run_db(_delete)
+    if name:
+        await safe_send_message(query, f"✅ Анализ {name} удален", reply_markup=InlineKeyboardMarkup([get_main_menu_button()]))
 
 # ============== ОБРАБОТЧИКИ САМОЧУВСТВИЯ ==============
 
+@callback_router.exact("mood")
 async def mood_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = "📊 Как вы себя чувствуете сегодня?\n\nОцените по 5-балльной шкале:"
     
@@ -2310,32 +3961,162 @@ async def mood_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await safe_send_message(update.message, text, reply_markup=get_mood_keyboard())
 
+@callback_router.prefix("mood_", int)
 async def mood_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    score = int(query.data.replace("mood_", ""))
+    score = context.args[0]
     user_id = update.effective_user.id
     
-    db = get_db()
-    try:
-        mood = MoodLog(user_id=user_id, mood_score=score)
-        db.add(mood)
+    def _save(db):
+        now = datetime.now(pytz.UTC)
+        tz = get_user_timezone(user_id, db)
+        db.add(MoodLog(user_id=user_id, mood_score=score, created_at=now))
+        bump_daily_stats(db, user_id, now, tz, mood=score)
         db.commit()
-        
-        texts = {1: "😢 Очень плохо", 2: "🙁 Плохо", 3: "😐 Нормально", 4: "🙂 Хорошо", 5: "😊 Отлично"}
-        local = utc_to_local(mood.created_at, get_user_timezone(user_id))
-        
-        await safe_send_message(
-            query,
-            f"✅ {texts[score]}\n📅 {local.strftime('%d.%m.%Y %H:%M')}",
-            reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
-        )
-    finally:
-        db.close()
+        return utc_to_local(now, tz)
+    
+    texts = {1: "😢 Очень плохо", 2: "🙁 Плохо", 3: "😐 Нормально", 4: "🙂 Хорошо", 5: "😊 Отлично"}
+    local = await run_db(_save)
+    
+    await safe_send_message(
+        query,
+        f"✅ {texts[score]}\n📅 {local.strftime('%d.%m.%Y %H:%M')}",
+        reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
+    )
+
+# ============== ДНЕВНЫЕ СВОДКИ СТАТИСТИКИ ==============
+
+DAILY_STATS_BACKFILL_CHUNK = 500
+DAILY_STATS_FETCH = 5000
+MEDICINE_TAKEN_STATUSES = ('taken', 'extra')
+DAILY_STATS_GAUGES = ('mood', 'symptom')
+DAILY_STATS_COUNTERS = ('medicine_taken', 'medicine_skipped')
+
+def daily_stats_row(user_id: int, day, mood: Optional[int] = None, symptom: Optional[int] = None,
+                    medicine_status: Optional[str] = None) -> dict:
+    row = {"user_id": user_id, "day": day}
+    for gauge, value in (("mood", mood), ("symptom", symptom)):
+        row[f"{gauge}_count"] = int(value is not None)
+        row[f"{gauge}_sum"] = value or 0
+        row[f"{gauge}_min"] = value
+        row[f"{gauge}_max"] = value
+    row["medicine_taken"] = int(medicine_status in MEDICINE_TAKEN_STATUSES)
+    row["medicine_skipped"] = int(medicine_status is not None and medicine_status not in MEDICINE_TAKEN_STATUSES)
+    return row
+
+def _merge_daily_row(total: dict, row: dict):
+    for gauge in DAILY_STATS_GAUGES:
+        if not row[f"{gauge}_count"]:
+            continue
+        total[f"{gauge}_count"] += row[f"{gauge}_count"]
+        total[f"{gauge}_sum"] += row[f"{gauge}_sum"]
+        for key, pick in ((f"{gauge}_min", min), (f"{gauge}_max", max)):
+            total[key] = row[key] if total[key] is None else pick(total[key], row[key])
+    for counter in DAILY_STATS_COUNTERS:
+        total[counter] += row[counter]
+
+def upsert_daily_stats(db, rows: List[dict]):
+    """Прибавляет строки к сводкам одним INSERT ... ON CONFLICT DO UPDATE (коммит - за вызывающим)."""
+    if not rows:
+        return
+    table = DailyUserStats.__table__
+    stmt = sqlite_insert(table)
+    new = stmt.excluded
+    set_ = {counter: table.c[counter] + new[counter] for counter in DAILY_STATS_COUNTERS}
+    for gauge in DAILY_STATS_GAUGES:
+        for key in (f"{gauge}_count", f"{gauge}_sum"):
+            set_[key] = table.c[key] + new[key]
+        # Скалярные min()/max() SQLite возвращают NULL, если один из аргументов NULL
+        set_[f"{gauge}_min"] = func.min(func.coalesce(table.c[f"{gauge}_min"], new[f"{gauge}_min"]),
+                                        func.coalesce(new[f"{gauge}_min"], table.c[f"{gauge}_min"]))
+        set_[f"{gauge}_max"] = func.max(func.coalesce(table.c[f"{gauge}_max"], new[f"{gauge}_max"]),
+                                        func.coalesce(new[f"{gauge}_max"], table.c[f"{gauge}_max"]))
+    db.execute(stmt.on_conflict_do_update(index_elements=[table.c.user_id, table.c.day], set_=set_), rows)
+
+def bump_daily_stats(db, user_id: int, moment: datetime, tz: str, **values):
+    """Учитывает одну запись журнала в сводке ее локального дня."""
+    upsert_daily_stats(db, [daily_stats_row(user_id, utc_to_local(moment, tz).date(), **values)])
+
+def rebuild_daily_stats(db, user_ids: List[int]) -> int:
+    """Пересчитывает сводки пользователей из журналов целиком (коммит - за вызывающим)."""
+    db.query(DailyUserStats).filter(DailyUserStats.user_id.in_(user_ids)).delete(synchronize_session=False)
+    timezones = dict(db.execute(
+        select(UserTimezone.user_id, UserTimezone.timezone).where(UserTimezone.user_id.in_(user_ids))
+    ).all())
+    
+    sources = (
+        (select(MoodLog.user_id, MoodLog.created_at, MoodLog.mood_score).where(MoodLog.user_id.in_(user_ids)), "mood"),
+        (select(SymptomLog.user_id, SymptomLog.created_at, SymptomLog.severity).where(SymptomLog.user_id.in_(user_ids)), "symptom"),
+        (select(MedicineLog.user_id, MedicineLog.taken_at, MedicineLog.status).where(MedicineLog.user_id.in_(user_ids)), "medicine_status"),
+    )
+    days: Dict[Tuple[int, Any], dict] = {}
+    for stmt, field in sources:
+        for user_id, moment, value in db.execute(stmt.execution_options(yield_per=DAILY_STATS_FETCH)):
+            if moment is None:
+                continue
+            day = utc_to_local(moment, timezones.get(user_id, DEFAULT_TIMEZONE)).date()
+            row = daily_stats_row(user_id, day, **{field: value})
+            total = days.get((user_id, day))
+            if total is None:
+                days[(user_id, day)] = row
+            else:
+                _merge_daily_row(total, row)
+    
+    upsert_daily_stats(db, list(days.values()))
+    return len(days)
+
+def backfill_daily_stats(db) -> Tuple[int, int]:
+    """Пересчитывает сводки всех пользователей с журналами, коммитя пачками."""
+    user_ids = [user_id for (user_id,) in db.execute(
+        select(MoodLog.user_id).union(select(SymptomLog.user_id), select(MedicineLog.user_id))
+    )]
+    rows = 0
+    for chunk in _chunks(user_ids, DAILY_STATS_BACKFILL_CHUNK):
+        rows += rebuild_daily_stats(db, chunk)
+        db.commit()
+    return len(user_ids), rows
+
+def daily_stats_summary(db, user_id: int, since=None) -> dict:
+    """Итоги по сводкам пользователя с дня since (включительно) или за все время."""
+    stmt = select(
+        func.coalesce(func.sum(DailyUserStats.mood_count), 0),
+        func.coalesce(func.sum(DailyUserStats.mood_sum), 0),
+        func.min(DailyUserStats.mood_min),
+        func.max(DailyUserStats.mood_max),
+        func.coalesce(func.sum(DailyUserStats.symptom_count), 0),
+        func.coalesce(func.sum(DailyUserStats.medicine_taken), 0),
+        func.coalesce(func.sum(DailyUserStats.medicine_skipped), 0),
+    ).where(DailyUserStats.user_id == user_id)
+    if since is not None:
+        stmt = stmt.where(DailyUserStats.day >= since)
+    mood_count, mood_sum, mood_min, mood_max, symptoms, taken, skipped = db.execute(stmt).one()
+    return {
+        "mood_count": mood_count,
+        "mood_avg": mood_sum / mood_count if mood_count else 0,
+        "mood_min": mood_min,
+        "mood_max": mood_max,
+        "symptoms": symptoms,
+        "taken": taken,
+        "skipped": skipped,
+    }
+
+def format_mood_summary(summary: dict) -> str:
+    text = f"😊 Настроение: {summary['mood_count']} записей, среднее {summary['mood_avg']:.1f}/5"
+    if summary['mood_count']:
+        text += f" (от {summary['mood_min']} до {summary['mood_max']})"
+    return text
+
+async def run_daily_stats_backfill():
+    started = time.perf_counter()
+    users, rows = await run_db(backfill_daily_stats)
+    log.info(f"📊 Сводки статистики пересчитаны: {users} польз., {rows} дней за {time.perf_counter() - started:.1f}s")
+    return users, rows
 
 # ============== ОБРАБОТЧИКИ СТАТИСТИКИ ==============
 
+@callback_router.exact("stats")
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = "📈 *Статистика*\n\nВыберите тип статистики:"
     
@@ -2344,59 +4125,44 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await safe_send_message(update.message, text, reply_markup=get_stats_keyboard())
 
+@callback_router.prefix("stats_")
 async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     user_id = update.effective_user.id
-    tz = get_user_timezone(user_id)
-    db = get_db()
     
-    try:
+    def _build(db):
+        """Возвращает (текст, показывать_меню)."""
+        tz = get_user_timezone(user_id, db)
+        
+        today = utc_to_local(datetime.now(pytz.UTC), tz).date()
+        
         if query.data == "stats_week":
-            week_ago = datetime.now(pytz.UTC) - timedelta(days=7)
-            
-            mood = db.query(MoodLog).filter(
-                MoodLog.user_id == user_id,
-                MoodLog.created_at >= week_ago
-            ).all()
-            
-            symptoms = db.query(SymptomLog).filter(
-                SymptomLog.user_id == user_id,
-                SymptomLog.created_at >= week_ago
-            ).all()
-            
-            avg_mood = sum(m.mood_score for m in mood) / len(mood) if mood else 0
+            summary = daily_stats_summary(db, user_id, since=today - timedelta(days=6))
             
             text = f"""📊 *Статистика за неделю*
 
-😊 Настроение: {len(mood)} записей, среднее {avg_mood:.1f}/5
-🩺 Симптомы: {len(symptoms)} записей"""
+{format_mood_summary(summary)}
+🩺 Симптомы: {summary['symptoms']} записей
+💊 Приемы лекарств: {summary['taken']} принято, {summary['skipped']} пропущено"""
             
         elif query.data == "stats_month":
-            month_ago = datetime.now(pytz.UTC) - timedelta(days=30)
-            
-            mood = db.query(MoodLog).filter(
-                MoodLog.user_id == user_id,
-                MoodLog.created_at >= month_ago
-            ).all()
-            
-            avg_mood = sum(m.mood_score for m in mood) / len(mood) if mood else 0
+            summary = daily_stats_summary(db, user_id, since=today - timedelta(days=29))
             
             text = f"""📊 *Статистика за месяц*
 
-😊 Настроение: {len(mood)} записей, среднее {avg_mood:.1f}/5"""
+{format_mood_summary(summary)}
+💊 Приемы лекарств: {summary['taken']} принято, {summary['skipped']} пропущено"""
             
         elif query.data == "stats_all":
-            mood = db.query(MoodLog).filter(MoodLog.user_id == user_id).all()
-            symptoms = db.query(SymptomLog).filter(SymptomLog.user_id == user_id).all()
-            
-            avg_mood = sum(m.mood_score for m in mood) / len(mood) if mood else 0
+            summary = daily_stats_summary(db, user_id)
             
             text = f"""📊 *Вся статистика*
 
-😊 Настроение: {len(mood)} записей, среднее {avg_mood:.1f}/5
-🩺 Симптомы: {len(symptoms)} записей"""
+{format_mood_summary(summary)}
+🩺 Симптомы: {summary['symptoms']} записей
+💊 Приемы лекарств: {summary['taken']} принято, {summary['skipped']} пропущено"""
             
         elif query.data == "stats_mood":
             mood = db.query(MoodLog).filter(
@@ -2404,8 +4170,7 @@ async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ).order_by(MoodLog.created_at.desc()).limit(10).all()
             
             if not mood:
-                await safe_send_message(query, "📊 Нет данных о настроении")
-                return
+                return "📊 Нет данных о настроении", False
             
             text = "📈 *Последние оценки настроения:*\n\n"
             for m in mood:
@@ -2419,8 +4184,7 @@ async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ).order_by(SymptomLog.created_at.desc()).limit(10).all()
             
             if not symptoms:
-                await safe_send_message(query, "📊 Нет данных о симптомах")
-                return
+                return "📊 Нет данных о симптомах", False
             
             text = "🩺 *Последние симптомы:*\n\n"
             for s in symptoms:
@@ -2433,101 +4197,494 @@ async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ).order_by(MedicineLog.taken_at.desc()).limit(10).all()
             
             if not meds:
-                await safe_send_message(query, "📊 Нет данных о лекарствах")
-                return
+                return "📊 Нет данных о лекарствах", False
             
+            medicines = loader(Medicine).load_many(db, {m.medicine_id for m in meds})
             text = "💊 *Последние приемы лекарств:*\n\n"
             for m in meds:
                 local = utc_to_local(m.taken_at, tz)
                 status = "✅" if m.status in ['taken', 'extra'] else "❌"
                 plan = "📅" if m.is_planned else "➕"
-                medicine = db.query(Medicine).filter_by(id=m.medicine_id).first()
+                medicine = medicines[m.medicine_id]
                 name = medicine.name if medicine else "Неизвестно"
                 text += f"{local.strftime('%d.%m %H:%M')}: {status}{plan} {name}\n"
         else:
             text = "📈 Выберите тип статистики"
         
-        await safe_send_message(query, text, reply_markup=InlineKeyboardMarkup([get_main_menu_button()]))
+        return text, True
+    
+    try:
+        text, with_menu = await run_db(_build)
+        
+        if with_menu:
+            await safe_send_message(query, text, reply_markup=InlineKeyboardMarkup([get_main_menu_button()]))
+        else:
+            await safe_send_message(query, text)
         
     except Exception as e:
         log.error(f"STATS ERROR: {e}")
         await safe_send_message(query, "❌ Ошибка при получении статистики")
-    finally:
-        db.close()
 
 # ============== ОБРАБОТЧИКИ НАПОМИНАНИЙ ==============
 
+# Статус, в котором лекарство/анализ еще ждут напоминания
+REMINDER_ITEM_STATUS = {'medicine': 'active', 'analysis': 'pending'}
+# Статусы напоминаний, которые можно отправлять: новые и ожидающие повтора
+REMINDER_SENDABLE = ('pending', 'retry')
+
+def reminder_message(reminder, item) -> Tuple[str, InlineKeyboardMarkup]:
+    if reminder.reminder_type == 'medicine':
+        return f"💊 Время принять лекарство!\n\n{item.name}", get_medicine_inline_keyboard(item.id)
+    
+    local = utc_to_local(item.scheduled_date, item.user_timezone)
+    text = f"🩺 Напоминание об анализе!\n\n{item.name}\n📅 {local.strftime('%d.%m.%Y %H:%M')}"
+    if item.notes:
+        text += f"\n\n📝 Заметки: {item.notes}"
+    return text, get_analysis_inline_keyboard(item.id)
+
+# Напоминания, которые уже взяты в отправку (ждут пачки, очереди или ответа Telegram):
+# проверка целостности не считает их просроченными
+reminders_in_flight: set = set()
+
 async def send_reminder_job(reminder_id: int):
+    """Срабатывание напоминания (задача APScheduler, колесо, medicine_dose_job).
+    
+    В режиме batch напоминание уходит в ReminderBatcher и делит с остальными
+    напоминаниями тика один JOIN-запрос и один UPDATE статусов, в single -
+    отправляется сразу.
+    """
+    if REMINDER_SEND_MODE == 'batch':
+        reminder_batcher.submit([reminder_id])
+        return
+    await send_reminder(reminder_id)
+
+@with_unit_of_work
+async def send_reminder(reminder_id: int):
+    """Отправляет одно напоминание: своя выборка, отправка и коммит статуса."""
+    reminders_in_flight.add(reminder_id)
+    try:
+        await _send_reminder(reminder_id)
+    finally:
+        reminders_in_flight.discard(reminder_id)
+
+async def _send_reminder(reminder_id: int):
     global application
     
-    db = get_db()
-    try:
+    def _prepare(db):
         reminder = db.query(Reminder).filter_by(id=reminder_id).first()
-        if not reminder or reminder.status != 'pending':
-            return
+        if not reminder or reminder.status not in REMINDER_SENDABLE:
+            return None
+        if reminder.reminder_type not in REMINDER_ITEM_STATUS:
+            return None
         
-        user_id = reminder.user_id
+        if db.query(User.is_active).filter_by(user_id=reminder.user_id).scalar() is False:
+            reminder.status = 'suspended'
+            db.commit()
+            return None
         
-        if reminder.reminder_type == 'medicine':
-            medicine = db.query(Medicine).filter_by(id=reminder.item_id).first()
-            if not medicine or medicine.status != 'active':
-                reminder.status = 'cancelled'
-                db.commit()
-                return
-            
-            text = f"💊 Время принять лекарство!\n\n{medicine.name}"
-            keyboard = get_medicine_inline_keyboard(medicine.id)
-            
-        elif reminder.reminder_type == 'analysis':
-            analysis = db.query(Analysis).filter_by(id=reminder.item_id).first()
-            if not analysis or analysis.status != 'pending':
-                reminder.status = 'cancelled'
-                db.commit()
-                return
-            
-            local = utc_to_local(analysis.scheduled_date, analysis.user_timezone)
-            text = f"🩺 Напоминание об анализе!\n\n{analysis.name}\n📅 {local.strftime('%d.%m.%Y %H:%M')}"
-            if analysis.notes:
-                text += f"\n\n📝 Заметки: {analysis.notes}"
-            
-            keyboard = get_analysis_inline_keyboard(analysis.id)
-        else:
+        model = Medicine if reminder.reminder_type == 'medicine' else Analysis
+        item = loader(model).load(db, reminder.item_id)
+        if not item or item.status != REMINDER_ITEM_STATUS[reminder.reminder_type]:
+            reminder.status = 'cancelled'
+            db.commit()
+            return None
+        
+        return (reminder.user_id, *reminder_message(reminder, item), reminder.retry_count or 0)
+    
+    def _mark_sent(db):
+        db.query(Reminder).filter_by(id=reminder_id).update({Reminder.status: 'sent'})
+        db.commit()
+    
+    try:
+        prepared = await run_db(_prepare)
+        if not prepared:
             return
+        user_id, text, keyboard, retry_count = prepared
+        
+        try:
+            await application.bot.send_message(
+                chat_id=user_id,
+                text=text,
+                reply_markup=keyboard,
+                parse_mode=None,
+                rate_limit_args=SendPriority.REMINDER
+            )
+        except Exception as e:
+            await run_db(record_reminder_failures, [(reminder_id, retry_count, e)])
+            return
+        
+        await run_db(_mark_sent)
+        log.info(f"✅ Напоминание {reminder_id} отправлено {user_id}")
         
-        await rate_limiter.acquire(user_id)
+    except Exception as e:
+        log.error(f"❌ Ошибка отправки {reminder_id}: {e}")
+
+def _due_medicine(db, medicine_id: int, now: datetime) -> Optional[Medicine]:
+    """Лекарство, по которому сейчас нужно напоминать; иначе None (и снимает задачи, если курс окончен)."""
+    medicine = loader(Medicine).load(db, medicine_id)
+    if not medicine or medicine.status != 'active':
+        if medicine:
+            unschedule_medicine(medicine)
+        return None
+    
+    if db.query(User.is_active).filter_by(user_id=medicine.user_id).scalar() is False:
+        unschedule_medicine(medicine)
+        return None
+    
+    paused_until = _as_utc(medicine.paused_until)
+    if paused_until and paused_until > now:
+        return None
+    
+    end = medicine_course_end(medicine)
+    if end and end <= now:
+        medicine.status = 'completed'
+        db.commit()
+        unschedule_medicine(medicine)
+        log.info(f"🏁 Курс лекарства {medicine.id} завершен")
+        return None
+    
+    return medicine
+
+@with_unit_of_work
+async def medicine_dose_job(medicine_id: int, dose_time: str):
+    """Срабатывание повторяющейся задачи приема: создает Reminder и отправляет его."""
+    def _materialize(db):
+        now = datetime.now(pytz.UTC)
+        medicine = _due_medicine(db, medicine_id, now)
+        if not medicine:
+            return None
+        
+        reminder = Reminder(
+            user_id=medicine.user_id,
+            reminder_type='medicine',
+            item_id=medicine.id,
+            scheduled_time=now,
+            user_timezone=medicine.user_timezone
+        )
+        db.add(reminder)
+        db.commit()
+        return reminder.id
+    
+    reminder_id = await run_db(_materialize)
+    if reminder_id:
+        await send_reminder_job(reminder_id)
+
+@with_unit_of_work
+async def medicine_pre_job(medicine_id: int, dose_time: str):
+    """Предупреждение за reminder_minutes до приема. Reminder не создает: прием напомнит medicine_dose_job."""
+    global application
+    
+    def _prepare(db):
+        medicine = _due_medicine(db, medicine_id, datetime.now(pytz.UTC))
+        if not medicine:
+            return None
+        text = f"⏰ Через {medicine.reminder_minutes} мин. прием лекарства\n\n{medicine.name} в {dose_time}"
+        return medicine.user_id, text
+    
+    prepared = await run_db(_prepare)
+    if not prepared:
+        return
+    user_id, text = prepared
+    
+    try:
         await application.bot.send_message(
             chat_id=user_id,
             text=text,
-            reply_markup=keyboard,
-            parse_mode=None
+            parse_mode=None,
+            rate_limit_args=SendPriority.REMINDER
+        )
+    except Exception as e:
+        log.error(f"❌ Ошибка предупреждения о приеме {medicine_id}: {e}")
+
+# ============== ПАКЕТНАЯ ОТПРАВКА НАПОМИНАНИЙ ==============
+
+# single - send_reminder на каждое напоминание (как было)
+# batch  - напоминания одного тика отправляются пачкой через send_reminders_batch,
+#          в том числе сработавшие отдельными задачами APScheduler
+REMINDER_SEND_MODE = os.environ.get("REMINDER_SEND_MODE", "batch").lower()
+REMINDER_BATCH_TICK = float(os.environ.get("REMINDER_BATCH_TICK", "1"))
+REMINDER_SEND_WORKERS = int(os.environ.get("REMINDER_SEND_WORKERS", "16"))
+# Ниже лимита SQLite на число параметров запроса (32766)
+SQL_IN_CHUNK = 10000
+
+def _chunks(items: list, size: int = SQL_IN_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def set_reminders_status(db, reminder_ids: List[int], status: str):
+    for chunk in _chunks(reminder_ids):
+        db.query(Reminder).filter(Reminder.id.in_(chunk)).update(
+            {Reminder.status: status}, synchronize_session=False
         )
+
+async def send_reminders_batch(reminder_ids: List[int]) -> int:
+    """Отправляет пачку напоминаний: один JOIN-запрос, пул отправителей, один UPDATE статусов."""
+    def _load(db):
+        messages, cancelled, suspended = [], [], []
+        for chunk in _chunks(reminder_ids):
+            rows = db.query(Reminder, Medicine, Analysis, User.is_active).outerjoin(
+                Medicine, and_(Reminder.reminder_type == 'medicine', Medicine.id == Reminder.item_id)
+            ).outerjoin(
+                Analysis, and_(Reminder.reminder_type == 'analysis', Analysis.id == Reminder.item_id)
+            ).outerjoin(
+                User, User.user_id == Reminder.user_id
+            ).filter(Reminder.id.in_(chunk), Reminder.status.in_(REMINDER_SENDABLE))
+            
+            for reminder, medicine, analysis, is_active in rows:
+                if reminder.reminder_type not in REMINDER_ITEM_STATUS:
+                    continue
+                if is_active is False:
+                    suspended.append(reminder.id)
+                    continue
+                item = medicine if reminder.reminder_type == 'medicine' else analysis
+                if not item or item.status != REMINDER_ITEM_STATUS[reminder.reminder_type]:
+                    cancelled.append(reminder.id)
+                    continue
+                messages.append((
+                    reminder.id, reminder.user_id, *reminder_message(reminder, item), reminder.retry_count or 0
+                ))
         
-        reminder.status = 'sent'
-        db.commit()
-        log.info(f"✅ Напоминание {reminder_id} отправлено {user_id}")
+        if cancelled or suspended:
+            set_reminders_status(db, cancelled, 'cancelled')
+            set_reminders_status(db, suspended, 'suspended')
+            db.commit()
+        return messages
+    
+    def _save_results(db):
+        set_reminders_status(db, sent, 'sent')
+        record_reminder_failures(db, failures)
+    
+    messages = await run_db(_load)
+    queue = iter(messages)
+    sent, failures = [], []
+    
+    async def _worker():
+        for reminder_id, user_id, text, keyboard, retry_count in queue:
+            try:
+                await application.bot.send_message(
+                    chat_id=user_id, text=text, reply_markup=keyboard, parse_mode=None,
+                    rate_limit_args=SendPriority.REMINDER
+                )
+                sent.append(reminder_id)
+            except Exception as e:
+                failures.append((reminder_id, retry_count, e))
+    
+    await asyncio.gather(*(_worker() for _ in range(min(REMINDER_SEND_WORKERS, len(messages)))))
+    if sent or failures:
+        await run_db(_save_results)
+    log.info(f"✅ Пачка напоминаний: отправлено {len(sent)} из {len(reminder_ids)}")
+    return len(sent)
+
+class ReminderBatcher:
+    """Копит напоминания, сработавшие в пределах одного тика, и отдает их send_reminders_batch."""
+    
+    def __init__(self, tick: float = REMINDER_BATCH_TICK):
+        self.tick = tick
+        self.batches = 0
+        self.largest = 0
+        self._pending: List[int] = []
+        self._flush: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self._draining = asyncio.Event()
+    
+    def submit(self, reminder_ids: List[int]):
+        reminders_in_flight.update(reminder_ids)
+        self._pending.extend(reminder_ids)
+        if self._flush is None:
+            # Пустой контекст: пачка не должна попасть в unit of work вызвавшей задачи
+            self._flush = asyncio.create_task(self._flush_later(), context=contextvars.Context())
+            self._inflight.add(self._flush)
+            self._flush.add_done_callback(self._inflight.discard)
+    
+    async def _flush_later(self):
+        try:
+            await asyncio.wait_for(self._draining.wait(), timeout=self.tick)
+        except asyncio.TimeoutError:
+            pass
+        reminder_ids, self._pending, self._flush = self._pending, [], None
+        self.batches += 1
+        self.largest = max(self.largest, len(reminder_ids))
+        try:
+            await send_reminders_batch(reminder_ids)
+        except Exception as e:
+            log.error(f"❌ Ошибка пакетной отправки ({len(reminder_ids)} напоминаний): {e}")
+        finally:
+            reminders_in_flight.difference_update(reminder_ids)
+    
+    async def stop(self):
+        """Отправляет накопленное, не дожидаясь тика, и ждет начатые пачки.
         
-    except Exception as e:
-        log.error(f"❌ Ошибка отправки {reminder_id}: {e}")
-    finally:
-        db.close()
+        Задачи этих напоминаний уже сработали и удалены из jobstore: если бросить
+        пачку при остановке, после запуска их никто не отправит.
+        """
+        self._draining.set()
+        while self._inflight:
+            await asyncio.gather(*list(self._inflight), return_exceptions=True)
+
+reminder_batcher = ReminderBatcher()
+
+# ============== ПОВТОРНАЯ ОТПРАВКА НАПОМИНАНИЙ ==============
+
+REMINDER_MAX_ATTEMPTS = int(os.environ.get("REMINDER_MAX_ATTEMPTS", "6"))
+REMINDER_RETRY_BASE_SECONDS = int(os.environ.get("REMINDER_RETRY_BASE_SECONDS", "30"))
+REMINDER_RETRY_MAX_SECONDS = int(os.environ.get("REMINDER_RETRY_MAX_SECONDS", "3600"))
+REMINDER_RETRY_INTERVAL = int(os.environ.get("REMINDER_RETRY_INTERVAL", "30"))
+REMINDER_RETRY_BATCH = int(os.environ.get("REMINDER_RETRY_BATCH", "500"))
+
+def reminder_retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Через сколько секунд повторить отправку; None - ошибка постоянная, повтор не поможет.
+    
+    RetryAfter - ровно столько, сколько попросил Telegram; TimedOut - короткая фиксированная
+    пауза (Telegram жив, но медленно отвечает); сетевые и прочие ошибки - экспоненциально
+    с разбросом, чтобы после сбоя напоминания не вернулись все в одну секунду.
+    """
+    if isinstance(error, RetryAfter):
+        return float(error.retry_after) + 1
+    if isinstance(error, (Forbidden, BadRequest)):
+        return None
+    if isinstance(error, TimedOut):
+        return float(REMINDER_RETRY_BASE_SECONDS)
+    delay = min(REMINDER_RETRY_MAX_SECONDS, REMINDER_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+    return delay * random.uniform(0.75, 1.25)
+
+def record_reminder_failures(db, failures: List[Tuple[int, int, Exception]]):
+    """Сохраняет неудачные попытки (reminder_id, retry_count, ошибка) одним bulk UPDATE.
+    
+    RetryAfter не считается попыткой: это ограничение Telegram, а не сбой отправки.
+    """
+    now = datetime.now(pytz.UTC)
+    mappings = []
+    for reminder_id, retry_count, error in failures:
+        attempts = retry_count if isinstance(error, RetryAfter) else retry_count + 1
+        delay = reminder_retry_delay(error, attempts)
+        row = {'id': reminder_id, 'retry_count': attempts, 'last_error': f"{type(error).__name__}: {error}"[:500]}
+        if delay is None or attempts >= REMINDER_MAX_ATTEMPTS:
+            row.update(status='failed', next_retry_at=None)
+            log.error(f"❌ Напоминание {reminder_id} не отправлено ({attempts} попыток): {error}")
+        else:
+            row.update(status='retry', next_retry_at=now + timedelta(seconds=delay))
+            log.warning(f"🔁 Напоминание {reminder_id}: повтор через {delay:.0f}s (попытка {attempts}): {error}")
+        mappings.append(row)
+    
+    if mappings:
+        db.bulk_update_mappings(Reminder, mappings)
+    
+    dead = [reminder_id for reminder_id, _, error in failures if is_dead_chat_error(error)]
+    if dead:
+        user_ids = set()
+        for chunk in _chunks(dead):
+            user_ids.update(db.execute(select(Reminder.user_id).where(Reminder.id.in_(chunk))).scalars())
+        deactivate_users(db, user_ids)
+    db.commit()
+
+async def retry_failed_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет напоминания, у которых подошло время повтора, пачками по REMINDER_RETRY_BATCH.
+    
+    Если пачка целиком не ушла (Telegram или сеть все еще недоступны), остаток ждет
+    следующего запуска, а не долбит API.
+    """
+    def _due(db):
+        return list(db.execute(
+            select(Reminder.id).where(
+                Reminder.status == 'retry',
+                Reminder.next_retry_at <= datetime.now(pytz.UTC)
+            ).order_by(Reminder.next_retry_at).limit(REMINDER_RETRY_BATCH)
+        ).scalars())
+    
+    total = 0
+    while True:
+        reminder_ids = await run_db(_due)
+        if not reminder_ids:
+            break
+        sent = await send_reminders_batch(reminder_ids)
+        total += sent
+        if not sent or len(reminder_ids) < REMINDER_RETRY_BATCH:
+            break
+    if total:
+        log.info(f"🔁 Повторно отправлено {total} напоминаний")
+
+# ============== НЕДОСТУПНЫЕ ЧАТЫ ==============
+
+# Тексты BadRequest, означающие, что чата больше нет (Forbidden - всегда)
+DEAD_CHAT_ERRORS = ('chat not found', 'user is deactivated', 'peer_id_invalid', 'bot was blocked', 'bot was kicked')
+
+def is_dead_chat_error(error: Exception) -> bool:
+    """Постоянная ошибка доставки: бот заблокирован, аккаунт удален или чата не существует."""
+    if isinstance(error, Forbidden):
+        return True
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        return any(marker in message for marker in DEAD_CHAT_ERRORS)
+    return False
+
+def deactivate_users(db, user_ids) -> int:
+    """Помечает пользователей неактивными и снимает их напоминания и задачи приема.
+    
+    Ожидающие напоминания переводятся в 'suspended' одним UPDATE на пачку, задачи
+    APScheduler удаляются одним DELETE. Коммит - за вызывающим (задачи удаляются
+    сразу, повторная регистрация все равно пересоздает их).
+    """
+    user_ids = list(set(user_ids))
+    deactivated = 0
+    job_ids = []
+    for chunk in _chunks(user_ids):
+        deactivated += db.query(User).filter(
+            User.user_id.in_(chunk), User.is_active.isnot(False)
+        ).update({User.is_active: False}, synchronize_session=False)
+        
+        reminders = db.execute(
+            select(Reminder.id, Reminder.reminder_type)
+            .where(Reminder.user_id.in_(chunk), Reminder.status.in_(REMINDER_SENDABLE))
+        ).all()
+        set_reminders_status(db, [reminder_id for reminder_id, _ in reminders], 'suspended')
+        job_ids.extend(f"{reminder_type}_{reminder_id}" for reminder_id, reminder_type in reminders)
+        
+        for medicine in db.query(Medicine).filter(Medicine.user_id.in_(chunk), Medicine.status == 'active'):
+            job_ids.extend(job_id for job_id, _, _, _ in medicine_dose_jobs(medicine))
+    
+    scheduler.delete_jobs(job_ids)
+    activity_tracker.forget(user_ids)
+    if deactivated:
+        log.warning(f"🚫 Чат недоступен у {deactivated} пользователей: напоминания приостановлены")
+    return deactivated
+
+def reactivate_user(db, user_id: int):
+    """Возвращает напоминания и задачи приема пользователю, снова написавшему боту."""
+    now = datetime.now(pytz.UTC)
+    suspended = db.query(Reminder).filter(Reminder.user_id == user_id, Reminder.status == 'suspended').all()
+    for reminder in suspended:
+        if _as_utc(reminder.scheduled_time) > now:
+            reminder.status = 'pending'
+            schedule_reminder(reminder)
+        else:
+            reminder.status = 'cancelled'
+    
+    for medicine in db.query(Medicine).filter(Medicine.user_id == user_id, Medicine.status == 'active'):
+        schedule_medicine(medicine)
+    log.info(f"♻️ Пользователь {user_id} снова активен, напоминания восстановлены")
 
+@callback_router.prefix("take_", int)
 async def medicine_take(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    med_id = int(query.data.replace("take_", ""))
+    med_id = context.args[0]
     user_id = update.effective_user.id
     
-    db = get_db()
-    try:
-        med = db.query(Medicine).filter_by(id=med_id).first()
+    def _save(db):
+        med = loader(Medicine).load(db, med_id)
+        if not med or med.user_id != user_id:
+            return None  # удалено или чужая кнопка
+        now = datetime.now(pytz.UTC)
         log_entry = MedicineLog(
             medicine_id=med_id,
             user_id=user_id,
             status='taken',
-            is_planned=True
+            is_planned=True,
+            taken_at=now
         )
         db.add(log_entry)
+        bump_daily_stats(db, user_id, now, get_user_timezone(user_id, db), medicine_status='taken')
         
         rem = db.query(Reminder).filter(
             Reminder.item_id == med_id,
@@ -2538,32 +4695,45 @@ async def medicine_take(update: Update, context: ContextTypes.DEFAULT_TYPE):
             rem.status = 'completed'
         
         db.commit()
-        
+        return med.name
+    
+    name = await run_db(_save)
+    if name is None:
         await safe_send_message(
             query,
-            f"✅ Отлично! Прием {med.name} отмечен.",
+            "❌ Лекарство не найдено",
             reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
         )
-    finally:
-        db.close()
+        return
+    
+    await safe_send_message(
+        query,
+        f"✅ Отлично! Прием {name} отмечен.",
+        reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
+    )
 
+@callback_router.prefix("skip_", int)
 async def medicine_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    med_id = int(query.data.replace("skip_", ""))
+    med_id = context.args[0]
     user_id = update.effective_user.id
     
-    db = get_db()
-    try:
-        med = db.query(Medicine).filter_by(id=med_id).first()
+    def _save(db):
+        med = loader(Medicine).load(db, med_id)
+        if not med or med.user_id != user_id:
+            return None  # удалено или чужая кнопка
+        now = datetime.now(pytz.UTC)
         log_entry = MedicineLog(
             medicine_id=med_id,
             user_id=user_id,
             status='skipped',
-            is_planned=True
+            is_planned=True,
+            taken_at=now
         )
         db.add(log_entry)
+        bump_daily_stats(db, user_id, now, get_user_timezone(user_id, db), medicine_status='skipped')
         
         rem = db.query(Reminder).filter(
             Reminder.item_id == med_id,
@@ -2574,25 +4744,35 @@ async def medicine_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
             rem.status = 'skipped'
         
         db.commit()
-        
+        return med.name
+    
+    name = await run_db(_save)
+    if name is None:
         await safe_send_message(
             query,
-            f"❌ Прием {med.name} пропущен",
+            "❌ Лекарство не найдено",
             reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
         )
-    finally:
-        db.close()
+        return
+    
+    await safe_send_message(
+        query,
+        f"❌ Прием {name} пропущен",
+        reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
+    )
 
+@callback_router.prefix("analysis_take_", int)
 async def analysis_take(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    ana_id = int(query.data.replace("analysis_take_", ""))
+    ana_id = context.args[0]
     user_id = update.effective_user.id
     
-    db = get_db()
-    try:
-        ana = db.query(Analysis).filter_by(id=ana_id).first()
+    def _save(db):
+        ana = loader(Analysis).load(db, ana_id)
+        if not ana or ana.user_id != user_id:
+            return None  # удалено или чужая кнопка
         log_entry = AnalysisLog(
             analysis_id=ana_id,
             user_id=user_id,
@@ -2600,8 +4780,7 @@ async def analysis_take(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         db.add(log_entry)
         
-        if ana:
-            ana.status = 'completed'
+        ana.status = 'completed'
         
         rem = db.query(Reminder).filter(
             Reminder.item_id == ana_id,
@@ -2612,25 +4791,35 @@ async def analysis_take(update: Update, context: ContextTypes.DEFAULT_TYPE):
             rem.status = 'completed'
         
         db.commit()
-        
+        return ana.name
+    
+    name = await run_db(_save)
+    if name is None:
         await safe_send_message(
             query,
-            f"✅ Отлично! Анализ {ana.name} отмечен.",
+            "❌ Анализ не найден",
             reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
         )
-    finally:
-        db.close()
+        return
+    
+    await safe_send_message(
+        query,
+        f"✅ Отлично! Анализ {name} отмечен.",
+        reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
+    )
 
+@callback_router.prefix("analysis_skip_", int)
 async def analysis_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    ana_id = int(query.data.replace("analysis_skip_", ""))
+    ana_id = context.args[0]
     user_id = update.effective_user.id
     
-    db = get_db()
-    try:
-        ana = db.query(Analysis).filter_by(id=ana_id).first()
+    def _save(db):
+        ana = loader(Analysis).load(db, ana_id)
+        if not ana or ana.user_id != user_id:
+            return None  # удалено или чужая кнопка
         log_entry = AnalysisLog(
             analysis_id=ana_id,
             user_id=user_id,
@@ -2638,8 +4827,7 @@ async def analysis_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         db.add(log_entry)
         
-        if ana:
-            ana.status = 'skipped'
+        ana.status = 'skipped'
         
         rem = db.query(Reminder).filter(
             Reminder.item_id == ana_id,
@@ -2650,155 +4838,178 @@ async def analysis_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
             rem.status = 'skipped'
         
         db.commit()
-        
+        return ana.name
+    
+    name = await run_db(_save)
+    if name is None:
         await safe_send_message(
             query,
-            f"❌ Анализ {ana.name} пропущен",
+            "❌ Анализ не найден",
             reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
         )
-    finally:
-        db.close()
+        return
+    
+    await safe_send_message(
+        query,
+        f"❌ Анализ {name} пропущен",
+        reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
+    )
 
 # ============== ПРОВЕРКА ЦЕЛОСТНОСТИ ==============
 
-async def integrity_check(context: ContextTypes.DEFAULT_TYPE):
-    db = get_db()
-    try:
-        now = datetime.now(pytz.UTC)
-        
-        for med in db.query(Medicine).filter(
-            Medicine.paused_until.isnot(None),
-            Medicine.paused_until <= now,
-            Medicine.status == 'active'
-        ):
-            med.paused_until = None
-            log.info(f"🔄 Возобновлено лекарство {med.id}")
-        
-        for ana in db.query(Analysis).filter(
-            Analysis.paused_until.isnot(None),
-            Analysis.paused_until <= now,
-            Analysis.status == 'pending'
-        ):
-            ana.paused_until = None
-            log.info(f"🔄 Возобновлен анализ {ana.id}")
-        
-        db.commit()
-        
-        overdue = db.query(Reminder).filter(
+INTEGRITY_INTERVAL = int(os.environ.get("INTEGRITY_INTERVAL", "60"))
+INTEGRITY_CHUNK = 1000
+# Просроченным напоминание считается только после misfire grace APScheduler (и
+# окна колеса) с запасом: до этого его еще может отправить диспетчер или очередь
+INTEGRITY_OVERDUE_GRACE = REMINDER_MISFIRE_GRACE + timedelta(minutes=5)
+# Раз в сутки проход начинается с начала: ловит pending-напоминания, появившиеся
+# задним числом ниже водяного знака
+INTEGRITY_FULL_SWEEP = timedelta(hours=24)
+INTEGRITY_WATERMARK_KEY = "integrity.reminders_watermark"
+INTEGRITY_FULL_SWEEP_KEY = "integrity.full_sweep_at"
+
+def get_app_state(db, key: str) -> Optional[str]:
+    return db.execute(select(AppState.value).where(AppState.key == key)).scalar()
+
+def set_app_state(db, key: str, value: Optional[str]):
+    stmt = sqlite_insert(AppState).values(key=key, value=value, updated_at=datetime.now(pytz.UTC))
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[AppState.key],
+        set_={"value": stmt.excluded.value, "updated_at": stmt.excluded.updated_at}
+    ))
+
+class IntegrityStats:
+    def __init__(self):
+        self.runs = 0
+        self.touched = defaultdict(int)
+        self.last_touched: Dict[str, int] = {}
+        self.last_duration = 0.0
+    
+    def record(self, touched: Dict[str, int], duration: float):
+        self.runs += 1
+        self.last_touched = touched
+        self.last_duration = duration
+        for key, count in touched.items():
+            self.touched[key] += count
+    
+    def summary(self) -> str:
+        return (f"{self.runs} проходов, последний {self.last_duration * 1000:.0f}мс; возобновлено лекарств "
+                f"{self.touched['medicines']}, анализов {self.touched['analyses']}, "
+                f"просрочено напоминаний {self.touched['reminders']}")
+
+integrity_stats = IntegrityStats()
+
+def _resume_paused(db, model, status: str, now: datetime) -> int:
+    """Снимает истекшие паузы UPDATE-ами по INTEGRITY_CHUNK строк, коммитя каждый."""
+    touched = 0
+    while True:
+        chunk = select(model.id).where(
+            model.paused_until.isnot(None),
+            model.paused_until <= now,
+            model.status == status
+        ).limit(INTEGRITY_CHUNK)
+        count = db.query(model).filter(model.id.in_(chunk)).update(
+            {model.paused_until: None}, synchronize_session=False
+        )
+        if count:
+            db.commit()
+        touched += count
+        if count < INTEGRITY_CHUNK:
+            return touched
+
+def _fail_overdue_reminders(db, now: datetime, inflight: frozenset = frozenset()) -> int:
+    """Помечает просроченные pending-напоминания от водяного знака до now - INTEGRITY_OVERDUE_GRACE.
+    
+    Водяной знак - scheduled_time, до которого все уже проверено; он
+    сохраняется в app_state вместе с каждой пачкой, так что прерванный проход
+    продолжится с места остановки. Напоминания из inflight (ждут пачки или
+    отправки) пропускаются, и водяной знак за первое из них не сдвигается.
+    """
+    cutoff = now - INTEGRITY_OVERDUE_GRACE
+    full_sweep_at = get_app_state(db, INTEGRITY_FULL_SWEEP_KEY)
+    watermark = get_app_state(db, INTEGRITY_WATERMARK_KEY)
+    if not full_sweep_at or datetime.fromisoformat(full_sweep_at) <= now - INTEGRITY_FULL_SWEEP:
+        watermark = None
+        set_app_state(db, INTEGRITY_FULL_SWEEP_KEY, now.isoformat())
+    since = datetime.fromisoformat(watermark) if watermark else None
+    
+    touched = 0
+    held = None  # scheduled_time первого пропущенного напоминания в работе
+    last = None  # (scheduled_time, id) последней просмотренной строки
+    while True:
+        # Ключ (scheduled_time, id): пропущенные строки остаются 'pending', и без
+        # id проход зациклился бы на них при одинаковом времени
+        stmt = select(Reminder.id, Reminder.scheduled_time).where(
             Reminder.status == 'pending',
-            Reminder.scheduled_time <= now
-        ).all()
+            Reminder.scheduled_time <= cutoff
+        )
+        if last is not None:
+            stmt = stmt.where(or_(
+                Reminder.scheduled_time > last[0],
+                and_(Reminder.scheduled_time == last[0], Reminder.id > last[1])
+            ))
+        elif since is not None:
+            stmt = stmt.where(Reminder.scheduled_time >= since)
+        rows = db.execute(stmt.order_by(Reminder.scheduled_time, Reminder.id).limit(INTEGRITY_CHUNK)).all()
         
-        for rem in overdue:
-            rem.status = 'failed'
-            rem.last_error = 'Overdue'
-            log.warning(f"⚠️ Просроченное напоминание {rem.id}")
+        overdue = [reminder_id for reminder_id, _ in rows if reminder_id not in inflight]
+        if held is None and len(overdue) < len(rows):
+            held = next(_as_utc(scheduled_time) for reminder_id, scheduled_time in rows if reminder_id in inflight)
+        if overdue:
+            db.query(Reminder).filter(Reminder.id.in_(overdue)).update(
+                {Reminder.status: 'failed', Reminder.last_error: 'Overdue'}, synchronize_session=False
+            )
+            touched += len(overdue)
+        if rows:
+            last = (rows[-1][1], rows[-1][0])
         
+        done = len(rows) < INTEGRITY_CHUNK
+        watermark = held or (cutoff if done else _as_utc(last[0]))
+        set_app_state(db, INTEGRITY_WATERMARK_KEY, watermark.isoformat())
         db.commit()
-        
-    finally:
-        db.close()
+        if done:
+            return touched
+
+@with_unit_of_work
+async def integrity_check(context: ContextTypes.DEFAULT_TYPE):
+    inflight = frozenset(reminders_in_flight)
+    
+    def _check(db):
+        now = datetime.now(pytz.UTC)
+        return {
+            "medicines": _resume_paused(db, Medicine, 'active', now),
+            "analyses": _resume_paused(db, Analysis, 'pending', now),
+            "reminders": _fail_overdue_reminders(db, now, inflight),
+        }
+    
+    started = time.perf_counter()
+    touched = await run_db(_check)
+    integrity_stats.record(touched, time.perf_counter() - started)
+    if touched["medicines"] or touched["analyses"]:
+        log.info(f"🔄 Паузы сняты: лекарств {touched['medicines']}, анализов {touched['analyses']}")
+    if touched["reminders"]:
+        log.warning(f"⚠️ Просроченных напоминаний: {touched['reminders']}")
 
 # ============== ОБРАБОТЧИК КНОПОК ==============
 
+@callback_router.exact("phone_kit", "phone_family")
+async def phone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    clinic = KIT_CLINIC if query.data == "phone_kit" else FAMILY_CLINIC
+    title = "КИТ-клиники" if query.data == "phone_kit" else "Семейной клиники"
+    await context.bot.send_message(
+        chat_id=update.effective_user.id,
+        text=f"📞 Телефон {title}: {clinic['phone_display']}\n\nНажмите на номер: {clinic['phone']}",
+        reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
+    )
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data
     
     try:
-        if data == "start":
-            await start_callback(update, context)
-        elif data == "help":
-            await help_command(update, context)
-        elif data == "about":
-            await about_command(update, context)
-        elif data == "stats":
-            await stats_command(update, context)
-        elif data.startswith("stats_"):
-            await stats_callback(update, context)
-        elif data == "add_medicine":
-            await add_medicine_start(update, context)
-        elif data == "add_analysis":
-            await add_analysis_start(update, context)
-        elif data == "list_medicines":
-            await list_medicines(update, context)
-        elif data == "list_analyses":
-            await list_analyses(update, context)
-        elif data.startswith("delete_medicine_"):
-            await delete_medicine(update, context)
-        elif data.startswith("delete_analysis_"):
-            await delete_analysis(update, context)
-        elif data == "mood":
-            await mood_command(update, context)
-        elif data.startswith("mood_"):
-            await mood_callback(update, context)
-        elif data.startswith("take_"):
-            await medicine_take(update, context)
-        elif data.startswith("skip_"):
-            await medicine_skip(update, context)
-        elif data.startswith("analysis_take_"):
-            await analysis_take(update, context)
-        elif data.startswith("analysis_skip_"):
-            await analysis_skip(update, context)
-        elif data == "admin_panel":
-            await admin_command(update, context)
-        elif data == "admin_stats":
-            await admin_stats_callback(update, context)
-        elif data == "admin_users":
-            await admin_users_callback(update, context)
-        elif data == "admin_users_list":
-            await admin_users_list_callback(update, context)
-        elif data == "admin_logs":
-            await admin_logs_callback(update, context)
-        elif data == "admin_logs_errors":
-            await admin_logs_errors_callback(update, context)
-        elif data == "admin_backups":
-            await admin_backups_callback(update, context)
-        elif data == "admin_backup_create":
-            await admin_backup_create_callback(update, context)
-        elif data == "admin_backup_list":
-            await admin_backup_list_callback(update, context)
-        elif data == "phone_kit":
-            await query.answer()
-            await context.bot.send_message(
-                chat_id=update.effective_user.id,
-                text=f"📞 Телефон КИТ-клиники: {KIT_CLINIC['phone_display']}\n\nНажмите на номер: {KIT_CLINIC['phone']}",
-                reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
-            )
-        elif data == "phone_family":
-            await query.answer()
-            await context.bot.send_message(
-                chat_id=update.effective_user.id,
-                text=f"📞 Телефон Семейной клиники: {FAMILY_CLINIC['phone_display']}\n\nНажмите на номер: {FAMILY_CLINIC['phone']}",
-                reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
-            )
-        elif data.startswith("times_"):
-            await add_medicine_times_per_day(update, context)
-        elif data in ["reminder_minutes", "reminder_hours"]:
-            await add_medicine_reminder_unit(update, context)
-        elif data.startswith("med_remind_"):
-            await add_medicine_reminder_value(update, context)
-        elif data.startswith("ana_remind_"):
-            await add_analysis_reminder_value(update, context)
-        elif data.startswith("med_hour_"):
-            await add_medicine_hour(update, context)
-        elif data.startswith("med_minute_"):
-            await add_medicine_minute(update, context)
-        elif data.startswith("ana_hour_"):
-            await add_analysis_hour(update, context)
-        elif data.startswith("ana_minute_"):
-            await add_analysis_minute(update, context)
-        elif data == "confirm_medicine":
-            await add_medicine_confirm(update, context)
-        elif data == "confirm_analysis":
-            await add_analysis_confirm(update, context)
-        elif data.startswith("analysis_date_"):
-            await add_analysis_date(update, context)
-        elif data == "analysis_date_custom":
-            await add_analysis_date(update, context)
-        elif data == "analysis_date_back":
-            await add_analysis_date(update, context)
-        else:
+        if not await callback_router.dispatch(update, context):
             await query.answer("⚙️ Функция в разработке")
             
     except Exception as e:
@@ -2809,6 +5020,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup([get_main_menu_button()])
         )
 
+@callback_router.exact("start")
 async def start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -2832,18 +5044,352 @@ async def start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ============== ПЛАНОВЫЕ ЗАДАЧИ ==============
 
 async def scheduled_backup(context: ContextTypes.DEFAULT_TYPE):
-    backup_manager.create_backup("auto")
+    await backup_manager.create_backup("auto")
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    error = context.error
+    user = update.effective_user if isinstance(update, Update) else None
+    log.error(f"❌ Необработанная ошибка: {error}", update=update if isinstance(update, Update) else None, exc_info=error)
+    if error_notifier:
+        error_notifier.notify(
+            type(error).__name__, str(error),
+            user_id=user.id if user else None,
+            traceback="".join(traceback.format_exception(error))
+        )
+
+# ============== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА UPDATES ==============
+
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "8"))
+UPDATE_MAX_PENDING = int(os.environ.get("UPDATE_MAX_PENDING", "1024"))
+
+def update_lane_key(update: object) -> Optional[int]:
+    """Ключ очереди update: пользователь, а для updates без пользователя - чат."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+# (UpdateLanes, [слот занят]) у задачи, которая сейчас обрабатывает update
+_lane_slot: contextvars.ContextVar = contextvars.ContextVar("update_lane_slot", default=None)
+
+class UpdateLanes:
+    """Updates разных пользователей обрабатываются параллельно, одного - строго по порядку.
+    
+    PTB с concurrent_updates запускает каждый update отдельной задачей в порядке
+    получения. Задача сначала встает в очередь своего пользователя (asyncio.Lock
+    будит ожидающих по очереди), и только первая в очереди занимает один из
+    concurrency слотов: updates пользователя, у которого что-то уже
+    обрабатывается, слоты не держат и остальных не тормозят. На время ожидания
+    отправки в Telegram (waiting) слот тоже отдается.
+    """
+    
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self.depth: Dict[int, int] = {}
+        self.active = 0
+        self.peak_active = 0
+        self.processed = 0
+        self.max_depth = 0
+    
+    @asynccontextmanager
+    async def _slot(self):
+        await self._slots.acquire()
+        held = [True]
+        token = _lane_slot.set((self, held))
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            yield
+        finally:
+            _lane_slot.reset(token)
+            if held[0]:
+                self.active -= 1
+                self._slots.release()
+            self.processed += 1
+    
+    @asynccontextmanager
+    async def waiting(self):
+        """Отдает слот текущего update на время ожидания отправки в Telegram.
+        
+        Очередь пользователя (его Lock) остается за update, поэтому порядок
+        сохраняется, а слот тем временем обрабатывает updates других пользователей.
+        """
+        current = _lane_slot.get()
+        if current is None or current[0] is not self or not current[1][0]:
+            yield
+            return
+        held = current[1]
+        held[0] = False
+        self.active -= 1
+        self._slots.release()
+        try:
+            yield
+        finally:
+            await self._slots.acquire()
+            held[0] = True
+            self.active += 1
+    
+    @asynccontextmanager
+    async def lane(self, update: object):
+        key = update_lane_key(update)
+        if key is None:
+            async with self._slot():
+                yield
+            return
+        
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self.depth[key] = self.depth.get(key, 0) + 1
+        self.max_depth = max(self.max_depth, self.depth[key])
+        try:
+            async with lock:
+                async with self._slot():
+                    yield
+        finally:
+            self.depth[key] -= 1
+            if not self.depth[key]:
+                del self.depth[key]
+                del self._locks[key]
+    
+    def summary(self) -> str:
+        text = (f"до {self.concurrency} параллельно, сейчас {self.active} (пик {self.peak_active}), "
+                f"обработано {self.processed}; в очередях {sum(self.depth.values())} "
+                f"от {len(self.depth)} польз., макс. глубина {self.max_depth}")
+        busiest = sorted(
+            ((key, depth) for key, depth in self.depth.items() if depth > 1),
+            key=lambda item: item[1], reverse=True
+        )[:5]
+        if busiest:
+            text += "\n" + ", ".join(f"{key}: {depth}" for key, depth in busiest)
+        return text
+
+update_lanes = UpdateLanes(UPDATE_CONCURRENCY)
+
+# ============== ХРАНЕНИЕ СОСТОЯНИЯ ДИАЛОГОВ ==============
+
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", "30"))
+
+def _encode_state_value(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} нельзя сохранить в user_data")
+
+def _decode_state_object(obj: dict):
+    if len(obj) == 1 and "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+def dump_state(value) -> str:
+    return json.dumps(value, default=_encode_state_value, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+def load_state(raw: str):
+    return json.loads(raw, object_hook=_decode_state_object)
+
+def conversation_owner(key: Tuple[int, ...]) -> int:
+    """Пользователь диалога: ключ ConversationHandler (per_chat, per_user) - (chat_id, user_id)."""
+    return key[1] if len(key) > 1 else key[0]
+
+class SQLitePersistence(BasePersistence):
+    """Состояния диалогов и user_data в основной БД, строкой на ключ.
+    
+    При старте ничего не читается: данные пользователя и его незавершенные
+    диалоги подгружаются одним запросом при первом его update (load_user).
+    PTB раз в update_interval отдает измененные ключи - они копятся в памяти, а
+    write_pending пишет только те, что действительно изменились, одной транзакцией.
+    """
+    
+    def __init__(self, update_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._loaded: set = set()
+        self._stored_user_data: Dict[int, str] = {}
+        self._pending_user_data: Dict[int, Optional[str]] = {}
+        self._pending_conversations: Dict[Tuple[str, str], Tuple[int, Optional[int]]] = {}
+        self._write_lock = asyncio.Lock()
+        self.loads = 0
+        self.flushes = 0
+        self.rows_written = 0
+    
+    async def load_user(self, application: Application, user_id: int):
+        if user_id in self._loaded:
+            return
+        
+        def _load(db):
+            row = db.get(UserData, user_id)
+            states = db.query(ConversationState).filter(ConversationState.user_id == user_id).all()
+            return row.data if row else None, [(s.name, s.conversation_key, s.state) for s in states]
+        
+        data, states = await run_db(_load)
+        self._loaded.add(user_id)
+        self.loads += 1
+        if data is not None:
+            self._stored_user_data[user_id] = data
+            application.user_data[user_id].update(load_state(data))
+        conversations = application._conversation_handler_conversations
+        for name, key, state in states:
+            if name in conversations:
+                conversations[name].update_no_track({tuple(json.loads(key)): state})
+    
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}
+    
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+    
+    async def get_bot_data(self) -> dict:
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+    
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        self._pending_conversations[(name, json.dumps(list(key)))] = (conversation_owner(key), new_state)
+    
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        encoded = dump_state(data) if data else None
+        if encoded != self._stored_user_data.get(user_id):
+            self._pending_user_data[user_id] = encoded
+        else:
+            self._pending_user_data.pop(user_id, None)
+    
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_user_data[user_id] = None
+    
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+    
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+    
+    async def update_callback_data(self, data) -> None:
+        pass
+    
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+    
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+    
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+    
+    async def write_pending(self) -> int:
+        """Пишет накопленные изменения одной транзакцией, возвращает число строк."""
+        async with self._write_lock:
+            user_data, self._pending_user_data = self._pending_user_data, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            if not user_data and not conversations:
+                return 0
+            
+            def _write(db):
+                now = datetime.now(pytz.UTC)
+                upserts = [{"user_id": uid, "data": data, "updated_at": now}
+                           for uid, data in user_data.items() if data is not None]
+                if upserts:
+                    stmt = sqlite_insert(UserData)
+                    db.execute(stmt.on_conflict_do_update(
+                        index_elements=[UserData.user_id],
+                        set_={"data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at}
+                    ), upserts)
+                dropped = [uid for uid, data in user_data.items() if data is None]
+                if dropped:
+                    db.query(UserData).filter(UserData.user_id.in_(dropped)).delete(synchronize_session=False)
+                
+                states = [{"name": name, "conversation_key": key, "user_id": owner, "state": state, "updated_at": now}
+                          for (name, key), (owner, state) in conversations.items() if state is not None]
+                if states:
+                    stmt = sqlite_insert(ConversationState)
+                    db.execute(stmt.on_conflict_do_update(
+                        index_elements=[ConversationState.name, ConversationState.conversation_key],
+                        set_={"state": stmt.excluded.state, "updated_at": stmt.excluded.updated_at}
+                    ), states)
+                ended = defaultdict(list)
+                for (name, key), (owner, state) in conversations.items():
+                    if state is None:
+                        ended[name].append(key)
+                for name, keys in ended.items():
+                    db.query(ConversationState).filter(
+                        ConversationState.name == name, ConversationState.conversation_key.in_(keys)
+                    ).delete(synchronize_session=False)
+                db.commit()
+            
+            try:
+                await run_db(_write)
+            except Exception as e:
+                # Вернуть в очередь то, что не перезаписано более свежими изменениями
+                for uid, data in user_data.items():
+                    self._pending_user_data.setdefault(uid, data)
+                for key, value in conversations.items():
+                    self._pending_conversations.setdefault(key, value)
+                log.error(f"❌ Ошибка сохранения состояния диалогов: {e}")
+                return 0
+            
+            for uid, data in user_data.items():
+                if data is None:
+                    self._stored_user_data.pop(uid, None)
+                else:
+                    self._stored_user_data[uid] = data
+            self.flushes += 1
+            self.rows_written += len(user_data) + len(conversations)
+            return len(user_data) + len(conversations)
+    
+    async def flush(self) -> None:
+        await self.write_pending()
+
+persistence = SQLitePersistence()
 
 # ============== СОЗДАНИЕ ПРИЛОЖЕНИЯ ==============
 
+class BotApplication(Application):
+    """Application, обрабатывающий каждый update в очереди его пользователя и в собственном unit of work."""
+    
+    async def process_update(self, update: object) -> None:
+        async with update_lanes.lane(update):
+            async with unit_of_work("update"):
+                if isinstance(self.persistence, SQLitePersistence) and isinstance(update, Update) and update.effective_user:
+                    await self.persistence.load_user(self, update.effective_user.id)
+                await super().process_update(update)
+    
+    async def update_persistence(self) -> None:
+        await super().update_persistence()
+        if isinstance(self.persistence, SQLitePersistence):
+            await self.persistence.write_pending()
+
 def create_application():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .application_class(BotApplication)
+        .rate_limiter(TelegramRateLimiter(outbound_queue))
+        .persistence(persistence)
+    )
+    if UPDATE_CONCURRENCY > 1:
+        # Семафор PTB ограничивает только число ждущих задач, параллельность - UpdateLanes
+        builder = builder.concurrent_updates(max(UPDATE_MAX_PENDING, UPDATE_CONCURRENCY))
+    app = builder.build()
     app.scheduler = scheduler.scheduler
     
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("about", about_command))
     app.add_handler(CommandHandler("admin", admin_command))
+    app.add_handler(CommandHandler("backfill_stats", admin_backfill_stats_command))
     
     medicine_conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(add_medicine_start, pattern="^add_medicine$")],
@@ -2863,7 +5409,8 @@ def create_application():
             MEDICINE_CONFIRM: [CallbackQueryHandler(add_medicine_confirm, pattern="^confirm_medicine$")],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        name="add_medicine"
+        name="add_medicine",
+        persistent=True
     )
     
     analysis_conv = ConversationHandler(
@@ -2884,14 +5431,34 @@ def create_application():
             ANALYSIS_CONFIRM: [CallbackQueryHandler(add_analysis_confirm, pattern="^confirm_analysis$")],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        name="add_analysis"
+        name="add_analysis",
+        persistent=True
+    )
+    
+    broadcast_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(admin_broadcast_start, pattern="^admin_broadcast$")],
+        states={
+            ADMIN_BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_message)],
+            ADMIN_BROADCAST_CONFIRM: [CallbackQueryHandler(admin_broadcast_confirm, pattern="^broadcast_(send_|cancel)")],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="admin_broadcast",
+        persistent=True
     )
     
     app.add_handler(medicine_conv)
     app.add_handler(analysis_conv)
+    app.add_handler(broadcast_conv)
     app.add_handler(CallbackQueryHandler(button_callback))
+    app.add_error_handler(error_handler)
     
-    app.job_queue.run_repeating(integrity_check, interval=3600, first=10, name="integrity")
+    app.job_queue.run_repeating(integrity_check, interval=INTEGRITY_INTERVAL, first=10, name="integrity")
+    app.job_queue.run_repeating(
+        retry_failed_reminders, interval=REMINDER_RETRY_INTERVAL, first=REMINDER_RETRY_INTERVAL, name="reminder_retries"
+    )
+    app.job_queue.run_repeating(
+        flush_activity, interval=ACTIVITY_FLUSH_INTERVAL, first=ACTIVITY_FLUSH_INTERVAL, name="activity_flush"
+    )
     app.job_queue.run_daily(scheduled_backup, time=datetime.strptime("03:00", "%H:%M").time(), name="daily_backup")
     
     return app
@@ -2911,10 +5478,169 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     return ConversationHandler.END
 
+# ============== WEBHOOK ==============
+
+# polling - getUpdates в цикле (как было); webhook - Telegram сам присылает updates на встроенный HTTP-сервер
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_INFLIGHT = int(os.environ.get("WEBHOOK_MAX_INFLIGHT", "100"))
+WEBHOOK_ACCEPT_TIMEOUT = float(os.environ.get("WEBHOOK_ACCEPT_TIMEOUT", "10"))
+# Сколько keep-alive соединение может молчать (или слать запрос по кусочку), прежде чем его закроют
+WEBHOOK_IDLE_TIMEOUT = float(os.environ.get("WEBHOOK_IDLE_TIMEOUT", "60"))
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+class WebhookServer:
+    """Встроенный HTTP/1.1-сервер для webhook-режима на asyncio.start_server.
+    
+    Принимает только POST на path с верным X-Telegram-Bot-Api-Secret-Token. Update
+    обрабатывается в отдельной задаче, а ответ 200 уходит сразу после того, как для
+    него нашлось место: одновременно обрабатывается не больше max_inflight updates.
+    Когда мест нет, запрос ждет до WEBHOOK_ACCEPT_TIMEOUT, потом получает 503 и
+    Telegram повторит его сам, так что очередь не копится в памяти бота. Соединение,
+    которое молчит дольше WEBHOOK_IDLE_TIMEOUT, закрывается.
+    """
+    
+    def __init__(self, app: Application, host: str, port: int, path: str, secret_token: str,
+                 max_inflight: int = WEBHOOK_MAX_INFLIGHT):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token.encode()
+        self.max_inflight = max_inflight
+        self.received = 0
+        self.rejected = 0
+        self.inflight = 0
+        self.peak_inflight = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._tasks: set = set()
+    
+    async def start(self):
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        log.info(f"🌐 Webhook-сервер слушает {self.host}:{self.port}{self.path}")
+    
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=WEBHOOK_ACCEPT_TIMEOUT)
+    
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=WEBHOOK_IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                request_line, *header_lines = head.decode('latin-1').rstrip("\r\n").split("\r\n")
+                method, target, version = (request_line.split(" ", 2) + ["", ""])[:3]
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                
+                length = int(headers.get('content-length') or 0)
+                if length > WEBHOOK_MAX_BODY:
+                    await self._respond(writer, 413, keep_alive=False)
+                    break
+                try:
+                    body = await asyncio.wait_for(reader.readexactly(length), timeout=WEBHOOK_IDLE_TIMEOUT) if length else b""
+                except asyncio.TimeoutError:
+                    break
+                
+                status = await self._handle(method, target, headers, body)
+                keep_alive = version == "HTTP/1.1" and headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, keep_alive: bool = True):
+        reason = HTTPStatus(status).phrase
+        connection = "keep-alive" if keep_alive else "close"
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\nConnection: {connection}\r\n\r\n".encode())
+        await writer.drain()
+    
+    async def _handle(self, method: str, target: str, headers: dict, body: bytes) -> int:
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if not self._authorized(headers.get('x-telegram-bot-api-secret-token', '')):
+            log.warning("🌐 Webhook: запрос с неверным secret token")
+            return 403
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except Exception as e:
+            log.warning(f"🌐 Webhook: некорректный update: {e}")
+            return 400
+        
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=WEBHOOK_ACCEPT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return 503
+        
+        self.received += 1
+        self.inflight += 1
+        self.peak_inflight = max(self.peak_inflight, self.inflight)
+        task = asyncio.create_task(self._process(update), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return 200
+    
+    def _authorized(self, token: str) -> bool:
+        # Заголовки декодированы как latin-1: обратное кодирование дает исходные байты,
+        # а compare_digest на str с не-ASCII символами бросает TypeError
+        try:
+            return hmac.compare_digest(token.encode('latin-1'), self.secret_token)
+        except Exception:
+            return False
+    
+    async def _process(self, update: Update):
+        try:
+            await self.app.process_update(update)
+        except Exception as e:
+            log.error(f"❌ Webhook: ошибка обработки update {update.update_id}: {e}")
+        finally:
+            self.inflight -= 1
+            self._slots.release()
+
+webhook_server: Optional[WebhookServer] = None
+
+async def start_webhook(app: Application) -> WebhookServer:
+    """Поднимает встроенный сервер и регистрирует webhook в Telegram."""
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    path = urlsplit(WEBHOOK_URL).path or "/"
+    server = WebhookServer(app, WEBHOOK_LISTEN, WEBHOOK_PORT, path, secret)
+    await server.start()
+    await bot_api.call(
+        "setWebhook",
+        url=WEBHOOK_URL,
+        secret_token=secret,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=min(100, WEBHOOK_MAX_INFLIGHT)
+    )
+    log.info(f"🌐 Webhook зарегистрирован: {WEBHOOK_URL}")
+    return server
+
 # ============== ЗАПУСК ==============
 
 async def main():
-    global application, error_notifier
+    global application, error_notifier, webhook_server
     
     print("🚀 Запуск ЛОР-Помощника...")
     print(f"📊 Версия: 12.0.0 (Улучшенная)")
@@ -2923,25 +5649,29 @@ async def main():
     print(f"📁 Логи: {LOG_DIR}")
     print("-" * 50)
     
-    print("🔄 Отключаем webhook...")
-    import requests
-    try:
-        r = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook")
-        print(f"✅ Webhook отключен: {r.json()}")
-    except Exception as e:
-        print(f"⚠️ Ошибка: {e}")
+    if BOT_MODE == 'polling':
+        print("🔄 Отключаем webhook...")
+        try:
+            result = await bot_api.call("deleteWebhook")
+            print(f"✅ Webhook отключен: {result}")
+        except Exception as e:
+            print(f"⚠️ Ошибка: {e}")
     
     if ADMIN_CHAT_ID:
-        error_notifier = ErrorNotifier(BOT_TOKEN, ADMIN_CHAT_ID)
+        error_notifier = ErrorNotifier(bot_api, ADMIN_CHAT_ID)
         await error_notifier.start()
     
     application = create_application()
     
     scheduler.start()
     await scheduler.restore_reminders()
+    await scheduler.restore_medicine_schedules()
+    if REMINDER_DISPATCHER == 'wheel':
+        await reminder_wheel.start()
     
     if DB_PATH.exists():
-        backup_manager.create_backup("auto")
+        # Стартовый бэкап идет в фоне: бот начинает отвечать, не дожидаясь сжатия
+        asyncio.create_task(backup_manager.create_backup("auto"))
     
     print("✅ Бот запущен и готов к работе!")
     print("📝 Логи пишутся в /app/logs")
@@ -2949,7 +5679,13 @@ async def main():
     
     await application.initialize()
     await application.start()
-    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        webhook_server = await start_webhook(application)
+    else:
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    await broadcast_engine.resume()
+    if daily_stats_backfill_pending:
+        asyncio.create_task(run_daily_stats_backfill())
     
     try:
         while True:
@@ -2957,13 +5693,23 @@ async def main():
     except KeyboardInterrupt:
         print("\n🛑 Бот остановлен")
     finally:
-        await application.updater.stop()
+        if webhook_server:
+            await webhook_server.stop()
+        if application.updater.running:
+            await application.updater.stop()
         await application.stop()
-        await application.shutdown()
+        await reminder_wheel.stop()
         if scheduler:
             scheduler.shutdown()
+        # До application.shutdown: пачке нужны бот и очередь отправки
+        await reminder_batcher.stop()
+        await application.shutdown()
+        await activity_tracker.flush()
+        await backup_manager.close()
+        db_executor.shutdown(wait=True)
         if error_notifier:
             await error_notifier.stop()
+        await bot_api.close()
         log.info("SHUTDOWN - Бот остановлен")
 
 if __name__ == "__main__":
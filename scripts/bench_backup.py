@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк бэкапа под нагрузкой: старый способ (checkpoint + copy2 + gzip прямо
+в event loop) против BackupManager.create_backup (backup API шагами в потоках).
+
+Основная БД раздувается до SIZE_MB мегабайт. Пока снимается бэкап, в event
+loop крутится "тикер" (меряет, на сколько опаздывает asyncio.sleep), а
+писатель каждые WRITE_EVERY секунд вставляет строку через run_db и меряет
+время записи. Новая копия распаковывается и проверяется integrity_check;
+строк в ней должно быть не меньше, чем было до начала бэкапа.
+
+Запуск: python scripts/bench_backup.py [размер БД в МБ]
+"""
+
+import asyncio
+import gzip
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+SIZE_MB = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+ROW_BYTES = 4000
+TICK = 0.01
+WRITE_EVERY = 0.02
+
+
+def fill_database():
+    conn = sqlite3.connect(str(bot.DB_PATH))
+    conn.execute("CREATE TABLE IF NOT EXISTS bench_blob (id INTEGER PRIMARY KEY, v BLOB)")
+    rows = SIZE_MB * 1024 * 1024 // ROW_BYTES
+    for start in range(0, rows, 10000):
+        # Наполовину случайные данные: сжимаются, но не в ноль
+        conn.executemany("INSERT INTO bench_blob (v) VALUES (?)",
+                         [(os.urandom(ROW_BYTES // 2) + bytes(ROW_BYTES // 2),) for _ in range(min(10000, rows - start))])
+        conn.commit()
+    conn.close()
+
+
+def insert_row(db):
+    db.execute(bot.text("INSERT INTO bench_blob (v) VALUES (:v)"), {"v": os.urandom(100)})
+    db.commit()
+
+
+def count_rows(path):
+    conn = sqlite3.connect(str(path))
+    try:
+        return conn.execute("SELECT count(*) FROM bench_blob").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def legacy_backup(backup_dir):
+    """BackupManager.create_backup до перехода на backup API (синхронно, gzip level 9)."""
+    backup_dir.mkdir()
+    for src in (bot.DB_PATH, bot.JOBS_DB_PATH):
+        if not src.exists():
+            continue
+        conn = sqlite3.connect(str(src), timeout=5)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+        dst = backup_dir / src.name
+        shutil.copy2(src, dst)
+        with open(dst, 'rb') as f_in:
+            with gzip.open(dst.with_suffix('.db.gz'), 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        dst.unlink()
+
+
+async def under_load(label, backup):
+    lags, writes = [], []
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            before = time.monotonic()
+            await asyncio.sleep(TICK)
+            lags.append(time.monotonic() - before - TICK)
+
+    async def writer():
+        while not stop.is_set():
+            before = time.monotonic()
+            await bot.run_db(insert_row)
+            writes.append(time.monotonic() - before)
+            await asyncio.sleep(WRITE_EVERY)
+
+    tasks = [asyncio.create_task(ticker()), asyncio.create_task(writer())]
+    await asyncio.sleep(0.2)
+    started = time.monotonic()
+    result = await backup()
+    elapsed = time.monotonic() - started
+    stop.set()
+    await asyncio.gather(*tasks)
+
+    lags.sort()
+    writes.sort()
+    print(f"  {label}: {elapsed:.1f}s, лаг event loop p50 {lags[len(lags) // 2] * 1000:.1f}ms "
+          f"макс. {lags[-1] * 1000:.0f}ms; запись p50 {writes[len(writes) // 2] * 1000:.1f}ms "
+          f"макс. {writes[-1] * 1000:.0f}ms ({len(writes)} записей)")
+    return result
+
+
+async def main():
+    fill_database()
+    print(f"💾 БД {bot.DB_PATH.stat().st_size / 1024 / 1024:.0f}MB, шаг {bot.BACKUP_STEP_PAGES} страниц, "
+          f"пауза {bot.BACKUP_STEP_PAUSE * 1000:g}ms, gzip {bot.BACKUP_COMPRESS_LEVEL}")
+
+    async def legacy():
+        legacy_backup(bot.BACKUP_DIR / "legacy")
+
+    await under_load("copy2 + gzip в event loop", legacy)
+
+    rows_before = count_rows(bot.DB_PATH)
+    backup_path = await under_load("backup API в потоках", lambda: bot.backup_manager.create_backup("manual"))
+    assert backup_path, "Бэкап не создан"
+
+    restored = TMP / "restored.db"
+    with gzip.open(backup_path / "lor_reminder.db.gz", 'rb') as f_in:
+        with open(restored, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    conn = sqlite3.connect(str(restored))
+    check = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    conn.close()
+    rows = count_rows(restored)
+    assert check == "ok", check
+    assert rows >= rows_before, (rows, rows_before)
+    print(f"  копия: integrity_check {check}, строк {rows} (до бэкапа {rows_before}, сейчас {count_rows(bot.DB_PATH)})")
+
+    await bot.backup_manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
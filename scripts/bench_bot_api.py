@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк служебных вызовов Bot API (уведомления админу, deleteWebhook).
+
+Поднимает локальную заглушку Bot API (отвечает на любой метод с задержкой
+DELAY) и направляет на нее бота через TELEGRAM_API_URL. Отправляет N
+уведомлений старым способом (requests.post внутри корутины) и через общий
+BotApiClient, параллельно измеряя задержку event loop тикером 10ms и число
+TCP-соединений, которые увидела заглушка.
+
+Запуск: python scripts/bench_bot_api.py [уведомлений]
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+
+NOTIFICATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+DELAY = 0.05
+connections = set()
+
+
+class StubBotApi(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(DELAY)
+        body = json.dumps({"ok": True, "result": True}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StubBotApi)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{server.server_port}"
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+
+async def measure(name, send):
+    connections.clear()
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(NOTIFICATIONS)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await tick
+    print(f"  {name}: {elapsed:.2f}s, макс. задержка loop {max(lags) * 1000:.0f}ms, "
+          f"TCP-соединений {len(connections)}")
+
+
+async def main():
+    print(f"📡 Заглушка Bot API: {bot.TELEGRAM_API_URL}, ответ {DELAY * 1000:.0f}ms, "
+          f"{NOTIFICATIONS} уведомлений")
+
+    try:
+        import requests
+    except ImportError:
+        requests = None
+
+    if requests:
+        async def legacy(i):
+            requests.post(
+                f"{bot.TELEGRAM_API_URL}/bot{bot.BOT_TOKEN}/sendMessage",
+                json={"chat_id": 1, "text": f"alert {i}"}, timeout=5
+            )
+
+        await measure("requests.post", legacy)
+
+    async def pooled(i):
+        await bot.bot_api.call("sendMessage", chat_id=1, text=f"alert {i}")
+
+    await measure("BotApiClient", pooled)
+    await bot.bot_api.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк рассылки на большой таблице users.
+
+Заполняет users N активными пользователями (у каждого десятого - активное
+лекарство) и гоняет BroadcastEngine с фейковым ботом без лимитов Telegram:
+рассылка прерывается на середине (как при перезапуске), затем продолжается
+через resume(). Проверяется, что каждый получатель получил сообщение,
+повторно ушло не больше одной страницы, а память не растет с числом
+пользователей.
+
+Запуск: python scripts/bench_broadcast.py [пользователей]
+"""
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+ADMIN_ID = 10 ** 9
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = Counter()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0.001)
+        self.sent[chat_id] += 1
+
+
+def fill_users():
+    conn = sqlite3.connect(str(bot.DB_PATH))
+    conn.execute(
+        "INSERT INTO users (user_id, is_active, is_banned, is_admin, registered_at, total_interactions) "
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+        "SELECT i, 1, 0, 0, datetime('now'), 0 FROM n",
+        (USERS,)
+    )
+    conn.execute(
+        "INSERT INTO medicines (user_id, name, times_per_day, schedule, user_timezone, status, start_date) "
+        "SELECT user_id, 'Витамин', 1, '09:00', 'Europe/Moscow', 'active', datetime('now') FROM users WHERE user_id % 10 = 0"
+    )
+    conn.commit()
+    conn.close()
+
+
+async def wait_progress(broadcast_id, processed):
+    while True:
+        entry = await bot.run_db(lambda db: db.query(bot.BroadcastLog).get(broadcast_id))
+        if entry.success + entry.failed >= processed:
+            return
+        await asyncio.sleep(0.05)
+
+
+async def main():
+    print(f"📁 Временные данные: {TMP}")
+    fill_users()
+    print(f"👥 Пользователей: {USERS}, страница {bot.BROADCAST_PAGE_SIZE}")
+
+    fake = FakeBot()
+    bot.application = SimpleNamespace(bot=fake)
+    engine = bot.BroadcastEngine()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    broadcast_id, total = await engine.create(ADMIN_ID, "Тестовая рассылка", "all")
+
+    # "Перезапуск" на середине: задача отменяется, в БД остается status='running'
+    await wait_progress(broadcast_id, total // 2)
+    for task in list(engine._tasks.values()):
+        task.cancel()
+    await asyncio.sleep(0.1)
+    interrupted = sum(count for chat_id, count in fake.sent.items() if chat_id != ADMIN_ID)
+
+    engine = bot.BroadcastEngine()
+    resumed = await engine.resume()
+    while engine._tasks:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    entry = await bot.run_db(lambda db: db.query(bot.BroadcastLog).get(broadcast_id))
+    recipients = {chat_id: count for chat_id, count in fake.sent.items() if chat_id != ADMIN_ID}
+    duplicates = sum(count - 1 for count in recipients.values())
+    print(f"  прервана после {interrupted} сообщений, возобновлено рассылок: {resumed}")
+    print(f"  итог: {entry.status}, доставлено {entry.success}/{entry.total}, ошибок {entry.failed}, "
+          f"за {elapsed:.1f}s")
+    print(f"  получателей {len(recipients)} из {USERS}, повторов {duplicates} "
+          f"(допустимо до {bot.BROADCAST_PAGE_SIZE}), отчет админу: {fake.sent[ADMIN_ID]}")
+    print(f"  пик памяти: {peak / 1024 / 1024:.1f} МБ")
+
+    segment = await bot.run_db(lambda db: db.execute(
+        bot.select(bot.func.count()).select_from(bot.broadcast_recipients("medicines").subquery())
+    ).scalar())
+    print(f"  сегмент 'medicines': {segment} получателей")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк маршрутизации кнопок: цепочка if/elif против CallbackRouter.
+
+Прогоняет все callback_data, которые сейчас генерирует бот (точные ключи и
+по одному примеру на каждый префикс), через старую цепочку из button_callback
+(воспроизведена ниже, возвращает имя обработчика) и через
+callback_router.resolve. Проверяет, что обработчики совпадают, и печатает
+среднюю и худшую стоимость разбора одного нажатия.
+
+Запуск: python scripts/bench_callback_router.py [повторов]
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+CALLBACK_DATA = [
+    "start", "help", "about", "stats", "stats_week", "stats_month", "stats_all", "stats_mood",
+    "stats_symptoms", "stats_medicine", "add_medicine", "add_analysis", "list_medicines",
+    "list_analyses", "delete_medicine_1234", "delete_analysis_1234", "mood", "mood_1", "mood_5",
+    "take_1234", "skip_1234", "analysis_take_1234", "analysis_skip_1234", "admin_panel",
+    "admin_stats", "admin_users", "admin_users_list", "admin_logs", "admin_logs_errors",
+    "admin_backups", "admin_backup_create", "admin_backup_list", "phone_kit", "phone_family",
+    "times_1", "times_custom", "reminder_minutes", "reminder_hours", "med_remind_15",
+    "med_remind_2h", "ana_remind_custom_h", "med_hour_08", "med_minute_08_30", "ana_hour_10",
+    "ana_minute_10_45", "confirm_medicine", "confirm_analysis", "analysis_date_2026-10-18",
+    "analysis_date_custom", "extra_medicine", "tz_Europe/Moscow",
+]
+
+
+def legacy_route(data):
+    """Цепочка из button_callback до CallbackRouter (порядок проверок сохранен)."""
+    if data == "start":
+        return "start_callback"
+    elif data == "help":
+        return "help_command"
+    elif data == "about":
+        return "about_command"
+    elif data == "stats":
+        return "stats_command"
+    elif data.startswith("stats_"):
+        return "stats_callback"
+    elif data == "add_medicine":
+        return "add_medicine_start"
+    elif data == "add_analysis":
+        return "add_analysis_start"
+    elif data == "list_medicines":
+        return "list_medicines"
+    elif data == "list_analyses":
+        return "list_analyses"
+    elif data.startswith("delete_medicine_"):
+        return "delete_medicine"
+    elif data.startswith("delete_analysis_"):
+        return "delete_analysis"
+    elif data == "mood":
+        return "mood_command"
+    elif data.startswith("mood_"):
+        return "mood_callback"
+    elif data.startswith("take_"):
+        return "medicine_take"
+    elif data.startswith("skip_"):
+        return "medicine_skip"
+    elif data.startswith("analysis_take_"):
+        return "analysis_take"
+    elif data.startswith("analysis_skip_"):
+        return "analysis_skip"
+    elif data == "admin_panel":
+        return "admin_command"
+    elif data == "admin_stats":
+        return "admin_stats_callback"
+    elif data == "admin_users":
+        return "admin_users_callback"
+    elif data == "admin_users_list":
+        return "admin_users_list_callback"
+    elif data == "admin_logs":
+        return "admin_logs_callback"
+    elif data == "admin_logs_errors":
+        return "admin_logs_errors_callback"
+    elif data == "admin_backups":
+        return "admin_backups_callback"
+    elif data == "admin_backup_create":
+        return "admin_backup_create_callback"
+    elif data == "admin_backup_list":
+        return "admin_backup_list_callback"
+    elif data == "phone_kit":
+        return "phone_callback"
+    elif data == "phone_family":
+        return "phone_callback"
+    elif data.startswith("times_"):
+        return "add_medicine_times_per_day"
+    elif data in ["reminder_minutes", "reminder_hours"]:
+        return "add_medicine_reminder_unit"
+    elif data.startswith("med_remind_"):
+        return "add_medicine_reminder_value"
+    elif data.startswith("ana_remind_"):
+        return "add_analysis_reminder_value"
+    elif data.startswith("med_hour_"):
+        return "add_medicine_hour"
+    elif data.startswith("med_minute_"):
+        return "add_medicine_minute"
+    elif data.startswith("ana_hour_"):
+        return "add_analysis_hour"
+    elif data.startswith("ana_minute_"):
+        return "add_analysis_minute"
+    elif data == "confirm_medicine":
+        return "add_medicine_confirm"
+    elif data == "confirm_analysis":
+        return "add_analysis_confirm"
+    elif data.startswith("analysis_date_"):
+        return "add_analysis_date"
+    return None
+
+
+def router_route(data):
+    route = bot.callback_router.resolve(data)
+    return route[0].__name__ if route else None
+
+
+def measure(fn, data):
+    return min(timeit.repeat(lambda: fn(data), number=ROUNDS, repeat=5)) / ROUNDS * 1e9
+
+
+def main():
+    mismatched = [d for d in CALLBACK_DATA if legacy_route(d) != router_route(d)]
+    assert not mismatched, f"Маршруты расходятся: {mismatched}"
+
+    legacy = {d: measure(legacy_route, d) for d in CALLBACK_DATA}
+    router = {d: measure(bot.callback_router.resolve, d) for d in CALLBACK_DATA}
+    worst_legacy = max(legacy, key=legacy.get)
+    worst_router = max(router, key=router.get)
+
+    print(f"🔀 {len(CALLBACK_DATA)} видов callback_data, лучший из 5 прогонов по {ROUNDS}, маршруты совпадают")
+    print(f"  if/elif: в среднем {sum(legacy.values()) / len(legacy):.0f}ns, "
+          f"худший {legacy[worst_legacy]:.0f}ns ({worst_legacy})")
+    print(f"  router:  в среднем {sum(router.values()) / len(router):.0f}ns, "
+          f"худший {router[worst_router]:.0f}ns ({worst_router})")
+
+
+if __name__ == "__main__":
+    main()
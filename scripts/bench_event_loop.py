@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк задержки event loop при массовом добавлении лекарств.
+
+Запускает N одновременных "пользователей", каждый из которых проходит
+add_medicine_confirm, и параллельно измеряет, насколько опаздывает
+пробуждение event loop (lag). Сравниваются два режима:
+  inline   - работа с БД прямо в event loop (старое поведение)
+  executor - работа с БД через run_db в пуле потоков
+
+Запуск: python scripts/bench_event_loop.py [кол-во пользователей]
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+TICK = 0.005
+
+
+class FakeQuery:
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, *args, **kwargs):
+        await asyncio.sleep(0.01)
+
+
+def fake_update(user_id: int):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, username=f"u{user_id}", first_name="Bench"),
+        callback_query=FakeQuery(),
+    )
+
+
+def fake_context():
+    return SimpleNamespace(user_data={
+        'medicine': {
+            'name': 'Бенчмарк',
+            'times_per_day': 3,
+            'schedule': '08:00,14:00,20:00',
+            'times': ['08:00', '14:00', '20:00'],
+            'reminder_minutes': 15,
+        }
+    })
+
+
+async def measure_lag(samples: list, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + TICK
+        await asyncio.sleep(TICK)
+        samples.append(max(0.0, loop.time() - expected) * 1000)
+
+
+async def run_mode(mode: str, base_user: int):
+    original = bot.run_blocking
+    if mode == "inline":
+        async def inline(func, *args, **kwargs):
+            return func(*args, **kwargs)
+        bot.run_blocking = inline
+
+    samples = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(measure_lag(samples, stop))
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            bot.add_medicine_confirm(fake_update(base_user + i), fake_context())
+            for i in range(USERS)
+        ))
+    finally:
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await monitor
+        bot.run_blocking = original
+
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99) - 1] if samples else 0.0
+    print(
+        f"{mode:>8}: {USERS} пользователей за {elapsed:.2f}s | "
+        f"lag mean {statistics.mean(samples or [0]):.1f}ms, "
+        f"p99 {p99:.1f}ms, max {max(samples or [0]):.1f}ms"
+    )
+
+
+async def main():
+    print(f"📁 Временные данные: {TMP}")
+    await run_mode("inline", 1_000_000)
+    await run_mode("executor", 2_000_000)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
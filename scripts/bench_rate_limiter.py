@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк лимитера исходящих сообщений на реальных лимитах Telegram.
+
+Все сообщения ставятся в очередь одновременно и проходят через
+TelegramRateLimiter.process_request и OutboundQueue, как запросы application.bot:
+  - PRIVATE_CHATS личных чатов по 2 сообщения,
+  - один "горячий" чат с HOT сообщениями подряд,
+  - две группы по 26 сообщений (лимит 20 в минуту, поэтому прогон ~1.5 минуты).
+По фактическим временам отправки проверяется, что глобальный лимит выбран
+полностью, но ни один лимит не превышен ни в одном скользящем окне.
+Для сравнения старый RateLimiter (семафор без release) гоняется 5 секунд.
+
+Запуск: python scripts/bench_rate_limiter.py [личных чатов]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+PRIVATE_CHATS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+HOT = 15
+GROUPS = (-1001, -1002)
+GROUP_MESSAGES = 26
+
+
+class LegacyRateLimiter:
+    def __init__(self, global_rate: int = 30, per_user_rate: int = 1):
+        self.global_semaphore = asyncio.Semaphore(global_rate)
+        self.per_user_rate = per_user_rate
+        self.user_last_message = defaultdict(float)
+
+    async def acquire(self, user_id=None):
+        await self.global_semaphore.acquire()
+        if user_id:
+            now = time.time()
+            last = self.user_last_message[user_id]
+            if now - last < self.per_user_rate:
+                await asyncio.sleep(self.per_user_rate - (now - last))
+            self.user_last_message[user_id] = now
+
+
+def max_in_window(times: list, window: float) -> int:
+    best, i = 0, 0
+    for j, t in enumerate(times):
+        while t - times[i] >= window:
+            i += 1
+        best = max(best, j - i + 1)
+    return best
+
+
+def workload() -> list:
+    chats = [chat_id for chat_id in range(1, PRIVATE_CHATS + 1) for _ in range(2)]
+    chats += [999_999] * HOT
+    chats += [group for group in GROUPS for _ in range(GROUP_MESSAGES)]
+    return chats
+
+
+async def run_new():
+    limiter = bot.RateLimiter()
+    queue = bot.OutboundQueue(limiter)
+    queue.start()
+    ptb_limiter = bot.TelegramRateLimiter(queue)
+    sent = defaultdict(list)
+
+    async def send(chat_id):
+        sent[chat_id].append(time.monotonic())
+        return True
+
+    async def request(chat_id):
+        await ptb_limiter.process_request(send, (chat_id,), {}, "sendMessage", {"chat_id": chat_id}, None)
+
+    chats = workload()
+    started = time.monotonic()
+    await asyncio.gather(*(request(chat_id) for chat_id in chats))
+    elapsed = time.monotonic() - started
+    await queue.stop()
+
+    all_times = sorted(t for times in sent.values() for t in times)
+    private_end = max(t for chat_id, times in sent.items() if 0 < chat_id <= PRIVATE_CHATS for t in times)
+    private_span = private_end - started
+    busy = sum(1 for t in all_times if t <= private_end)
+    min_gap = min(
+        b - a for chat_id, times in sent.items() if chat_id > 0
+        for a, b in zip(times, times[1:])
+    )
+    group_max = max(max_in_window(sent[group], 60.0) for group in GROUPS)
+
+    print(f"  новый: {len(all_times)} сообщений за {elapsed:.1f}s")
+    print(f"    глобально: макс. {max_in_window(all_times, 1.0)} в любом окне 1s "
+          f"(лимит {bot.TELEGRAM_GLOBAL_RATE:g}), пока были личные чаты - "
+          f"{busy / private_span:.1f} сообщ./с")
+    print(f"    в один чат: мин. интервал {min_gap:.3f}s (лимит {1 / bot.TELEGRAM_CHAT_RATE:.3f}s)")
+    print(f"    в группу: макс. {group_max} в любом окне 60s (лимит {bot.TELEGRAM_GROUP_RATE:g})")
+    print(f"    среднее ожидание {limiter.waited / limiter.acquired:.2f}s, макс. {limiter.max_wait:.1f}s")
+    print(f"    очередь: {queue.stats.summary()}")
+
+
+async def run_legacy(seconds: float = 5.0):
+    limiter = LegacyRateLimiter()
+    sent = 0
+
+    async def request(chat_id):
+        nonlocal sent
+        await limiter.acquire(chat_id)
+        sent += 1
+
+    tasks = [asyncio.create_task(request(chat_id)) for chat_id in workload()]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    print(f"  старый: {sent} сообщений за {seconds:.0f}s, остальные {len(tasks) - sent} ждут вечно")
+
+
+async def main():
+    print(f"📨 {len(workload())} сообщений: {PRIVATE_CHATS} личных чатов, горячий чат, {len(GROUPS)} группы")
+    await run_legacy()
+    await run_new()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк отправки напоминаний, сработавших в одну секунду (08:00 / 20:00).
+
+Сравнивает два режима на фейковом боте (send_message спит FAKE_SEND_MS):
+  single - send_reminder на каждое напоминание
+  batch  - send_reminders_batch на всю пачку
+Rate limiter отключен: замеряется только работа бота, а не лимиты Telegram.
+
+Запуск: python scripts/bench_reminder_batch.py [напоминаний] [задержка отправки, мс]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+import pytz  # noqa: E402
+
+REMINDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+FAKE_SEND_MS = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+USERS = 2000
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, **kwargs):
+        await asyncio.sleep(FAKE_SEND_MS / 1000)
+        self.sent += 1
+
+
+def seed(db, item_offset: int) -> list:
+    now = datetime.now(pytz.UTC)
+    for user_id in range(1, USERS + 1):
+        db.add(bot.Medicine(
+            id=item_offset + user_id, user_id=user_id, name=f"Лекарство {user_id}",
+            schedule="08:00", user_timezone="Europe/Moscow", status="active"
+        ))
+    reminders = [
+        bot.Reminder(
+            user_id=1 + i % USERS, reminder_type="medicine", item_id=item_offset + 1 + i % USERS,
+            scheduled_time=now, user_timezone="Europe/Moscow"
+        )
+        for i in range(REMINDERS)
+    ]
+    db.add_all(reminders)
+    db.commit()
+    return [r.id for r in reminders]
+
+
+async def run_mode(mode: str, item_offset: int):
+    fake = FakeBot()
+    bot.application = SimpleNamespace(bot=fake)
+    ids = await bot.run_db(seed, item_offset)
+
+    started = time.perf_counter()
+    if mode == "single":
+        await asyncio.gather(*(bot.send_reminder(reminder_id) for reminder_id in ids))
+    else:
+        await bot.send_reminders_batch(ids)
+    elapsed = time.perf_counter() - started
+
+    def _sent(db):
+        return db.query(bot.Reminder).filter(bot.Reminder.id >= ids[0], bot.Reminder.status == "sent").count()
+    marked = await bot.run_db(_sent)
+    print(f"{mode:>7}: {len(ids)} напоминаний за {elapsed:.2f}s ({len(ids) / elapsed:.0f}/с) | "
+          f"отправлено {fake.sent}, помечено sent {marked}")
+
+
+async def main():
+    print(f"📁 Временные данные: {TMP}")
+
+    async def no_limit(*args, **kwargs):
+        pass
+
+    bot.rate_limiter.acquire = no_limit
+    await run_mode("single", 0)
+    await run_mode("batch", USERS)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
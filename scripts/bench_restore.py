@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк перезапуска: restore_reminders() при заполненном jobstore.
+
+Заполняет reminders N pending-напоминаниями в будущем, один раз заполняет
+jobstore (как после первого запуска) и затем сравнивает повторный запуск:
+  legacy      - remove_job + add_job(replace_existing=True) на каждое напоминание
+  incremental - сверка ID с jobstore, пишутся только различия
+
+Запуск: python scripts/bench_restore.py [кол-во напоминаний]
+"""
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+os.environ["REMINDER_DISPATCHER"] = "apscheduler"
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+import pytz  # noqa: E402
+from datetime import datetime  # noqa: E402
+
+REMINDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+
+def fill_reminders():
+    conn = sqlite3.connect(str(bot.DB_PATH))
+    conn.execute(
+        "INSERT INTO reminders (user_id, reminder_type, item_id, scheduled_time, user_timezone, status, retry_count) "
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+        "SELECT i % 50000, 'analysis', i, "
+        "strftime('%Y-%m-%d %H:%M:%f000', 'now', '+1 day', '+' || i || ' seconds'), "
+        "'Europe/Moscow', 'pending', 0 FROM n",
+        (REMINDERS,)
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_restore(db):
+    now = datetime.now(pytz.UTC)
+    pending = db.query(bot.Reminder).filter(
+        bot.Reminder.status == 'pending',
+        bot.Reminder.scheduled_time > now
+    ).all()
+    for reminder in pending:
+        job_id = f"{reminder.reminder_type}_{reminder.id}"
+        try:
+            bot.scheduler.scheduler.remove_job(job_id)
+        except bot.JobLookupError:
+            pass
+        bot.scheduler.scheduler.add_job(
+            bot.send_reminder_job,
+            trigger=bot.DateTrigger(run_date=reminder.scheduled_time),
+            id=job_id,
+            args=[reminder.id],
+            replace_existing=True
+        )
+    return len(pending)
+
+
+async def timed(label: str, coro):
+    started = time.perf_counter()
+    await coro
+    print(f"  {label}: {time.perf_counter() - started:.2f}s")
+
+
+async def main():
+    print(f"📁 Временные данные: {TMP}")
+    fill_reminders()
+    print(f"📦 pending-напоминаний: {REMINDERS}")
+    bot.scheduler.start()
+    await timed("первый запуск, пустой jobstore", bot.scheduler.restore_reminders())
+    await timed("перезапуск, incremental", bot.scheduler.restore_reminders())
+    await timed("перезапуск, legacy     ", bot.run_db(legacy_restore))
+    bot.scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк конкуренции за SQLite: записи send_reminder вперемешку
+с чтениями stats_callback.
+
+Каждый профиль запускается в отдельном процессе с чистой БД:
+  legacy - журнал DELETE, synchronous FULL, таймаут pysqlite 5s (как было)
+  tuned  - профиль по умолчанию (WAL, busy_timeout, synchronous NORMAL, mmap)
+
+Запуск: python scripts/bench_sqlite_contention.py [напоминаний] [чтений]
+"""
+
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+PROFILES = {
+    "legacy": {
+        "SQLITE_JOURNAL_MODE": "DELETE",
+        "SQLITE_SYNCHRONOUS": "FULL",
+        "SQLITE_BUSY_TIMEOUT_MS": "5000",
+        "SQLITE_MMAP_SIZE": "0",
+        "SQLITE_CACHE_SIZE": "-2000",
+    },
+    "tuned": {},
+}
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.total = 0
+        self.locked = 0
+
+    def emit(self, record):
+        self.total += 1
+        if "locked" in record.getMessage():
+            self.locked += 1
+
+
+async def run_profile(reminders: int, reads: int):
+    import bot
+    import pytz
+
+    counter = ErrorCounter()
+    logging.getLogger().addHandler(counter)
+
+    async def fake_send(**kwargs):
+        await asyncio.sleep(0.001)
+
+    bot.application = SimpleNamespace(bot=SimpleNamespace(send_message=fake_send))
+
+    async def no_limit(*args, **kwargs):
+        pass
+
+    bot.rate_limiter.acquire = no_limit
+
+    db = bot.SessionLocal()
+    now = datetime.now(pytz.UTC)
+    users = 200
+    for user_id in range(1, users + 1):
+        db.add(bot.Medicine(
+            id=user_id, user_id=user_id, name=f"Лекарство {user_id}", schedule="08:00",
+            user_timezone="Europe/Moscow", status="active"
+        ))
+        for day in range(30):
+            db.add(bot.MoodLog(user_id=user_id, mood_score=1 + day % 5, created_at=now - timedelta(days=day)))
+    for i in range(reminders):
+        user_id = 1 + i % users
+        db.add(bot.Reminder(
+            user_id=user_id, reminder_type="medicine", item_id=user_id,
+            scheduled_time=now, user_timezone="Europe/Moscow"
+        ))
+    db.commit()
+    ids = [r.id for r in db.query(bot.Reminder.id)]
+    db.close()
+
+    class Query:
+        def __init__(self, data):
+            self.data = data
+
+        async def answer(self, *args, **kwargs):
+            pass
+
+        async def edit_message_text(self, *args, **kwargs):
+            pass
+
+    async def read(i):
+        update = SimpleNamespace(
+            effective_user=SimpleNamespace(id=1 + i % users),
+            callback_query=Query(("stats_week", "stats_all", "stats_mood")[i % 3]),
+        )
+        await bot.stats_callback(update, None)
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(bot.send_reminder(reminder_id) for reminder_id in ids),
+        *(read(i) for i in range(reads)),
+    )
+    elapsed = time.perf_counter() - started
+
+    db = bot.SessionLocal()
+    sent = db.query(bot.Reminder).filter(bot.Reminder.status == "sent").count()
+    db.close()
+
+    ops = len(ids) + reads
+    print(
+        f"{os.environ['BENCH_PROFILE']:>7}: {ops} операций за {elapsed:.2f}s "
+        f"({ops / elapsed:.0f} оп/с) | отправлено {sent}/{len(ids)} | "
+        f"ошибок {counter.total}, из них 'database is locked': {counter.locked}"
+    )
+
+
+def main():
+    reminders = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    if os.environ.get("BENCH_PROFILE"):
+        asyncio.run(run_profile(reminders, reads))
+        return
+
+    for name, overrides in PROFILES.items():
+        tmp = Path(tempfile.mkdtemp(prefix=f"lor_bench_{name}_"))
+        env = dict(os.environ, BENCH_PROFILE=name, LOG_LEVEL="WARNING", ADMIN_CHAT_ID="", **overrides)
+        for var in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+            env[var] = str(tmp / var.lower())
+        result = subprocess.run(
+            [sys.executable, __file__, str(reminders), str(reads)],
+            env=env, capture_output=True, text=True
+        )
+        lines = [l for l in result.stdout.splitlines() if l.lstrip().startswith(name)]
+        print("\n".join(lines) or result.stderr[-2000:])
+
+
+if __name__ == "__main__":
+    main()
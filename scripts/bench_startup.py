@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк проверки схемы при старте на большой БД.
+
+Строит БД заданного размера (по умолчанию 1 ГБ, в основном mood_logs) и
+сравнивает старый путь запуска (create_all + inspect/get_columns по пяти
+таблицам) с версионированным migrate_database() на актуальной схеме.
+Каждый замер делается на новом engine, т.е. с холодным пулом соединений.
+
+Запуск: python scripts/bench_startup.py [размер в МБ] [повторов]
+"""
+
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+SIZE_MB = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+ROW_BYTES = 1024
+
+
+def fill_database():
+    rows = SIZE_MB * 1024 * 1024 // ROW_BYTES
+    conn = sqlite3.connect(str(bot.DB_PATH))
+    conn.execute(
+        "INSERT INTO mood_logs (user_id, mood_score, comment, created_at) "
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+        "SELECT i % 5000, 1 + i % 5, hex(randomblob(?)), datetime('now') FROM n",
+        (rows, ROW_BYTES // 2)
+    )
+    conn.commit()
+    conn.close()
+    return bot.DB_PATH.stat().st_size / 1024 / 1024
+
+
+def legacy_startup(target_engine):
+    bot.Base.metadata.create_all(bind=target_engine)
+    inspector = bot.inspect(target_engine)
+    tables = inspector.get_table_names()
+    for table in ('medicines', 'analyses', 'reminders', 'medicine_logs', 'users'):
+        if table in tables:
+            [c['name'] for c in inspector.get_columns(table)]
+
+
+def versioned_startup(target_engine):
+    original = bot.engine
+    bot.engine = target_engine
+    try:
+        bot.migrate_database()
+    finally:
+        bot.engine = original
+
+
+def measure(fn):
+    timings = []
+    for _ in range(ROUNDS):
+        target_engine = bot.create_sqlite_engine(bot.DATABASE_URL)
+        started = time.perf_counter()
+        fn(target_engine)
+        timings.append((time.perf_counter() - started) * 1000)
+        target_engine.dispose()
+    return statistics.median(timings)
+
+
+def main():
+    print(f"📁 Временные данные: {TMP}")
+    size = fill_database()
+    print(f"📦 Размер БД: {size:.0f} МБ")
+    legacy = measure(legacy_startup)
+    versioned = measure(versioned_startup)
+    print(f"  legacy (create_all + inspect): {legacy:.1f}ms")
+    print(f"  versioned (schema_version):    {versioned:.1f}ms")
+    print(f"  экономия: {legacy - versioned:.1f}ms на запуск")
+
+
+if __name__ == "__main__":
+    main()
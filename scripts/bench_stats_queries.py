@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк времени экранов статистики.
+
+Для пользователей с историей разного размера (записи настроения и приемы
+разных лекарств) открывает каждый экран stats_* внутри unit of work REPEATS
+раз и печатает медиану времени и число SQL-запросов. Постоянство числа
+запросов проверяет tests/test_stats_queries.py.
+
+Запуск: python scripts/bench_stats_queries.py [записей через запятую]
+"""
+
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+HISTORY = tuple(int(n) for n in sys.argv[1].split(",")) if len(sys.argv) > 1 else (10, 100, 1000, 10000)
+REPEATS = 20
+SCREENS = ("stats_week", "stats_month", "stats_all", "stats_mood", "stats_symptoms", "stats_medicine")
+
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.text = None
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, *args, **kwargs):
+        self.text = text
+
+
+def fill_history(user_id, entries):
+    """entries записей каждого журнала; приемы идут по entries разным лекарствам (не больше 10)."""
+    now = time.time()
+    conn = sqlite3.connect(str(bot.DB_PATH))
+    conn.executemany(
+        "INSERT INTO medicines (user_id, name, times_per_day, schedule, user_timezone, status, start_date) "
+        "VALUES (?, ?, 1, '09:00', 'Europe/Moscow', 'active', datetime('now'))",
+        [(user_id, f"Лекарство {i}") for i in range(min(entries, 10))]
+    )
+    medicine_ids = [row[0] for row in conn.execute("SELECT id FROM medicines WHERE user_id = ?", (user_id,))]
+    conn.executemany(
+        "INSERT INTO medicine_logs (medicine_id, user_id, status, is_planned, taken_at) "
+        "VALUES (?, ?, 'taken', 1, datetime(?, 'unixepoch'))",
+        [(medicine_ids[i % len(medicine_ids)], user_id, now - i * 3600) for i in range(entries)]
+    )
+    conn.executemany(
+        "INSERT INTO mood_logs (user_id, mood_score, created_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+        [(user_id, 1 + i % 5, now - i * 3600) for i in range(entries)]
+    )
+    conn.executemany(
+        "INSERT INTO symptom_logs (user_id, symptom, severity, created_at) VALUES (?, 'кашель', ?, datetime(?, 'unixepoch'))",
+        [(user_id, 1 + i % 5, now - i * 3600) for i in range(entries)]
+    )
+    conn.commit()
+    conn.close()
+
+
+async def open_screen(user_id, screen):
+    query = FakeQuery(screen)
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=user_id))
+    started = time.perf_counter()
+    async with bot.unit_of_work(screen) as uow:
+        await bot.stats_callback(update, SimpleNamespace())
+    elapsed = time.perf_counter() - started
+    assert query.text and "Ошибка" not in query.text, query.text
+    return elapsed, uow.queries
+
+
+async def main():
+    for user_id, entries in enumerate(HISTORY, start=1):
+        fill_history(user_id, entries)
+    await bot.run_daily_stats_backfill()
+
+    results = {screen: [] for screen in SCREENS}
+    for user_id, entries in enumerate(HISTORY, start=1):
+        # Первый экран прогревает кэш часового пояса пользователя
+        await open_screen(user_id, "stats")
+        for screen in SCREENS:
+            runs = [await open_screen(user_id, screen) for _ in range(REPEATS)]
+            results[screen].append((statistics.median(t for t, _ in runs), runs[-1][1]))
+
+    print(f"⏱ Медиана {REPEATS} открытий экрана при истории {', '.join(map(str, HISTORY))} записей:")
+    for screen, values in results.items():
+        print(f"  {screen}: " + ", ".join(f"{t * 1000:.2f}ms ({q} SQL)" for t, q in values))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
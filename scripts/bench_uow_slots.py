@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк задержки updates во время волны напоминаний.
+
+REMINDERS напоминаний срабатывают разом и идут через настоящий
+send_reminder_job (REMINDER_SEND_MODE=single): фаза БД, отправка через
+application.bot и outbound_queue с лимитами Telegram, еще одна фаза БД.
+Bot API - заглушка с задержкой RTT. Пока волна отправляется, приходят
+updates с частотой RATE: каждый в своем unit of work читает пользователя
+через run_db, как обработчики бота. Печатается задержка update до конца
+этой фазы БД, то есть время ожидания слота _uow_slots.
+
+Сравниваются два режима unit of work:
+  - слот на весь unit of work (как было): соединение и слот _uow_slots
+    держатся и пока задача ждет отправки в Telegram;
+  - слот на фазу БД (сейчас): между фазами соединение возвращается в пул.
+
+Запуск: python scripts/bench_uow_slots.py [напоминаний] [updates в секунду]
+"""
+
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+os.environ["REMINDER_SEND_MODE"] = "single"
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+import pytz  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+REMINDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+RATE = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+RTT = 0.02
+DURATION = 10
+
+
+class StubRequest(BaseRequest):
+    """Bot API без сети: каждый запрос отвечает через RTT."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        await asyncio.sleep(RTT)
+        params = request_data.parameters if request_data else {}
+        if url.endswith("/getMe"):
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif "chat_id" in params:
+            result = {"message_id": 1, "date": int(time.time()),
+                      "chat": {"id": int(params["chat_id"]), "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def fill_reminders(first_user):
+    now = datetime.now(pytz.UTC)
+    db = bot.SessionLocal()
+    try:
+        medicines = []
+        for user_id in range(first_user, first_user + REMINDERS):
+            db.add(bot.User(user_id=user_id, first_name="U"))
+            medicine = bot.Medicine(user_id=user_id, name="Лекарство", times_per_day=1, schedule="09:00",
+                                    user_timezone="Europe/Moscow", status="active", start_date=now)
+            db.add(medicine)
+            medicines.append(medicine)
+        db.flush()
+        reminders = [bot.Reminder(user_id=m.user_id, reminder_type="medicine", item_id=m.id,
+                                  scheduled_time=now, user_timezone="Europe/Moscow") for m in medicines]
+        db.add_all(reminders)
+        db.commit()
+        return [r.id for r in reminders]
+    finally:
+        db.close()
+
+
+def percentiles(values):
+    values = sorted(values)
+    return (f"p50 {statistics.median(values) * 1000:.0f}ms p95 {values[int(len(values) * 0.95)] * 1000:.0f}ms "
+            f"max {values[-1] * 1000:.0f}ms")
+
+
+async def run(label, first_user):
+    reminder_ids = fill_reminders(first_user)
+    queue = bot.OutboundQueue(bot.RateLimiter())
+    app = (
+        bot.ApplicationBuilder()
+        .token(bot.BOT_TOKEN)
+        .request(StubRequest())
+        .rate_limiter(bot.TelegramRateLimiter(queue))
+        .build()
+    )
+    await app.initialize()
+    bot.application = app
+    latencies = []
+
+    async def handle_update(user_id):
+        created = time.monotonic()
+        async with bot.unit_of_work("update"):
+            await bot.run_db(lambda db: db.query(bot.User).filter_by(user_id=user_id).first())
+            latencies.append(time.monotonic() - created)
+
+    started = time.monotonic()
+    burst = [asyncio.create_task(bot.send_reminder_job(reminder_id)) for reminder_id in reminder_ids]
+    updates = []
+    for i in range(1, int(DURATION * RATE) + 1):
+        updates.append(asyncio.create_task(handle_update(first_user + i % REMINDERS)))
+        await asyncio.sleep(max(0.0, started + i / RATE - time.monotonic()))
+    await asyncio.gather(*updates)
+    await asyncio.gather(*burst)
+    elapsed = time.monotonic() - started
+    await app.shutdown()
+
+    print(f"  {label}: волна {elapsed:.1f}s, отправлено {queue.stats.sent[bot.SendPriority.REMINDER]} напоминаний; "
+          f"update до конца фазы БД {percentiles(latencies)}")
+
+
+async def main():
+    slots = bot.DB_POOL_SIZE + bot.DB_MAX_OVERFLOW - bot.DB_WORKERS
+    print(f"⏰ {REMINDERS} напоминаний разом, {RATE:g} updates/s в течение {DURATION}s, RTT {RTT * 1000:.0f}ms, "
+          f"слотов unit of work {slots}")
+
+    end_phase = bot.UnitOfWork._end_phase
+    bot.UnitOfWork._end_phase = lambda self: None  # соединение и слот держатся до finish
+    await run("слот на весь unit of work", 100_000)
+    bot.UnitOfWork._end_phase = end_phase
+    await run("слот на фазу БД", 200_000)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
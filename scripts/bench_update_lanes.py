@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк обработки updates: последовательно (как PTB по умолчанию) против
+UpdateLanes (параллельно по пользователям, по порядку внутри пользователя).
+
+Updates приходят с постоянной частотой от USERS пользователей; каждый
+HEAVY_EVERY-й - от "тяжелого" пользователя, его update обрабатывается SLOW секунд (как
+stats_callback на большой истории), у остальных - WORK. Затем обработчик отвечает
+через context.bot: запрос идет через TelegramRateLimiter и OutboundQueue с лимитами
+Telegram в заглушку Bot API с задержкой RTT. Тяжелый пользователь пишет чаще, чем
+позволяет лимит в один чат, и его ответы копятся в очереди. В начале прогона
+срабатывает волна из REMINDERS напоминаний с приоритетом REMINDER: пока она
+уходит, ответы ждут в очереди. Задачи создаются в
+порядке получения, как это делает PTB с concurrent_updates. Проверяется, что
+updates одного пользователя начинаются строго по порядку и не пересекаются,
+и печатается задержка до начала обработки у остальных пользователей и до их ответа.
+UpdateLanes гоняется дважды: со слотом, который держится и во время отправки
+(как до UpdateLanes.waiting), и как сейчас.
+
+Запуск: python scripts/bench_update_lanes.py [updates] [частота]
+"""
+
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+UPDATES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+RATE = float(sys.argv[2]) if len(sys.argv) > 2 else 25
+USERS = 200
+HEAVY_USER = 1
+HEAVY_EVERY = 10
+SLOW = 0.3
+WORK = 0.01
+RTT = 0.02
+REMINDERS = 300
+
+
+class StubRequest(BaseRequest):
+    """Bot API без сети: каждый запрос отвечает через RTT."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        await asyncio.sleep(RTT)
+        params = request_data.parameters if request_data else {}
+        if url.endswith("/getMe"):
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif "chat_id" in params:
+            result = {"message_id": 1, "date": int(time.time()),
+                      "chat": {"id": int(params["chat_id"]), "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_update(app, update_id, user_id):
+    return bot.Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": "ping",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+        },
+    }, app.bot)
+
+
+def percentiles(values):
+    values = sorted(values)
+    return (f"p50 {statistics.median(values) * 1000:.0f}ms p95 {values[int(len(values) * 0.95)] * 1000:.0f}ms "
+            f"max {values[-1] * 1000:.0f}ms")
+
+
+async def run(label, concurrent):
+    app = (
+        bot.ApplicationBuilder()
+        .token(bot.BOT_TOKEN)
+        .application_class(bot.BotApplication)
+        .request(StubRequest())
+        .rate_limiter(bot.TelegramRateLimiter(bot.OutboundQueue(bot.RateLimiter())))
+        .build()
+    )
+    await app.initialize()
+    bot.update_lanes = bot.UpdateLanes(bot.UPDATE_CONCURRENCY)
+    created, latencies, replies = {}, [], []
+    started_order = defaultdict(list)
+    running = defaultdict(int)
+    overlaps = 0
+
+    async def handle(update, context):
+        nonlocal overlaps
+        user_id = update.effective_user.id
+        started_order[user_id].append(update.update_id)
+        if user_id != HEAVY_USER:
+            latencies.append(time.monotonic() - created[update.update_id])
+        running[user_id] += 1
+        overlaps += running[user_id] > 1
+        await asyncio.sleep(SLOW if user_id == HEAVY_USER else WORK)
+        await context.bot.send_message(chat_id=user_id, text="pong")
+        if user_id != HEAVY_USER:
+            replies.append(time.monotonic() - created[update.update_id])
+        running[user_id] -= 1
+
+    app.add_handler(TypeHandler(bot.Update, handle))
+
+    burst = [asyncio.create_task(app.bot.send_message(chat_id=100_000 + i, text="💊",
+                                                      rate_limit_args=bot.SendPriority.REMINDER))
+             for i in range(REMINDERS)]
+    tasks = []
+    queue = asyncio.Queue()
+    sent = defaultdict(list)
+
+    async def sequential():
+        while True:
+            await app.process_update(await queue.get())
+            queue.task_done()
+
+    if not concurrent:
+        tasks.append(asyncio.create_task(sequential()))
+    started = time.monotonic()
+    for i in range(1, UPDATES + 1):
+        user_id = HEAVY_USER if i % HEAVY_EVERY == 0 else 1000 + i % USERS
+        created[i] = time.monotonic()
+        sent[user_id].append(i)
+        update = make_update(app, i, user_id)
+        if concurrent:
+            tasks.append(asyncio.create_task(app.process_update(update)))
+        else:
+            queue.put_nowait(update)
+        await asyncio.sleep(max(0.0, started + i / RATE - time.monotonic()))
+    if concurrent:
+        await asyncio.gather(*tasks)
+    else:
+        await queue.join()
+        tasks[0].cancel()
+    elapsed = time.monotonic() - started
+    await asyncio.gather(*burst)
+    await app.shutdown()
+
+    assert started_order == sent, "Нарушен порядок updates пользователя"
+    assert not overlaps, "Updates одного пользователя обрабатывались одновременно"
+    print(f"  {label}: {UPDATES / elapsed:.0f} upd/s, порядок соблюден")
+    print(f"    остальные до начала обработки: {percentiles(latencies)}")
+    print(f"    остальные до ответа:           {percentiles(replies)}")
+    if concurrent:
+        print(f"    {bot.update_lanes.summary()}")
+
+
+async def main():
+    print(f"🧵 {UPDATES} updates, {RATE:g} upd/s, {USERS} польз.; тяжелый пользователь {SLOW * 1000:.0f}ms "
+          f"(каждый {HEAVY_EVERY}-й update), остальные {WORK * 1000:.0f}ms; ответ через Bot API, RTT {RTT * 1000:.0f}ms; "
+          f"волна {REMINDERS} напоминаний; UPDATE_CONCURRENCY={bot.UPDATE_CONCURRENCY}")
+    await run("последовательно", concurrent=False)
+
+    waiting = bot.UpdateLanes.waiting
+    bot.UpdateLanes.waiting = lambda self: contextlib.nullcontext()  # слот держится и во время отправки
+    await run("UpdateLanes, слот на всю обработку", concurrent=True)
+    bot.UpdateLanes.waiting = waiting
+    await run("UpdateLanes", concurrent=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
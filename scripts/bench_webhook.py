@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк приема updates: long polling против встроенного webhook-сервера.
+
+Локальная заглушка Bot API отдает getUpdates (long polling, до 100 updates
+за ответ) с задержкой сети RTT. В webhook-режиме "Telegram" сам POST-ит
+updates на WebhookServer, как настоящий: до 40 соединений, задержка RTT/2.
+Обработчик имитирует работу (WORK секунд await) и меряет задержку от
+появления update до начала обработки. Updates идут с постоянной частотой,
+прогоны - на легкой и тяжелой нагрузке; polling гоняется и как сейчас
+(updates по одному), и с concurrent_updates, чтобы отделить вклад транспорта.
+
+Запуск: python scripts/bench_webhook.py [updates под нагрузкой] [частота нагрузки]
+"""
+
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+
+UPDATES = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+HEAVY_RATE = float(sys.argv[2]) if len(sys.argv) > 2 else 300
+LIGHT_RATE = 20
+LIGHT_UPDATES = 200
+RTT = 0.05
+WORK = 0.02
+SECRET = "bench-secret"
+
+
+class StubState:
+    def __init__(self):
+        self.updates = []
+        self.cond = threading.Condition()
+
+    def push(self, update):
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+
+stub = StubState()
+
+
+class StubBotApi(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[1]
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(raw or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(raw.decode()).items()}
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = stub.get_updates(int(params.get("offset") or 0), int(params.get("limit") or 100),
+                                      float(params.get("timeout") or 0))
+        else:
+            result = True
+        time.sleep(RTT)
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except BrokenPipeError:
+            pass  # polling остановлен, пока висел long poll
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StubBotApi)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{server.server_port}"
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+import httpx  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+
+update_seq = 0
+
+
+def make_update(user_id):
+    global update_seq
+    update_seq += 1
+    return {
+        "update_id": update_seq,
+        "message": {
+            "message_id": update_seq, "date": int(time.time()), "text": "ping",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+        },
+    }
+
+
+def build_app(concurrent):
+    builder = (
+        bot.ApplicationBuilder()
+        .token(bot.BOT_TOKEN)
+        .base_url(f"{bot.TELEGRAM_API_URL}/bot")
+        .application_class(bot.BotApplication)
+    )
+    if concurrent:
+        builder = builder.concurrent_updates(concurrent)
+    return builder.build()
+
+
+async def run(mode, rate, count, concurrent=0):
+    created, latencies = {}, []
+    done = asyncio.Event()
+
+    async def handle(update, context):
+        latencies.append(time.monotonic() - created[update.update_id])
+        await asyncio.sleep(WORK)
+        if len(latencies) == count:
+            done.set()
+
+    app = build_app(concurrent)
+    app.add_handler(TypeHandler(bot.Update, handle))
+    await app.initialize()
+    await app.start()
+
+    webhook = None
+    client = None
+    if mode == "polling":
+        stub.updates.clear()
+        await app.updater.start_polling(poll_interval=0, timeout=10)
+    else:
+        webhook = bot.WebhookServer(app, "127.0.0.1", 0, "/hook", SECRET)
+        await webhook.start()
+        client = httpx.AsyncClient(limits=httpx.Limits(max_connections=40))
+        url = f"http://127.0.0.1:{webhook.port}/hook"
+        connections = asyncio.Semaphore(40)
+
+    async def deliver(update):
+        async with connections:
+            await asyncio.sleep(RTT / 2)
+            r = await client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            assert r.status_code == 200, r.status_code
+
+    deliveries = []
+    started = time.monotonic()
+    for i in range(count):
+        update = make_update(1000 + i % 500)
+        created[update["update_id"]] = time.monotonic()
+        if mode == "polling":
+            stub.push(update)
+        else:
+            deliveries.append(asyncio.create_task(deliver(update)))
+        await asyncio.sleep(max(0.0, started + (i + 1) / rate - time.monotonic()))
+    await asyncio.wait_for(done.wait(), timeout=count / 10 + 60)
+    elapsed = time.monotonic() - started
+
+    if deliveries:
+        await asyncio.gather(*deliveries)
+    if webhook:
+        rejected = await client.post(url, json=make_update(1), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        await client.aclose()
+        await webhook.stop()
+    if app.updater.running:
+        await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+
+    latencies.sort()
+    label = mode + (f" (concurrent_updates={concurrent})" if concurrent and mode == "polling" else "")
+    extra = ""
+    if webhook:
+        extra = f", в работе до {webhook.peak_inflight}, чужой token -> {rejected.status_code}"
+    print(f"  {label}: {count / elapsed:.0f} upd/s, задержка p50 {statistics.median(latencies) * 1000:.0f}ms "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f}ms max {latencies[-1] * 1000:.0f}ms{extra}")
+
+
+async def main():
+    print(f"📨 RTT {RTT * 1000:.0f}ms, обработка {WORK * 1000:.0f}ms")
+    for rate, count in ((LIGHT_RATE, LIGHT_UPDATES), (HEAVY_RATE, UPDATES)):
+        print(f"⏱ нагрузка {rate:g} upd/s, {count} updates")
+        await run("polling", rate, count)
+        await run("polling", rate, count, concurrent=bot.WEBHOOK_MAX_INFLIGHT)
+        await run("webhook", rate, count)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк запуска диспетчера-колеса на большой таблице reminders.
+
+Заполняет reminders N pending-напоминаниями, равномерно размазанными по
+ближайшим 30 дням, и замеряет ReminderWheel.start(): время первой загрузки
+окна, число напоминаний в памяти и прирост памяти процесса.
+
+Запуск: python scripts/bench_wheel_startup.py [кол-во напоминаний] [дней]
+"""
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_bench_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+REMINDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+DAYS = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+
+def fill_reminders():
+    step = DAYS * 86400 / REMINDERS
+    conn = sqlite3.connect(str(bot.DB_PATH))
+    conn.execute(
+        "INSERT INTO reminders (user_id, reminder_type, item_id, scheduled_time, user_timezone, status, retry_count) "
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+        "SELECT i % 50000, 'analysis', i, "
+        "strftime('%Y-%m-%d %H:%M:%f000', 'now', '+' || (i * ?) || ' seconds'), "
+        "'Europe/Moscow', 'pending', 0 FROM n",
+        (REMINDERS, step)
+    )
+    conn.commit()
+    conn.close()
+
+
+async def main():
+    print(f"📁 Временные данные: {TMP}")
+    fill_reminders()
+    print(f"📦 pending-напоминаний: {REMINDERS} на {DAYS} дней, "
+          f"БД {bot.DB_PATH.stat().st_size / 1024 / 1024:.0f} МБ")
+
+    async def dispatch(reminder_ids):
+        pass
+
+    wheel = bot.ReminderWheel()
+    wheel.dispatch = dispatch
+    started = time.perf_counter()
+    loaded = await wheel.start()
+    elapsed = time.perf_counter() - started
+    await wheel.stop()
+
+    # Память замеряется отдельным запуском: tracemalloc сильно замедляет загрузку
+    probe = bot.ReminderWheel()
+    probe.dispatch = dispatch
+    tracemalloc.start()
+    await probe.start()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await probe.stop()
+
+    print(f"  start(): {elapsed * 1000:.0f}ms, в окне {loaded} напоминаний "
+          f"({bot.REMINDER_WHEEL_HORIZON_HOURS:g} ч), корзин {len(wheel._buckets)}")
+    print(f"  пик памяти при загрузке: {peak / 1024 / 1024:.1f} МБ")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""Общая настройка тестов: bot.py читает каталоги из окружения при импорте,
+поэтому каждая сессия pytest получает свои временные DATA_DIR/BACKUP_DIR/LOG_DIR."""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="lor_test_"))
+for name in ("DATA_DIR", "BACKUP_DIR", "LOG_DIR"):
+    os.environ[name] = str(TMP / name.lower())
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ADMIN_CHAT_ID", "")
+sys.path.insert(0, str(ROOT))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Число SQL-запросов экранов статистики не зависит от длины истории пользователя.
+
+Для пользователей с 10, 100 и 1000 записями каждого журнала (приемы идут по
+нескольким разным лекарствам) каждый экран stats_* открывается внутри unit of
+work, запросы считает UnitOfWork.queries.
+"""
+
+import asyncio
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+HISTORY = (10, 100, 1000)
+EXPECTED_QUERIES = {
+    "stats_week": 1,
+    "stats_month": 1,
+    "stats_all": 1,
+    "stats_mood": 1,
+    "stats_symptoms": 1,
+    "stats_medicine": 2,
+}
+
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.text = None
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, *args, **kwargs):
+        self.text = text
+
+
+def fill_history(user_id, entries):
+    """entries записей каждого журнала; приемы идут по entries разным лекарствам (не больше 10)."""
+    now = time.time()
+    conn = sqlite3.connect(str(bot.DB_PATH))
+    conn.executemany(
+        "INSERT INTO medicines (user_id, name, times_per_day, schedule, user_timezone, status, start_date) "
+        "VALUES (?, ?, 1, '09:00', 'Europe/Moscow', 'active', datetime('now'))",
+        [(user_id, f"Лекарство {i}") for i in range(min(entries, 10))]
+    )
+    medicine_ids = [row[0] for row in conn.execute("SELECT id FROM medicines WHERE user_id = ?", (user_id,))]
+    conn.executemany(
+        "INSERT INTO medicine_logs (medicine_id, user_id, status, is_planned, taken_at) "
+        "VALUES (?, ?, 'taken', 1, datetime(?, 'unixepoch'))",
+        [(medicine_ids[i % len(medicine_ids)], user_id, now - i * 3600) for i in range(entries)]
+    )
+    conn.executemany(
+        "INSERT INTO mood_logs (user_id, mood_score, created_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+        [(user_id, 1 + i % 5, now - i * 3600) for i in range(entries)]
+    )
+    conn.executemany(
+        "INSERT INTO symptom_logs (user_id, symptom, severity, created_at) VALUES (?, 'кашель', ?, datetime(?, 'unixepoch'))",
+        [(user_id, 1 + i % 5, now - i * 3600) for i in range(entries)]
+    )
+    conn.commit()
+    conn.close()
+
+
+async def open_screen(user_id, screen):
+    query = FakeQuery(screen)
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=user_id))
+    async with bot.unit_of_work(screen) as uow:
+        await bot.stats_callback(update, SimpleNamespace())
+    return query.text, uow.queries
+
+
+@pytest.fixture(scope="module")
+def screens():
+    """{(записей в истории, экран): (текст, число запросов)} - все в одном event loop."""
+    async def collect():
+        for user_id, entries in enumerate(HISTORY, start=1):
+            fill_history(user_id, entries)
+        await bot.run_daily_stats_backfill()
+        
+        results = {}
+        for user_id, entries in enumerate(HISTORY, start=1):
+            # Первый экран прогревает кэш часового пояса пользователя
+            await open_screen(user_id, "stats")
+            for screen in EXPECTED_QUERIES:
+                results[entries, screen] = await open_screen(user_id, screen)
+        return results
+    
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("entries", HISTORY)
+@pytest.mark.parametrize("screen", EXPECTED_QUERIES)
+def test_stats_screen_query_count_is_constant(screens, screen, entries):
+    text, queries = screens[entries, screen]
+    assert text and "Ошибка" not in text, text
+    assert queries == EXPECTED_QUERIES[screen]